@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 密码哈希基准测试
+1. 不同 PBKDF2 轮数下单次哈希耗时，用于选择 PASSWORD_HASH_ROUNDS；
+2. 模拟登录高峰：并发哈希时，线程内计算与进程池计算的吞吐，以及同时进行的轻量请求的延迟。
+
+用法: python bench_password_hash.py [并发登录数，默认 64]
+"""
+
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from passlib.context import CryptContext
+
+from server.passwords import HASH_ROUNDS, PasswordHasher
+
+
+def bench_rounds():
+    print("⏱️  单次哈希耗时")
+    for rounds in (10_000, 29_000, 100_000, 300_000):
+        ctx = CryptContext(schemes=["pbkdf2_sha256"], pbkdf2_sha256__rounds=rounds)
+        timings = []
+        for _ in range(5):
+            began = time.perf_counter()
+            ctx.hash("correct horse battery staple")
+            timings.append((time.perf_counter() - began) * 1000)
+        mark = "  ← 当前配置" if rounds == HASH_ROUNDS else ""
+        print(f"   rounds={rounds:<8,} 中位 {statistics.median(timings):6.1f} ms{mark}")
+
+
+def probe_latency(stop: threading.Event, samples: list):
+    """模拟生成接口中的轻量 Python 工作，测量其在哈希高峰期间的延迟"""
+    while not stop.is_set():
+        began = time.perf_counter()
+        sum(i * i for i in range(20_000))
+        samples.append((time.perf_counter() - began) * 1000)
+        time.sleep(0.005)
+
+
+def bench_burst(hasher: PasswordHasher, n: int, label: str):
+    stop = threading.Event()
+    samples: list = []
+    probe = threading.Thread(target=probe_latency, args=(stop, samples))
+    probe.start()
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=40) as pool:  # 与 Starlette 默认线程池大小一致
+        list(pool.map(lambda i: hasher.hash(f"password-{i}"), range(n)))
+    elapsed = time.perf_counter() - began
+    stop.set()
+    probe.join()
+    samples.sort()
+    p95 = samples[int(len(samples) * 0.95)] if samples else 0
+    print(f"   {label:<16} {n / elapsed:7.1f} 次/秒  轻量请求 p95 {p95:6.1f} ms")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    bench_rounds()
+    print("=" * 50)
+    print(f"🔐 并发 {n} 次哈希（rounds={HASH_ROUNDS:,}）")
+    bench_burst(PasswordHasher(workers=0, max_pending=n, timeout=60), n, "线程内")
+    workers = os.cpu_count() or 1
+    hasher = PasswordHasher(workers=workers, max_pending=workers * 8, timeout=60)
+    hasher.hash("warmup")
+    bench_burst(hasher, n, f"进程池({workers})")
+    hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
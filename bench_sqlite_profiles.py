@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI SQLite 存储配置基准测试
+对每个存储配置（APP_DB_PROFILE）新建临时数据库，多个写线程模拟生成调用的用量写入
+（计数器 UPSERT + 用量事件 + 汇总表），多个读线程同时分页读取用户列表，测量吞吐与读延迟。
+
+用法: python bench_sqlite_profiles.py [每个配置的秒数，默认 5] [读线程，默认 8] [写线程，默认 4]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ.setdefault("SESSION_SECRET", "bench")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from server.db import Base, Tenant, UsageEvent, User, utcnow
+from server.rollups import apply_event
+from server.serialization import user_dicts, user_query
+from server.storage import PROFILES, engine_options, install_pragmas, verify
+from server.usage import increment_usage
+
+USERS = 20_000
+TENANTS = 20
+PAGE = 50
+
+
+def make_engine(profile, path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}, **engine_options(profile))
+    install_pragmas(engine, profile)
+    return engine
+
+
+def populate(engine) -> None:
+    Base.metadata.create_all(bind=engine)
+    now = utcnow()
+    with sessionmaker(bind=engine)() as db:
+        db.execute(insert(Tenant), [{"id": t, "name": f"租户{t}", "created_at": now, "updated_at": now} for t in range(1, TENANTS + 1)])
+        db.execute(insert(User), [
+            {
+                "id": i, "tenant_id": i % TENANTS + 1, "email": f"user{i}@bench.example.com", "password_hash": "x",
+                "name": f"用户{i}", "organization": f"租户{i % TENANTS + 1}", "phone": "13800000000",
+                "is_admin": False, "role": "user", "status": "active", "created_at": now, "updated_at": now,
+            }
+            for i in range(1, USERS + 1)
+        ])
+        db.commit()
+
+
+def run(profile, seconds: float, readers: int, writers: int):
+    path = os.path.join(tempfile.mkdtemp(prefix=f"sqlite_{profile.name}_"), "bench.db")
+    engine = make_engine(profile, path)
+    verify(engine, profile)
+    populate(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    stop = time.perf_counter() + seconds
+    lock = threading.Lock()
+    stats = {"writes": 0, "reads": 0, "errors": 0, "read_ms": []}
+
+    def writer(seed: int):
+        n, i = 0, seed
+        while time.perf_counter() < stop:
+            i = (i * 1103515245 + 12345) % USERS
+            user_id = i + 1
+            tenant_id = user_id % TENANTS + 1
+            db = Session()
+            try:
+                increment_usage(db, user_id)
+                created_at = utcnow()
+                db.add(UsageEvent(user_id=user_id, tenant_id=tenant_id, event_type="generate", created_at=created_at))
+                apply_event(db, tenant_id, user_id, created_at, 100, 500)
+                db.commit()
+                n += 1
+            except OperationalError:
+                db.rollback()
+                with lock:
+                    stats["errors"] += 1
+            finally:
+                db.close()
+        with lock:
+            stats["writes"] += n
+
+    def reader(seed: int):
+        n, timings = 0, []
+        tenant_id = seed % TENANTS + 1
+        while time.perf_counter() < stop:
+            began = time.perf_counter()
+            db = Session()
+            try:
+                rows = user_query(db).filter(User.tenant_id == tenant_id).order_by(User.id.asc()).limit(PAGE)
+                user_dicts(rows)
+                n += 1
+                timings.append((time.perf_counter() - began) * 1000)
+            except OperationalError:
+                with lock:
+                    stats["errors"] += 1
+            finally:
+                db.close()
+            tenant_id = tenant_id % TENANTS + 1
+        with lock:
+            stats["reads"] += n
+            stats["read_ms"].extend(timings)
+
+    threads = [threading.Thread(target=writer, args=(i + 1,)) for i in range(writers)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+    timings = sorted(stats["read_ms"]) or [0.0]
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    return stats["writes"] / seconds, stats["reads"] / seconds, p99, stats["errors"]
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    writers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    print(f"🔍 {USERS:,} 个用户，{writers} 个写线程 + {readers} 个读线程，每个配置 {seconds:g} 秒")
+    print("=" * 64)
+    print(f"{'配置':<10}{'写入/秒':>10}{'读取/秒':>10}{'读 p99 (ms)':>14}{'锁冲突':>8}")
+    for profile in PROFILES.values():
+        writes, reads, p99, errors = run(profile, seconds, readers, writers)
+        print(f"{profile.name:<10}{writes:>10.0f}{reads:>10.0f}{p99:>14.1f}{errors:>8}")
+    print("=" * 64)
+    print("legacy 为改动前的默认设置（回滚日志、无连接复用），其余为 server/storage.py 中的配置")
+
+
+if __name__ == "__main__":
+    main()
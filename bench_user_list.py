@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 用户列表序列化基准测试
+在临时数据库中生成一个大租户，对比两种列表输出路径的耗时：
+  原路径：加载 ORM 对象 -> response_model 逐行 from_attributes 校验 -> 标准库 json 编码
+  快速路径：列投影查询 -> 行元组直接拼 dict -> orjson 编码
+
+用法: python bench_user_list.py [用户数，默认 50000]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+from typing import List
+
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ.setdefault("SESSION_SECRET", "bench")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from pydantic import TypeAdapter
+from sqlalchemy import insert
+
+from server.db import Base, SessionLocal, Tenant, User, UserUsageCounter, engine, run_simple_migrations, utcnow
+from server.main import UserResponse
+from server.serialization import dumps, user_dicts, user_query
+
+TENANT_ID = 1
+ROUNDS = 5
+
+
+def populate(n: int) -> None:
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+    now = utcnow()
+    with SessionLocal() as db:
+        db.add(Tenant(id=TENANT_ID, name="基准租户"))
+        db.flush()
+        db.execute(insert(User), [
+            {
+                "id": i,
+                "tenant_id": TENANT_ID,
+                "email": f"user{i}@bench.example.com",
+                "password_hash": "x",
+                "name": f"用户{i}",
+                "organization": "基准租户",
+                "phone": f"138{i:08d}",
+                "is_admin": False,
+                "usage_quota": 1000 if i % 3 else None,
+                "role": "user",
+                "status": "active" if i % 10 else "disabled",
+                "notes": "备注" * 100,
+                "daily_quota": 50,
+                "created_at": now,
+                "updated_at": now,
+            }
+            for i in range(1, n + 1)
+        ])
+        db.execute(insert(UserUsageCounter), [
+            {"user_id": i, "usage_used": i % 997, "daily_used": i % 50, "daily_reset_at": date.today()}
+            for i in range(1, n + 1, 2)
+        ])
+        db.commit()
+
+
+def orm_path() -> bytes:
+    # 与 FastAPI 处理 response_model=List[UserResponse] 的过程一致
+    adapter = TypeAdapter(List[UserResponse])
+    with SessionLocal() as db:
+        users = db.query(User).filter(User.tenant_id == TENANT_ID).order_by(User.id.asc()).all()
+        content = adapter.dump_python(adapter.validate_python(users, from_attributes=True), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def fast_path() -> bytes:
+    with SessionLocal() as db:
+        rows = user_query(db).filter(User.tenant_id == TENANT_ID).order_by(User.id.asc())
+        return dumps(user_dicts(rows))
+
+
+def measure(fn) -> float:
+    timings = []
+    for _ in range(ROUNDS):
+        began = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - began) * 1000)
+    return sorted(timings)[ROUNDS // 2]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    began = time.perf_counter()
+    populate(n)
+    print(f"📥 生成 {n:,} 个用户: {(time.perf_counter() - began) * 1000:.0f} ms")
+
+    # 两条路径的输出必须逐字段一致
+    assert json.loads(orm_path()) == json.loads(fast_path()), "两种路径的输出不一致"
+
+    print("=" * 50)
+    orm_ms = measure(orm_path)
+    fast_ms = measure(fast_path)
+    size_kb = len(fast_path()) / 1024
+    print(f"ORM + Pydantic + json : {orm_ms:8.1f} ms")
+    print(f"投影 + dict + orjson   : {fast_ms:8.1f} ms")
+    print(f"响应体 {size_kb:,.0f} KB，提速 {orm_ms / fast_ms:.1f}x（{ROUNDS} 次取中位数）")
+
+
+if __name__ == "__main__":
+    main()
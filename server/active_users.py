@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .db import ActiveUserSketch, SessionLocal, UsageEvent, utcnow
+from .retention import iter_archive_by_day
+from .rollups import to_naive_utc
+from .sketches import HyperLogLog
+
+
+# -----------------------------
+# 活跃用户数（HyperLogLog）
+# -----------------------------
+# 每个 (租户, UTC日期) 维护一个 HyperLogLog。调用时只更新内存中的 sketch，
+# 寄存器有变化时标记为脏，由写入路径按间隔批量落库；落库时与库中已有寄存器逐项取最大值合并，
+# 重启、rebuild 清空内存或多个进程各自累积的 sketch 都不会覆盖此前落库的部分。
+# 任意日期范围的活跃用户数 = 合并范围内各日 sketch 后估计，成本只与天数相关。
+
+PRECISION = 12
+FLUSH_INTERVAL = 5.0  # 秒
+
+
+class ActiveUserTracker:
+    def __init__(self, precision: int = PRECISION, flush_interval: float = FLUSH_INTERVAL):
+        self.precision = precision
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._sketches: Dict[Tuple[int, date], HyperLogLog] = {}
+        self._dirty: set = set()
+        self._last_flush = time.monotonic()
+
+    def _load(self, db: Session, tenant_id: int, day: date) -> HyperLogLog:
+        row = (
+            db.query(ActiveUserSketch)
+            .filter(ActiveUserSketch.tenant_id == tenant_id, ActiveUserSketch.day == day)
+            .first()
+        )
+        if row is None:
+            return HyperLogLog(self.precision)
+        return HyperLogLog.from_bytes(row.registers, row.precision)
+
+    def observe(self, db: Session, tenant_id: int, user_id: int, when: Optional[datetime] = None) -> None:
+        """记录一次活跃（通常在用量事件写入后调用）"""
+        day = to_naive_utc(when or utcnow()).date()
+        key = (tenant_id, day)
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            loaded = self._load(db, tenant_id, day)
+            with self._lock:
+                sketch = self._sketches.setdefault(key, loaded)
+        with self._lock:
+            if sketch.add(user_id):
+                self._dirty.add(key)
+
+    def maybe_flush(self, force: bool = False) -> int:
+        """到达间隔后把脏 sketch 落库；并发调用时只有一个线程执行"""
+        if not force and time.monotonic() - self._last_flush < self.flush_interval:
+            return 0
+        if not self._flush_lock.acquire(blocking=force):
+            return 0
+        try:
+            with self._lock:
+                dirty = self._dirty
+                self._dirty = set()
+                payload = [(key, HyperLogLog(self.precision, bytes(self._sketches[key].registers))) for key in dirty]
+                # 只保留最近两天的 sketch 在内存中
+                horizon = utcnow().date() - timedelta(days=1)
+                for key in [k for k in self._sketches if k[1] < horizon and k not in dirty]:
+                    del self._sketches[key]
+            self._last_flush = time.monotonic()
+            if not payload:
+                return 0
+            db = SessionLocal()
+            try:
+                for (tenant_id, day), sketch in payload:
+                    self._upsert(db, tenant_id, day, sketch)
+                db.commit()
+            except Exception:
+                db.rollback()
+                with self._lock:
+                    self._dirty |= dirty
+                raise
+            finally:
+                db.close()
+            # 库中已有的部分并回内存，之后的估计与落库都包含它们
+            with self._lock:
+                for key, sketch in payload:
+                    if key in self._sketches:
+                        self._sketches[key].merge(sketch)
+            return len(payload)
+        finally:
+            self._flush_lock.release()
+
+    def _upsert(self, db: Session, tenant_id: int, day: date, sketch: HyperLogLog) -> None:
+        """与库中已有的 sketch 逐项取最大值合并后写入（sketch 原地更新为合并结果）"""
+        row = (
+            db.query(ActiveUserSketch.registers, ActiveUserSketch.precision)
+            .filter(ActiveUserSketch.tenant_id == tenant_id, ActiveUserSketch.day == day)
+            .first()
+        )
+        if row is not None and row.precision == sketch.p:
+            sketch.merge(HyperLogLog.from_bytes(row.registers, row.precision))
+        tbl = ActiveUserSketch.__table__
+        stmt = sqlite_insert(tbl).values(
+            tenant_id=tenant_id, day=day, precision=sketch.p, registers=sketch.to_bytes(), updated_at=utcnow()
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tbl.c.tenant_id, tbl.c.day],
+            set_={"registers": stmt.excluded.registers, "updated_at": stmt.excluded.updated_at},
+        )
+        db.execute(stmt)
+
+    def estimate(
+        self, db: Session, start: date, end: date, tenant_id: Optional[int] = None
+    ) -> Dict[str, float]:
+        """估计 [start, end]（按日闭区间）内的去重活跃用户数；tenant_id 为空表示全部租户"""
+        q = db.query(ActiveUserSketch).filter(ActiveUserSketch.day >= start, ActiveUserSketch.day <= end)
+        if tenant_id is not None:
+            q = q.filter(ActiveUserSketch.tenant_id == tenant_id)
+        sketches: Dict[Tuple[int, date], HyperLogLog] = {
+            (row.tenant_id, row.day): HyperLogLog.from_bytes(row.registers, row.precision) for row in q.all()
+        }
+        # 内存中的 sketch 比库中更新（尚未落库的部分）
+        with self._lock:
+            for key, sketch in self._sketches.items():
+                if start <= key[1] <= end and (tenant_id is None or key[0] == tenant_id):
+                    sketches[key] = HyperLogLog(sketch.p, bytes(sketch.registers))
+        merged = HyperLogLog.union(sketches.values(), self.precision)
+        return {
+            "active_users": int(round(merged.estimate())) if sketches else 0,
+            "relative_error": round(merged.relative_error, 4),
+            "sketches": len(sketches),
+        }
+
+    def rebuild(self, db: Session) -> Dict[str, int]:
+        """根据冷归档与 usage_events 重建全部 sketch"""
+        rebuilt: Dict[Tuple[int, date], HyperLogLog] = {}
+
+        def feed(events: Iterable[Tuple[int, int, datetime]]) -> None:
+            for tenant_id, user_id, created_at in events:
+                key = (tenant_id, to_naive_utc(created_at).date())
+                sketch = rebuilt.get(key)
+                if sketch is None:
+                    sketch = rebuilt[key] = HyperLogLog(self.precision)
+                sketch.add(user_id)
+
+        for _, rows in iter_archive_by_day():
+            feed((r["tenant_id"], r["user_id"], datetime.fromisoformat(r["created_at"])) for r in rows)
+        feed(
+            db.query(UsageEvent.tenant_id, UsageEvent.user_id, UsageEvent.created_at).yield_per(10000)
+        )
+        with self._flush_lock:
+            try:
+                db.query(ActiveUserSketch).delete(synchronize_session=False)
+                for (tenant_id, day), sketch in rebuilt.items():
+                    self._upsert(db, tenant_id, day, sketch)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            with self._lock:
+                self._sketches.clear()
+                self._dirty.clear()
+        return {"sketches": len(rebuilt)}
+
+    def ensure(self, db: Session) -> None:
+        """启动时检查：已有事件但没有任何 sketch（首次启用）时执行一次重建"""
+        if db.query(UsageEvent.id).first() and not db.query(ActiveUserSketch.tenant_id).first():
+            self.rebuild(db)
+
+
+# 全局实例
+active_users = ActiveUserTracker()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from .db import Subscription, User, UserUsageCounter, utcnow
+from .tokens import revocations
+
+
+# -----------------------------
+# 批量用户操作
+# -----------------------------
+# 按筛选条件（ID 列表 / 租户 / 状态）选中用户，每种操作都是少量 UPDATE / DELETE ... WHERE id IN (子查询)，
+# 整体在一个事务内提交，与用户数无关地只往返几次数据库。
+# 需要撤销令牌的操作（禁用、删除）先执行批量撤销的 INSERT ... SELECT，同时取得写锁，
+# 之后同一事务内查询到的用户集合即为最终受影响的集合。
+
+BULK_OPS = ("set_quota", "reset_usage", "enable", "disable", "delete")
+MAX_BULK_IDS = 10000
+
+
+def bulk_conditions(
+    ids: Optional[Sequence[int]] = None,
+    tenant_id: Optional[int] = None,
+    status: Optional[str] = None,
+) -> List[Any]:
+    conditions: List[Any] = []
+    if ids is not None:
+        conditions.append(User.id.in_(list(ids)))
+    if tenant_id is not None:
+        conditions.append(User.tenant_id == tenant_id)
+    if status is not None:
+        conditions.append(User.status == status)
+    return conditions
+
+
+def _selected(conditions: Sequence[Any]):
+    return select(User.id).where(*conditions)
+
+
+def _rows(db: Session, conditions: Sequence[Any]) -> List[Tuple[int, int]]:
+    return [(r.id, r.tenant_id) for r in db.execute(select(User.id, User.tenant_id).where(*conditions))]
+
+
+def run_bulk(
+    db: Session, op: str, conditions: Sequence[Any], values: Optional[Dict[str, Any]] = None
+) -> Tuple[Dict[str, int], List[Tuple[int, int]]]:
+    """执行批量操作并提交，返回 (各表受影响行数, [(用户ID, 租户ID)])"""
+    if op not in BULK_OPS:
+        raise ValueError(f"不支持的批量操作: {op}（可选 {', '.join(BULK_OPS)}）")
+    conditions = list(conditions)
+    now = utcnow()
+    affected: Dict[str, int] = {}
+    if op == "set_quota":
+        if not values:
+            raise ValueError("请指定 usage_quota 或 daily_quota")
+        # 配额不是筛选条件，更新前后选中的用户相同
+        affected["users"] = db.execute(
+            update(User).where(*conditions).values(**values, updated_at=now).execution_options(synchronize_session=False)
+        ).rowcount
+        rows = _rows(db, conditions)
+    elif op == "reset_usage":
+        affected["counters"] = db.execute(
+            update(UserUsageCounter)
+            .where(UserUsageCounter.user_id.in_(_selected(conditions)))
+            .values(usage_used=0, daily_used=0)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        rows = _rows(db, conditions)
+    elif op == "enable":
+        # 只处理状态确实变化的用户；启用不需要撤销令牌
+        conditions.append(User.status != "active")
+        rows = _rows(db, conditions)
+        affected["users"] = db.execute(
+            update(User).where(*conditions).values(status="active", updated_at=now).execution_options(synchronize_session=False)
+        ).rowcount
+    elif op == "disable":
+        conditions.append(User.status == "active")
+        affected["revoked"] = len(revocations.revoke_matching(db, _selected(conditions)))
+        rows = _rows(db, conditions)
+        affected["users"] = db.execute(
+            update(User).where(*conditions).values(status="disabled", updated_at=now).execution_options(synchronize_session=False)
+        ).rowcount
+    else:
+        affected["revoked"] = len(revocations.revoke_matching(db, _selected(conditions)))
+        rows = _rows(db, conditions)
+        # 与单个删除一致：计数器与订阅随用户删除，用量事件保留
+        affected["counters"] = db.execute(
+            delete(UserUsageCounter).where(UserUsageCounter.user_id.in_(_selected(conditions)))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        affected["subscriptions"] = db.execute(
+            delete(Subscription).where(Subscription.user_id.in_(_selected(conditions)))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        affected["users"] = db.execute(
+            delete(User).where(*conditions).execution_options(synchronize_session=False)
+        ).rowcount
+    db.commit()
+    return affected, rows
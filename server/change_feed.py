@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+
+# -----------------------------
+# 变更推送（Server-Sent Events）
+# -----------------------------
+# 写入路径调用 publish 把紧凑的增量事件发到进程内的发布/订阅中心，每个 SSE 连接是一个订阅者，
+# 按范围过滤：系统管理员收全部事件，医院管理员收本租户事件，普通用户只收与自己相关的事件。
+# 事件只序列化一次；订阅者的队列有上限，消费过慢时丢弃积压并下发 resync，客户端重新拉取全量。
+# 最近的事件保留在环形缓冲中，断线重连时按 Last-Event-ID 补发，缺口过大或服务已重启（事件ID带进程 epoch）
+# 同样下发 resync。
+# 空闲时定期发送注释行作为心跳，避免代理断开连接。浏览器标签页数量不再影响数据库读负载。
+# EventSource 无法设置请求头：客户端先用请求头鉴权换取短期一次性票据（StreamTickets），再以 ticket 查询参数
+# 建立连接，长期令牌不会出现在 URL、访问日志与浏览器历史中。票据只在签发它的进程内有效。
+
+HEARTBEAT_SECONDS = float(os.getenv("CHANGE_FEED_HEARTBEAT", "15"))
+QUEUE_SIZE = int(os.getenv("CHANGE_FEED_QUEUE", "1000"))
+REPLAY_SIZE = 2048
+RETRY_MS = 3000
+TICKET_TTL = float(os.getenv("CHANGE_FEED_TICKET_TTL", "30"))  # 秒
+
+# (序号, 事件类型, 租户ID, 用户ID, JSON 数据)
+Event = Tuple[int, str, Optional[int], Optional[int], str]
+
+
+class Subscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop, tenant_id: Optional[int], user_id: Optional[int]):
+        self.loop = loop
+        self.tenant_id = tenant_id  # None：不限租户
+        self.user_id = user_id  # 非空：只接收该用户的事件
+        self.queue: "asyncio.Queue[Event]" = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.overflowed = False
+
+    def accepts(self, event: Event) -> bool:
+        _, kind, tenant_id, user_id, _ = event
+        if kind == "resync":
+            # 全量刷新影响范围内的所有订阅者：不带租户时广播，带租户时含该租户的普通用户
+            return tenant_id is None or self.tenant_id is None or tenant_id == self.tenant_id
+        if self.user_id is not None:
+            return user_id == self.user_id
+        return self.tenant_id is None or tenant_id == self.tenant_id
+
+    def offer(self, event: Event) -> None:
+        """在事件循环线程中执行"""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class ChangeFeed:
+    def __init__(self, replay_size: int = REPLAY_SIZE):
+        self._lock = threading.Lock()
+        self.epoch = secrets.token_hex(4)
+        self._subscribers: Set[Subscriber] = set()
+        self._seq = 0
+        self._recent: Deque[Event] = deque(maxlen=replay_size)
+
+    def has_subscribers(self, tenant_id: Optional[int] = None, user_id: Optional[int] = None) -> bool:
+        """是否有订阅者会收到该范围的事件（没有时写入路径可跳过组装事件的额外查询）"""
+        probe: Event = (0, "", tenant_id, user_id, "")
+        with self._lock:
+            return any(sub.accepts(probe) for sub in self._subscribers)
+
+    def publish(
+        self, kind: str, data: Dict[str, Any], tenant_id: Optional[int] = None, user_id: Optional[int] = None
+    ) -> None:
+        """发布事件，可在任意线程调用"""
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+        with self._lock:
+            self._seq += 1
+            event: Event = (self._seq, kind, tenant_id, user_id, payload)
+            self._recent.append(event)
+            targets = [sub for sub in self._subscribers if sub.accepts(event)]
+        for sub in targets:
+            try:
+                sub.loop.call_soon_threadsafe(sub.offer, event)
+            except RuntimeError:
+                # 事件循环已关闭（进程退出中）
+                pass
+
+    def subscribe(
+        self, tenant_id: Optional[int] = None, user_id: Optional[int] = None, last_event_id: Optional[str] = None
+    ) -> Subscriber:
+        """在事件循环线程中调用；带 Last-Event-ID 时补发缓冲中之后的事件"""
+        sub = Subscriber(asyncio.get_running_loop(), tenant_id, user_id)
+        with self._lock:
+            self._subscribers.add(sub)
+            backlog: List[Event] = []
+            if last_event_id:
+                epoch, _, seq = last_event_id.partition("-")
+                try:
+                    last = int(seq) if epoch == self.epoch else None
+                except ValueError:
+                    last = None
+                if last is None:
+                    sub.overflowed = True
+                elif last < self._seq:
+                    oldest = self._recent[0][0] if self._recent else self._seq + 1
+                    if last + 1 < oldest:
+                        sub.overflowed = True
+                    else:
+                        backlog = [e for e in self._recent if e[0] > last]
+        for event in backlog:
+            if sub.accepts(event):
+                sub.offer(event)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    async def stream(self, sub: Subscriber, heartbeat: float = HEARTBEAT_SECONDS) -> AsyncIterator[str]:
+        """SSE 文本流；连接断开时由 StreamingResponse 取消，finally 中退订"""
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                if sub.overflowed:
+                    while not sub.queue.empty():
+                        sub.queue.get_nowait()
+                    sub.overflowed = False
+                    with self._lock:
+                        seq = self._seq
+                    yield f"id: {self.epoch}-{seq}\nevent: resync\ndata: {{}}\n\n"
+                try:
+                    seq, kind, _, _, payload = await asyncio.wait_for(sub.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"id: {self.epoch}-{seq}\nevent: {kind}\ndata: {payload}\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+
+class StreamTickets:
+    def __init__(self, ttl: float = TICKET_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tickets: Dict[str, Tuple[float, Optional[int], Optional[int]]] = {}
+
+    def issue(self, tenant_id: Optional[int], user_id: Optional[int]) -> str:
+        """签发绑定订阅范围的票据"""
+        ticket = secrets.token_urlsafe(24)
+        now = time.monotonic()
+        with self._lock:
+            # 顺带清理过期未用的票据
+            self._tickets = {k: v for k, v in self._tickets.items() if v[0] > now}
+            self._tickets[ticket] = (now + self.ttl, tenant_id, user_id)
+        return ticket
+
+    def redeem(self, ticket: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """兑换票据（只能使用一次），返回 (租户ID, 用户ID)；无效或已过期时为 None"""
+        with self._lock:
+            entry = self._tickets.pop(ticket, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1], entry[2]
+
+
+# 全局实例
+change_feed = ChangeFeed()
+stream_tickets = StreamTickets()
@@ -0,0 +1,493 @@
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from .db import DB_PATH, UsageEvent
+from .retention import iter_archive_by_day
+from .rollups import to_naive_utc
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# 列式用量事件存储（numpy memmap）
+# -----------------------------
+# 与 usage_events 并行的只追加存储：每列一个定长数组文件，按段（segment）切分，
+# 读取时用 numpy.memmap 映射，分析查询全部是向量化运算（searchsorted/bincount/percentile）。
+# 该存储是派生数据，可随时通过 rebuild_from_db 从 usage_events 与冷归档重建。
+# 每段内 ts 非递减：并发写入时先取时间戳的事件可能后到达，这类行插入当前可写段中的对应位置；
+# 早于可写段起点（所在段已封存）的行无法按序写入，拒绝并计入 rejected，重建后找回。
+# 追加只写入映射页，不在请求路径上刷盘：未落盘行数达到 USAGE_COLUMNAR_FLUSH_ROWS 或距上次刷盘超过
+# USAGE_COLUMNAR_FLUSH_SECONDS 时，由后台线程刷写映射并持久化清单（行数）；进程异常退出最多丢失
+# 最近一个刷盘间隔内的行，可通过重建找回。USAGE_COLUMNAR_FLUSH_SECONDS=0 时每次追加都同步刷盘。
+# 注意：同一目录只允许一个进程写入（多 worker 部署时请为每个进程配置不同目录或关闭写入）。
+
+COLUMNAR_DIR = os.getenv("USAGE_COLUMNAR_DIR", os.path.join(os.path.dirname(DB_PATH), "columnar"))
+COLUMNAR_ENABLED = os.getenv("USAGE_COLUMNAR_ENABLED", "1") == "1"
+SEGMENT_ROWS = int(os.getenv("USAGE_COLUMNAR_SEGMENT_ROWS", str(1 << 20)))
+FLUSH_ROWS = int(os.getenv("USAGE_COLUMNAR_FLUSH_ROWS", "4096"))
+FLUSH_SECONDS = float(os.getenv("USAGE_COLUMNAR_FLUSH_SECONDS", "1"))
+
+# 列定义：时间戳为 UTC 微秒；tokens/latency 缺失时记为 -1
+COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ("ts", "<i8"),
+    ("tenant_id", "<i4"),
+    ("user_id", "<i4"),
+    ("tokens", "<i4"),
+    ("latency", "<i4"),
+)
+MISSING = -1
+_US_PER_DAY = 86_400_000_000
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch_us(dt: datetime) -> int:
+    delta = to_naive_utc(dt) - _EPOCH
+    return (delta.days * 86_400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def from_epoch_us(ts: int) -> datetime:
+    return datetime.fromtimestamp(ts / 1_000_000, tz=timezone.utc).replace(tzinfo=None)
+
+
+class ColumnarEventStore:
+    """按段组织的列式事件存储"""
+
+    def __init__(
+        self,
+        root: str,
+        segment_rows: int = SEGMENT_ROWS,
+        flush_rows: int = FLUSH_ROWS,
+        flush_seconds: float = FLUSH_SECONDS,
+    ):
+        self.root = root
+        self.segment_rows = segment_rows
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._unflushed = 0  # 已写入映射、清单尚未记录的行数
+        self._flushed_at = time.monotonic()
+        self._flush_wanted = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._segments: List[Dict[str, Any]] = []
+        self._readers: Dict[str, Dict[str, np.memmap]] = {}
+        self._writer: Optional[Dict[str, np.memmap]] = None
+        self._last_ts = 0
+        self.rejected = 0  # 因乱序无法写入的行数
+        self._loaded = False
+
+    # ---- 段与清单 ----
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, "manifest.json")
+
+    def _column_path(self, segment: str, column: str) -> str:
+        return os.path.join(self.root, f"{segment}.{column}")
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        path = self._manifest_path()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.segment_rows = manifest.get("segment_rows", self.segment_rows)
+            self._segments = manifest.get("segments", [])
+            self.rejected = manifest.get("rejected", 0)
+        if self._segments:
+            self._last_ts = self._segments[-1]["ts_max"] or 0
+        self._loaded = True
+
+    def _save_manifest(self) -> None:
+        if self._writer is not None:
+            for arr in self._writer.values():
+                arr.flush()
+        tmp = self._manifest_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segment_rows": self.segment_rows, "segments": self._segments, "rejected": self.rejected}, f)
+        os.replace(tmp, self._manifest_path())
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+
+    def _open_writer(self) -> Dict[str, np.memmap]:
+        """打开（或新建）当前可写段"""
+        if self._writer is not None and self._segments[-1]["rows"] < self.segment_rows:
+            return self._writer
+        if self._writer is not None:
+            self._save_manifest()
+            self._readers.pop(self._segments[-1]["name"], None)
+            self._writer = None
+        if not self._segments or self._segments[-1]["rows"] >= self.segment_rows:
+            name = f"seg_{len(self._segments) + 1:06d}"
+            self._segments.append({"name": name, "rows": 0, "ts_min": None, "ts_max": None})
+            mode = "w+"
+        else:
+            mode = "r+"
+        name = self._segments[-1]["name"]
+        self._writer = {
+            col: np.memmap(self._column_path(name, col), dtype=dtype, mode=mode, shape=(self.segment_rows,))
+            for col, dtype in COLUMNS
+        }
+        return self._writer
+
+    def _segment_arrays(self, seg: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        rows = seg["rows"]
+        if self._writer is not None and seg is self._segments[-1]:
+            return {col: arr[:rows] for col, arr in self._writer.items()}
+        arrays = self._readers.get(seg["name"])
+        if arrays is None:
+            arrays = {
+                col: np.memmap(self._column_path(seg["name"], col), dtype=dtype, mode="r", shape=(self.segment_rows,))
+                for col, dtype in COLUMNS
+            }
+            self._readers[seg["name"]] = arrays
+        return {col: arr[:rows] for col, arr in arrays.items()}
+
+    # ---- 写入 ----
+
+    def append_many(self, columns: Dict[str, np.ndarray]) -> int:
+        """批量追加（批内先按时间排序）；返回写入行数，乱序且无法写入的行计入 rejected"""
+        n = len(columns["ts"])
+        if n == 0:
+            return 0
+        order = np.argsort(columns["ts"], kind="stable")
+        batch = {col: np.asarray(columns[col]).astype(dtype)[order] for col, dtype in COLUMNS}
+        with self._lock:
+            self._load()
+            split = int(np.searchsorted(batch["ts"], self._last_ts, side="left"))
+            written = 0
+            if split:
+                written += self._insert_late({col: arr[:split] for col, arr in batch.items()})
+            if split < n:
+                written += self._append_sorted({col: arr[split:] for col, arr in batch.items()})
+            self._unflushed += n
+            if self._flusher is not None:
+                if self._unflushed >= self.flush_rows:
+                    self._flush_wanted.set()
+            elif self._unflushed >= self.flush_rows or time.monotonic() - self._flushed_at >= self.flush_seconds:
+                # 未启动后台刷盘线程（脚本、测试）时按同样的阈值同步刷盘
+                self._save_manifest()
+        return written
+
+    def _append_sorted(self, batch: Dict[str, np.ndarray]) -> int:
+        """追加不早于已写入数据的行（batch 已按 ts 排序）"""
+        ts = batch["ts"]
+        n = len(ts)
+        offset = 0
+        while offset < n:
+            writer = self._open_writer()
+            seg = self._segments[-1]
+            take = min(n - offset, self.segment_rows - seg["rows"])
+            lo, hi = seg["rows"], seg["rows"] + take
+            for col, _ in COLUMNS:
+                writer[col][lo:hi] = batch[col][offset:offset + take]
+            if seg["ts_min"] is None:
+                seg["ts_min"] = int(ts[offset])
+            seg["ts_max"] = int(ts[offset + take - 1])
+            seg["rows"] = hi
+            offset += take
+        self._last_ts = int(ts[-1])
+        return n
+
+    def _insert_late(self, batch: Dict[str, np.ndarray]) -> int:
+        """把早于最新时间戳的行（batch 已按 ts 排序）按序插入当前可写段，段内其后的行整体后移"""
+        ts = batch["ts"]
+        seg = self._segments[-1] if self._segments else None
+        keep = 0
+        if seg is not None and seg["rows"] and seg["rows"] + len(ts) <= self.segment_rows:
+            floor = self._segments[-2]["ts_max"] if len(self._segments) > 1 else None
+            start = int(np.searchsorted(ts, floor, side="left")) if floor is not None else 0
+            keep = len(ts) - start
+        rejected = len(ts) - keep
+        if rejected:
+            self.rejected += rejected
+            logger.warning("列式存储拒绝 %d 行乱序事件（早于可写段或可写段已满），可通过重建找回", rejected)
+        if not keep:
+            return 0
+        late = {col: arr[rejected:] for col, arr in batch.items()}
+        writer = self._open_writer()
+        rows = seg["rows"]
+        pos = int(np.searchsorted(writer["ts"][:rows], late["ts"][0], side="right"))
+        order = np.argsort(np.concatenate([writer["ts"][pos:rows], late["ts"]]), kind="stable")
+        for col, _ in COLUMNS:
+            writer[col][pos:rows + keep] = np.concatenate([writer[col][pos:rows], late[col]])[order]
+        seg["rows"] = rows + keep
+        seg["ts_min"] = min(seg["ts_min"], int(late["ts"][0]))
+        return keep
+
+    def append(
+        self,
+        created_at: datetime,
+        tenant_id: int,
+        user_id: int,
+        tokens_used: Optional[int] = None,
+        latency_ms: Optional[int] = None,
+    ) -> None:
+        self.append_many({
+            "ts": np.array([to_epoch_us(created_at)], dtype="<i8"),
+            "tenant_id": np.array([tenant_id], dtype="<i4"),
+            "user_id": np.array([user_id], dtype="<i4"),
+            "tokens": np.array([MISSING if tokens_used is None else tokens_used], dtype="<i4"),
+            "latency": np.array([MISSING if latency_ms is None else latency_ms], dtype="<i4"),
+        })
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._loaded:
+                self._save_manifest()
+
+    def start_flusher(self) -> None:
+        """启动后台刷盘线程：行数达到阈值时立即刷盘，否则每 flush_seconds 检查一次"""
+        if self._flusher is not None or self.flush_seconds <= 0:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._flush_wanted.wait(self.flush_seconds)
+            self._flush_wanted.clear()
+            try:
+                with self._lock:
+                    if self._loaded and self._unflushed:
+                        self._save_manifest()
+            except Exception:
+                logger.exception("列式存储刷盘失败")
+
+    def reset(self) -> None:
+        """清空存储（重建前调用）"""
+        with self._lock:
+            self._writer = None
+            self._readers.clear()
+            self._segments = []
+            self._last_ts = 0
+            self.rejected = 0
+            self._unflushed = 0
+            self._loaded = False
+            if os.path.isdir(self.root):
+                shutil.rmtree(self.root)
+
+    # ---- 读取与分析 ----
+
+    def scan(
+        self,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        tenant_id: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        """返回时间范围 [start, end] 内的列数组（按段 searchsorted 定位，仅拷贝命中部分）"""
+        lo_ts = to_epoch_us(start) if start else None
+        hi_ts = to_epoch_us(end) if end else None
+        parts: Dict[str, List[np.ndarray]] = {col: [] for col, _ in COLUMNS}
+        with self._lock:
+            self._load()
+            segments = list(self._segments)
+            for seg in segments:
+                if not seg["rows"]:
+                    continue
+                if lo_ts is not None and seg["ts_max"] < lo_ts:
+                    continue
+                if hi_ts is not None and seg["ts_min"] > hi_ts:
+                    continue
+                arrays = self._segment_arrays(seg)
+                ts = arrays["ts"]
+                i = int(np.searchsorted(ts, lo_ts, side="left")) if lo_ts is not None else 0
+                j = int(np.searchsorted(ts, hi_ts, side="right")) if hi_ts is not None else len(ts)
+                if i >= j:
+                    continue
+                mask = None
+                if tenant_id is not None:
+                    mask = arrays["tenant_id"][i:j] == tenant_id
+                # 已封存段的行不再变化，无过滤时直接返回映射视图，避免拷贝；
+                # 最后一段可能插入乱序行而整体后移，总是拷贝
+                sealed = seg is not segments[-1]
+                for col, _ in COLUMNS:
+                    chunk = arrays[col][i:j]
+                    if mask is not None:
+                        chunk = chunk[mask]
+                    elif not sealed:
+                        chunk = chunk.copy()
+                    parts[col].append(chunk)
+        return {
+            col: _concat(parts[col], dtype) for col, dtype in COLUMNS
+        }
+
+    def row_count(self) -> int:
+        with self._lock:
+            self._load()
+            return sum(seg["rows"] for seg in self._segments)
+
+
+def _concat(parts: List[np.ndarray], dtype: str) -> np.ndarray:
+    if not parts:
+        return np.empty(0, dtype=dtype)
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts)
+
+
+def _percentiles(values: np.ndarray, qs: Iterable[float]) -> List[float]:
+    """基于计数直方图的精确分位数（与 numpy.percentile 线性插值结果一致，非负整数适用）"""
+    cum = np.cumsum(np.bincount(values))
+    n = int(cum[-1])
+    out = []
+    for q in qs:
+        rank = q / 100 * (n - 1)
+        lo = int(np.floor(rank))
+        hi = min(lo + 1, n - 1)
+        v_lo = int(np.searchsorted(cum, lo, side="right"))
+        v_hi = int(np.searchsorted(cum, hi, side="right"))
+        out.append(v_lo + (v_hi - v_lo) * (rank - lo))
+    return out
+
+
+def analyze(data: Dict[str, np.ndarray], top: int = 10) -> Dict[str, Any]:
+    """对 scan 结果做向量化统计：按天、按用户、延迟分位数"""
+    ts = data["ts"]
+    result: Dict[str, Any] = {"rows": int(len(ts)), "per_day": [], "top_users": [], "latency_ms": None}
+    if not len(ts):
+        return result
+    tokens = np.where(data["tokens"] >= 0, data["tokens"], 0).astype(np.int64)
+
+    days = ts // _US_PER_DAY
+    first_day = int(days[0])  # scan 结果按时间有序
+    offsets = days - first_day
+    day_counts = np.bincount(offsets)
+    day_tokens = np.bincount(offsets, weights=tokens)
+    for i in np.nonzero(day_counts)[0]:
+        day = from_epoch_us((first_day + int(i)) * _US_PER_DAY).date()
+        result["per_day"].append({
+            "date": day.isoformat(),
+            "count": int(day_counts[i]),
+            "tokens": int(day_tokens[i]),
+        })
+
+    user_ids = data["user_id"].astype(np.int64)
+    user_counts = np.bincount(user_ids)
+    user_tokens = np.bincount(user_ids, weights=tokens)
+    nonzero = np.nonzero(user_counts)[0]
+    k = min(top, len(nonzero))
+    if k:
+        best = nonzero[np.argpartition(-user_counts[nonzero], k - 1)[:k]]
+        best = best[np.lexsort((best, -user_counts[best]))]
+        result["top_users"] = [
+            {"user_id": int(u), "count": int(user_counts[u]), "tokens": int(user_tokens[u])} for u in best
+        ]
+
+    latency = data["latency"]
+    latency = latency[latency >= 0]
+    if len(latency):
+        p50, p95, p99 = _percentiles(latency, (50, 95, 99))
+        result["latency_ms"] = {
+            "count": int(len(latency)),
+            "avg": round(float(latency.mean()), 1),
+            "p50": round(float(p50), 1),
+            "p95": round(float(p95), 1),
+            "p99": round(float(p99), 1),
+        }
+    return result
+
+
+def _db_events(db: Session, batch: int) -> Iterator[Tuple[int, int, int, int, int, int]]:
+    q = (
+        db.query(
+            UsageEvent.created_at,
+            UsageEvent.id,
+            UsageEvent.tenant_id,
+            UsageEvent.user_id,
+            UsageEvent.tokens_used,
+            UsageEvent.latency_ms,
+        )
+        .order_by(UsageEvent.created_at.asc(), UsageEvent.id.asc())
+        .yield_per(batch)
+    )
+    for created_at, evt_id, tenant_id, user_id, tokens, latency in q:
+        yield to_epoch_us(created_at), evt_id, tenant_id, user_id, tokens, latency
+
+
+def _archived_events() -> Iterator[Tuple[int, int, int, int, int, int]]:
+    for _, rows in iter_archive_by_day():
+        events = [
+            (
+                to_epoch_us(datetime.fromisoformat(r["created_at"])),
+                r["id"],
+                r["tenant_id"],
+                r["user_id"],
+                r["tokens_used"],
+                r["latency_ms"],
+            )
+            for r in rows
+        ]
+        events.sort()
+        yield from events
+
+
+def _write_batches(store: ColumnarEventStore, events: Iterable[Tuple], batch: int) -> int:
+    total = 0
+    buf: List[Tuple] = []
+
+    def flush_buf() -> int:
+        arr = np.array(
+            [(ts, t, u, MISSING if tok is None else tok, MISSING if lat is None else lat)
+             for ts, _, t, u, tok, lat in buf],
+            dtype=np.int64,
+        ).reshape(-1, 5)
+        return store.append_many({
+            "ts": arr[:, 0],
+            "tenant_id": arr[:, 1].astype("<i4"),
+            "user_id": arr[:, 2].astype("<i4"),
+            "tokens": arr[:, 3].astype("<i4"),
+            "latency": arr[:, 4].astype("<i4"),
+        })
+
+    for evt in events:
+        buf.append(evt)
+        if len(buf) >= batch:
+            total += flush_buf()
+            buf = []
+    if buf:
+        total += flush_buf()
+    return total
+
+
+def ensure_columnar(db: Session) -> None:
+    """启动时检查：存储为空但已有事件（首次启用）时执行一次重建"""
+    if not COLUMNAR_ENABLED:
+        return
+    if event_store.row_count() == 0 and db.query(UsageEvent.id).first():
+        rebuild_from_db(db)
+
+
+def rebuild_from_db(db: Session, store: Optional[ColumnarEventStore] = None, batch: int = 65536) -> Dict[str, int]:
+    """从冷归档与 usage_events 重建列式存储（两路按时间归并，内存占用与单日归档量相关）"""
+    store = store or event_store
+    store.reset()
+
+    def dedup(events):
+        # 清理中断时同一事件可能同时存在于归档与热数据，归并后二者相邻
+        prev = None
+        for evt in events:
+            if prev is not None and evt[:2] == prev[:2]:
+                continue
+            prev = evt
+            yield evt
+
+    merged = heapq.merge(_archived_events(), _db_events(db, batch))
+    rows = _write_batches(store, dedup(merged), batch)
+    store.flush()
+    return {"rows": rows, "segments": len(store._segments)}
+
+
+# 全局存储实例
+event_store = ColumnarEventStore(COLUMNAR_DIR)
@@ -1,16 +1,19 @@
 from __future__ import annotations
 
 import os
-from datetime import datetime, timezone
-from typing import Generator
+from datetime import date, datetime, timezone
+from typing import Generator, Optional
 
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     DateTime,
     Date,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     UniqueConstraint,
     create_engine,
@@ -19,6 +22,8 @@ from sqlalchemy import (
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
 from sqlalchemy import inspect, text
 
+from .storage import engine_options, install_pragmas, storage_profile
+
 
 # SQLite 数据库文件路径（位于项目根目录）
 _project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
@@ -29,10 +34,11 @@ def utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
 
-# SQLAlchemy 基础设施
+# SQLAlchemy 基础设施：连接池与 PRAGMA 按 APP_DB_PROFILE 选择的存储配置设置（见 storage.py）
 engine = create_engine(
-    f"sqlite:///{DB_PATH}", connect_args={"check_same_thread": False}
+    f"sqlite:///{DB_PATH}", connect_args={"check_same_thread": False}, **engine_options(storage_profile)
 )
+install_pragmas(engine, storage_profile)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
@@ -44,6 +50,7 @@ class Tenant(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), unique=True, nullable=False, index=True)
     description = Column(Text, nullable=True)
+    retention_days = Column(Integer, nullable=True)  # 用量事件热数据保留天数，None 表示使用全局默认
     created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
     updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False)
 
@@ -62,23 +69,64 @@ class User(Base):
     phone = Column(String(50), nullable=True)
     is_admin = Column(Boolean, nullable=False, default=False)
     usage_quota = Column(Integer, nullable=True)  # None 表示不限
-    usage_used = Column(Integer, nullable=False, default=0)
     role = Column(String(50), nullable=False, default="user")  # user/hospital_admin/admin
     # 管理扩展字段
     status = Column(String(50), nullable=False, default="active")  # active/disabled
     notes = Column(String(1024), nullable=True)
     daily_quota = Column(Integer, nullable=True)  # None 表示不限
-    daily_used = Column(Integer, nullable=False, default=0)
-    daily_reset_at = Column(Date, nullable=True)
     created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
     updated_at = Column(
         DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False
     )
 
+    __table_args__ = (
+        # 机构维度的列表与活跃用户统计
+        Index("ix_users_organization_status", "organization", "status"),
+        Index("ix_users_tenant_status", "tenant_id", "status"),
+        # 用户列表按 (排序键, id) 游标分页
+        Index("ix_users_created_at", "created_at"),
+        Index("ix_users_tenant_created", "tenant_id", "created_at"),
+        Index("ix_users_tenant_email", "tenant_id", "email"),
+    )
+
     tenant = relationship("Tenant", back_populates="users")
     subscription = relationship(
         "Subscription", back_populates="user", uselist=False, cascade="all, delete-orphan"
     )
+    # 用量计数器单独成表，读取用户时随 JOIN 一并加载
+    counter = relationship(
+        "UserUsageCounter",
+        back_populates="user",
+        uselist=False,
+        cascade="all, delete-orphan",
+        lazy="joined",
+    )
+
+    # 兼容旧字段：计数器从 user_usage_counters 读取
+    @property
+    def usage_used(self) -> int:
+        return self.counter.usage_used if self.counter is not None else 0
+
+    @property
+    def daily_used(self) -> int:
+        return self.counter.daily_used if self.counter is not None else 0
+
+    @property
+    def daily_reset_at(self) -> Optional[date]:
+        return self.counter.daily_reset_at if self.counter is not None else None
+
+
+class UserUsageCounter(Base):
+    """用户用量计数器（高频写入，与 users 宽表分离，避免每次调用重写用户行）"""
+
+    __tablename__ = "user_usage_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    usage_used = Column(Integer, nullable=False, default=0)
+    daily_used = Column(Integer, nullable=False, default=0)
+    daily_reset_at = Column(Date, nullable=True)
+
+    user = relationship("User", back_populates="counter")
 
 
 class Subscription(Base):
@@ -115,10 +163,113 @@ class UsageEvent(Base):
     latency_ms = Column(Integer, nullable=True)
     meta = Column(String(2048), nullable=True)
 
+    __table_args__ = (
+        # 时间窗口过滤与按租户/用户聚合
+        Index("ix_usage_events_created_at", "created_at"),
+        Index("ix_usage_events_tenant_created", "tenant_id", "created_at"),
+        Index("ix_usage_events_user_created", "user_id", "created_at"),
+    )
+
     user = relationship("User")
     tenant = relationship("Tenant")
 
 
+# 用量汇总表：按 (时间桶, 租户, 用户) 增量维护，看板查询不再扫描 usage_events
+class UsageRollupHourly(Base):
+    __tablename__ = "usage_rollups_hourly"
+
+    bucket = Column(DateTime, primary_key=True)  # 小时起点（UTC）
+    tenant_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    event_count = Column(Integer, nullable=False, default=0)
+    tokens_sum = Column(Integer, nullable=False, default=0)
+    latency_sum = Column(Integer, nullable=False, default=0)
+    latency_count = Column(Integer, nullable=False, default=0)  # 有延迟数据的事件数
+
+    __table_args__ = (
+        Index("ix_usage_rollups_hourly_tenant_bucket", "tenant_id", "bucket"),
+        Index("ix_usage_rollups_hourly_user_bucket", "user_id", "bucket"),
+    )
+
+
+class UsageRollupDaily(Base):
+    __tablename__ = "usage_rollups_daily"
+
+    bucket = Column(Date, primary_key=True)  # 日期（UTC）
+    tenant_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    event_count = Column(Integer, nullable=False, default=0)
+    tokens_sum = Column(Integer, nullable=False, default=0)
+    latency_sum = Column(Integer, nullable=False, default=0)
+    latency_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_usage_rollups_daily_tenant_bucket", "tenant_id", "bucket"),
+        Index("ix_usage_rollups_daily_user_bucket", "user_id", "bucket"),
+    )
+
+
+# 活跃用户基数估计：按 (租户, 日期) 保存可合并的 HyperLogLog 寄存器（zlib 压缩）
+class ActiveUserSketch(Base):
+    __tablename__ = "usage_active_user_sketches"
+
+    tenant_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    precision = Column(Integer, nullable=False, default=12)
+    registers = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False)
+
+
+# 会话令牌撤销：早于 revoked_at_ms 签发的该用户令牌全部失效（用户删除后仍保留记录）
+class SessionRevocation(Base):
+    __tablename__ = "session_revocations"
+
+    user_id = Column(Integer, primary_key=True)
+    revoked_at_ms = Column(BigInteger, nullable=False)
+
+
+class UserChange(Base):
+    """用户变更日志：每个（租户, 用户）一行，记录最近一次变更（含用量计数）的全局序号；
+    删除用户或用户迁出该租户后保留为墓碑。由 users / user_usage_counters 上的触发器维护，见 user_changes.py"""
+    __tablename__ = "user_changes"
+
+    tenant_id = Column(Integer, primary_key=True, default=0)  # 0 表示无租户
+    user_id = Column(Integer, primary_key=True)
+    seq = Column(BigInteger, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        Index("ix_user_changes_seq", "seq"),
+        Index("ix_user_changes_tenant_seq", "tenant_id", "seq"),
+    )
+
+
+class DataMigration(Base):
+    """一次性数据迁移的执行标记：每个迁移一行，存在即表示已执行"""
+    __tablename__ = "data_migrations"
+
+    name = Column(String(100), primary_key=True)
+    applied_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class OrganizationStats(Base):
+    """机构统计（物化）：按 (租户, 机构) 汇总用户数、活跃用户数、总用量与事件数，
+    由 users / user_usage_counters / usage_rollups_daily 上的触发器增量维护，见 org_stats.py"""
+    __tablename__ = "organization_stats"
+
+    tenant_id = Column(Integer, primary_key=True)
+    organization = Column(String(255), primary_key=True)  # 未填写机构的用户记为空字符串
+    user_count = Column(Integer, nullable=False, default=0)
+    active_users = Column(Integer, nullable=False, default=0)
+    total_usage = Column(Integer, nullable=False, default=0)
+    event_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), nullable=True)  # 首个用户加入时间
+
+    __table_args__ = (
+        Index("ix_organization_stats_organization", "organization"),
+    )
+
+
 def get_db() -> Generator[Session, None, None]:
     db = SessionLocal()
     try:
@@ -138,6 +289,10 @@ def run_simple_migrations() -> None:
         # tenants
         if "tenants" not in tables:
             Base.metadata.tables["tenants"].create(bind=engine)
+        else:
+            existing_cols = {col["name"] for col in inspector.get_columns("tenants")}
+            if "retention_days" not in existing_cols:
+                conn.execute(text("ALTER TABLE tenants ADD COLUMN retention_days INTEGER"))
         # users
         if "users" in tables:
             existing_cols = {col["name"] for col in inspector.get_columns("users")}
@@ -154,22 +309,28 @@ def run_simple_migrations() -> None:
                 conn.execute(text("ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT 0 NOT NULL"))
             if "usage_quota" not in existing_cols:
                 conn.execute(text("ALTER TABLE users ADD COLUMN usage_quota INTEGER"))
-            if "usage_used" not in existing_cols:
-                conn.execute(text("ALTER TABLE users ADD COLUMN usage_used INTEGER DEFAULT 0 NOT NULL"))
             if "status" not in existing_cols:
                 conn.execute(text("ALTER TABLE users ADD COLUMN status VARCHAR(50) DEFAULT 'active' NOT NULL"))
             if "notes" not in existing_cols:
                 conn.execute(text("ALTER TABLE users ADD COLUMN notes VARCHAR(1024)"))
             if "daily_quota" not in existing_cols:
                 conn.execute(text("ALTER TABLE users ADD COLUMN daily_quota INTEGER"))
-            if "daily_used" not in existing_cols:
-                conn.execute(text("ALTER TABLE users ADD COLUMN daily_used INTEGER DEFAULT 0 NOT NULL"))
-            if "daily_reset_at" not in existing_cols:
-                conn.execute(text("ALTER TABLE users ADD COLUMN daily_reset_at DATE"))
             if "role" not in existing_cols:
                 conn.execute(text("ALTER TABLE users ADD COLUMN role VARCHAR(50) DEFAULT 'user' NOT NULL"))
         else:
             Base.metadata.tables["users"].create(bind=engine)
+            existing_cols = set()
+        # user_usage_counters：旧库的计数器在 users 表上，首次迁移时拷贝过来
+        if "user_usage_counters" not in tables:
+            Base.metadata.tables["user_usage_counters"].create(bind=engine)
+        legacy_cols = [c for c in ("usage_used", "daily_used", "daily_reset_at") if c in existing_cols]
+        if legacy_cols:
+            has_counters = conn.execute(text("SELECT 1 FROM user_usage_counters LIMIT 1")).first()
+            if not has_counters:
+                cols = ", ".join(legacy_cols)
+                conn.execute(text(
+                    f"INSERT OR IGNORE INTO user_usage_counters (user_id, {cols}) SELECT id, {cols} FROM users"
+                ))
         # subscriptions
         if "subscriptions" in tables:
             existing_cols = {col["name"] for col in inspector.get_columns("subscriptions")}
@@ -184,5 +345,26 @@ def run_simple_migrations() -> None:
                 conn.execute(text("ALTER TABLE usage_events ADD COLUMN tenant_id INTEGER REFERENCES tenants(id) DEFAULT 1 NOT NULL"))
         else:
             Base.metadata.tables["usage_events"].create(bind=engine)
+        # usage rollups
+        for name in ("usage_rollups_hourly", "usage_rollups_daily"):
+            if name not in tables:
+                Base.metadata.tables[name].create(bind=engine)
+        if "usage_active_user_sketches" not in tables:
+            Base.metadata.tables["usage_active_user_sketches"].create(bind=engine)
+        if "session_revocations" not in tables:
+            Base.metadata.tables["session_revocations"].create(bind=engine)
+        if "user_changes" not in tables:
+            Base.metadata.tables["user_changes"].create(bind=engine)
+        if "organization_stats" not in tables:
+            Base.metadata.tables["organization_stats"].create(bind=engine)
+        if "data_migrations" not in tables:
+            Base.metadata.tables["data_migrations"].create(bind=engine)
+        # 索引：旧库补建模型中声明的复合索引
+        for name in ("users", "usage_events", "usage_rollups_hourly", "usage_rollups_daily"):
+            for index in Base.metadata.tables[name].indexes:
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {index.name} ON {name} "
+                    f"({', '.join(col.name for col in index.columns)})"
+                ))
 
 
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal, UsageEvent, User, UserUsageCounter
+from .rollups import to_naive_utc
+
+
+# -----------------------------
+# 流式导出（CSV / NDJSON，可选 gzip）
+# -----------------------------
+# 按批从游标读取（yield_per），逐行写入缓冲区，攒满 FLUSH_BYTES 后交给 StreamingResponse，
+# 内存占用与表大小无关。响应开始后请求级 Session 已关闭，因此生成器内自行打开 Session。
+
+BATCH_ROWS = 1000
+FLUSH_BYTES = 64 * 1024
+
+USER_EXPORT_COLUMNS = [
+    "id",
+    "email",
+    "name",
+    "organization",
+    "phone",
+    "is_admin",
+    "status",
+    "usage_quota",
+    "usage_used",
+    "daily_quota",
+    "daily_used",
+]
+
+USAGE_EXPORT_COLUMNS = [
+    "id",
+    "tenant_id",
+    "user_id",
+    "event_type",
+    "created_at",
+    "tokens_used",
+    "latency_ms",
+    "meta",
+]
+
+
+def _user_rows(db: Session, tenant_id: Optional[int]) -> Iterator[Sequence[Any]]:
+    counter = UserUsageCounter.__table__.c
+    stmt = (
+        select(
+            User.id,
+            User.email,
+            User.name,
+            User.organization,
+            User.phone,
+            User.is_admin,
+            User.status,
+            User.usage_quota,
+            counter.usage_used,
+            User.daily_quota,
+            counter.daily_used,
+        )
+        .outerjoin(UserUsageCounter.__table__, counter.user_id == User.id)
+        .order_by(User.id.asc())
+    )
+    if tenant_id is not None:
+        stmt = stmt.where(User.tenant_id == tenant_id)
+    for row in db.execute(stmt.execution_options(yield_per=BATCH_ROWS)):
+        values = list(row)
+        values[5] = 1 if values[5] else 0
+        values[8] = values[8] or 0
+        values[10] = values[10] or 0
+        yield values
+
+
+def _usage_rows(
+    db: Session,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    tenant_id: Optional[int],
+    user_id: Optional[int],
+) -> Iterator[Sequence[Any]]:
+    stmt = select(*(getattr(UsageEvent, c) for c in USAGE_EXPORT_COLUMNS)).order_by(
+        UsageEvent.created_at.asc(), UsageEvent.id.asc()
+    )
+    if start is not None:
+        stmt = stmt.where(UsageEvent.created_at >= to_naive_utc(start))
+    if end is not None:
+        stmt = stmt.where(UsageEvent.created_at <= to_naive_utc(end))
+    if tenant_id is not None:
+        stmt = stmt.where(UsageEvent.tenant_id == tenant_id)
+    if user_id is not None:
+        stmt = stmt.where(UsageEvent.user_id == user_id)
+    yield from db.execute(stmt.execution_options(yield_per=BATCH_ROWS))
+
+
+def _format(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(columns: List[str], rows: Iterable[Sequence[Any]]) -> Iterator[bytes]:
+    """与导入格式一致：分号分隔、\\n 换行、空值写为空串"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=";", lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(["" if v is None else _format(v) for v in row])
+        if buf.tell() >= FLUSH_BYTES:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def ndjson_chunks(columns: List[str], rows: Iterable[Sequence[Any]]) -> Iterator[bytes]:
+    parts: List[str] = []
+    size = 0
+    for row in rows:
+        line = json.dumps({c: _format(v) for c, v in zip(columns, row)}, ensure_ascii=False)
+        parts.append(line)
+        size += len(line) + 1
+        if size >= FLUSH_BYTES:
+            yield ("\n".join(parts) + "\n").encode("utf-8")
+            parts, size = [], 0
+    if parts:
+        yield ("\n".join(parts) + "\n").encode("utf-8")
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31：gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(
+    rows_fn: Callable[[Session], Iterable[Sequence[Any]]],
+    columns: List[str],
+    fmt: str = "csv",
+    gzip: bool = False,
+) -> Iterator[bytes]:
+    """在独立 Session 中执行查询并逐块产出编码后的内容"""
+    def generate() -> Iterator[bytes]:
+        db = SessionLocal()
+        try:
+            rows = rows_fn(db)
+            yield from (ndjson_chunks if fmt == "ndjson" else csv_chunks)(columns, rows)
+        finally:
+            db.close()
+
+    return gzip_chunks(generate()) if gzip else generate()
+
+
+def export_users(tenant_id: Optional[int] = None, fmt: str = "csv", gzip: bool = False) -> Iterator[bytes]:
+    return stream_export(lambda db: _user_rows(db, tenant_id), USER_EXPORT_COLUMNS, fmt, gzip)
+
+
+def export_usage_events(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    tenant_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    fmt: str = "csv",
+    gzip: bool = False,
+) -> Iterator[bytes]:
+    return stream_export(
+        lambda db: _usage_rows(db, start, end, tenant_id, user_id), USAGE_EXPORT_COLUMNS, fmt, gzip
+    )
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .db import UsageRollupHourly, utcnow
+from .rollups import hour_bucket
+from .sketches import SpaceSaving
+
+
+# -----------------------------
+# 用量排行（流式 Top-K）
+# -----------------------------
+# 每个租户（以及全局）按小时维护一个 Space-Saving summary，事件到达时只更新当前小时。
+# 查询最近 N 小时的排行时合并对应的小时 summary，返回计数上界与误差，
+# 不再对 usage_events / 汇总表做全量 GROUP BY + 排序。进程重启后由小时汇总表预热。
+
+CAPACITY = int(os.getenv("USAGE_TOPK_CAPACITY", "256"))
+MAX_WINDOW_HOURS = 7 * 24
+
+_ALL = "*"  # 全局 summary 的键
+
+
+def parse_window(window: str) -> int:
+    """解析窗口参数（如 1h / 24h / 7d），返回小时数"""
+    value = (window or "").strip().lower()
+    try:
+        if value.endswith("h"):
+            hours = int(value[:-1])
+        elif value.endswith("d"):
+            hours = int(value[:-1]) * 24
+        else:
+            hours = int(value)
+    except ValueError:
+        raise ValueError("窗口格式应为 <小时数>h 或 <天数>d")
+    if not 1 <= hours <= MAX_WINDOW_HOURS:
+        raise ValueError(f"窗口需在 1h~{MAX_WINDOW_HOURS // 24}d 之间")
+    return hours
+
+
+class HeavyHitters:
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # (租户或 "*", 小时桶) -> summary
+        self._hours: Dict[Tuple[Any, datetime], SpaceSaving] = {}
+        self._current: Optional[datetime] = None
+
+    def _summary(self, scope: Any, bucket: datetime) -> SpaceSaving:
+        key = (scope, bucket)
+        summary = self._hours.get(key)
+        if summary is None:
+            summary = self._hours[key] = SpaceSaving(self.capacity)
+        return summary
+
+    def _evict(self, now: datetime) -> None:
+        horizon = hour_bucket(now) - timedelta(hours=MAX_WINDOW_HOURS)
+        for key in [k for k in self._hours if k[1] <= horizon]:
+            del self._hours[key]
+
+    def observe(self, tenant_id: int, user_id: int, when: Optional[datetime] = None, weight: int = 1) -> None:
+        bucket = hour_bucket(when or utcnow())
+        with self._lock:
+            if self._current is None or bucket > self._current:
+                # 进入新的小时：淘汰窗口之外的 summary
+                self._current = bucket
+                self._evict(bucket)
+            self._summary(tenant_id, bucket).add(user_id, weight)
+            self._summary(_ALL, bucket).add(user_id, weight)
+
+    def top(
+        self, k: int, hours: int, tenant_id: Optional[int] = None, now: Optional[datetime] = None
+    ) -> Dict[str, Any]:
+        """最近 hours 个小时桶（含当前小时）内用量最高的 k 个用户"""
+        current = hour_bucket(now or utcnow())
+        scope = _ALL if tenant_id is None else tenant_id
+        with self._lock:
+            summaries = [
+                self._hours[(scope, current - timedelta(hours=i))]
+                for i in range(hours)
+                if (scope, current - timedelta(hours=i)) in self._hours
+            ]
+            ranked = SpaceSaving.merge_top(summaries, k)
+            total = sum(s.total for s in summaries)
+        items: List[Dict[str, Any]] = [
+            {"user_id": uid, "count": upper, "error": err, "guaranteed": upper - err}
+            for uid, upper, err in ranked
+        ]
+        return {
+            "items": items,
+            "total_events": total,
+            "max_error": max((i["error"] for i in items), default=0),
+            "window_start": (current - timedelta(hours=hours - 1)).isoformat(),
+        }
+
+    def warm(self, db: Session, now: Optional[datetime] = None) -> int:
+        """用小时汇总表重建最近 MAX_WINDOW_HOURS 小时的 summary"""
+        current = hour_bucket(now or utcnow())
+        since = current - timedelta(hours=MAX_WINDOW_HOURS - 1)
+        rows = (
+            db.query(
+                UsageRollupHourly.bucket,
+                UsageRollupHourly.tenant_id,
+                UsageRollupHourly.user_id,
+                UsageRollupHourly.event_count,
+            )
+            .filter(UsageRollupHourly.bucket >= since)
+            .all()
+        )
+        with self._lock:
+            self._hours.clear()
+            self._current = current
+            for bucket, tenant_id, user_id, count in rows:
+                self._summary(tenant_id, bucket).add(user_id, count)
+                self._summary(_ALL, bucket).add(user_id, count)
+        return len(rows)
+
+
+# 全局实例
+heavy_hitters = HeavyHitters()
@@ -1,20 +1,70 @@
 from typing import List, Optional, Dict, Any, Iterator
-from datetime import date
+from datetime import date, datetime, timedelta
 
 import os
+import ipaddress
 import json
+import logging
+import time
 import requests
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, RedirectResponse
+from fastapi.responses import JSONResponse, StreamingResponse, RedirectResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field, EmailStr
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
 
-from .db import Base, engine, get_db, User, Subscription, UsageEvent, run_simple_migrations
+from .db import Base, SessionLocal, engine, get_db, Tenant, User, Subscription, UsageEvent, run_simple_migrations
+from .usage import get_counter, quota_headers, quota_status, record_generate, reset_usage
+from .rollups import aggregate_usage, backfill_rollups, ensure_rollups, hour_bucket
+from .columnar import analyze, ensure_columnar, event_store, rebuild_from_db
+from .active_users import active_users
+from .tenants import (
+    DEFAULT_TENANT_ID,
+    MigrationApplied,
+    backfill_user_tenants,
+    ensure_default_tenant,
+    move_usage_history,
+    tenant_directory,
+)
+from .org_stats import (
+    ensure_org_stats,
+    list_organizations,
+    organization_totals,
+    reconcile_org_stats,
+    start_org_stats_worker,
+    tenant_totals,
+)
+from .heavy_hitters import heavy_hitters, parse_window
+from .timeseries import usage_timeseries
+from .passwords import password_hasher
+from .principals import Principal, principal_cache
+from .pagination import MAX_PAGE_SIZE, keyset_page, paginate_users, projected_user_query, user_counts
+from .serialization import fast_response, parse_fields, user_dicts, user_query
+from .versions import change_versions, etag_matches
+from .change_feed import change_feed, stream_tickets
+from .user_changes import changes_since, current_version, ensure_change_log
+from .user_search import ensure_user_search, rebuild_user_search, search_users, user_search_filter
+from .user_import import import_users_csv
+from .bulk_users import BULK_OPS, MAX_BULK_IDS, bulk_conditions, run_bulk
+from .exports import export_usage_events, export_users
+from .tokens import (
+    ALLOW_LEGACY_USER_HEADER,
+    InvalidToken,
+    bearer_token,
+    issue_token,
+    revocations,
+    verify_token,
+    warn_legacy_header,
+    warn_missing_secret,
+)
+from .retention import DEFAULT_RETENTION_DAYS, iter_archive_by_day, query_events, run_retention, start_retention_worker
 from .config import upstream_config
-from sqlalchemy import func
+from .storage import checkpoint, storage_profile, verify as verify_storage
+from sqlalchemy import false, func, inspect, select
+
+logger = logging.getLogger(__name__)
 
 
 # 使用配置管理系统获取上游服务URL和模型
@@ -88,7 +138,9 @@ def root() -> RedirectResponse:
 @app.post("/api/generate")
 def proxy_generate(
     req: GenerateRequest,
+    response: Response,
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     payload: Dict[str, Any] = req.model_dump()
@@ -101,74 +153,92 @@ def proxy_generate(
     if user_prompt:
         payload["prompt"] = f"[系统]\n{SYSTEM_PROMPT}\n\n[用户]\n{user_prompt}\n\n[助手]"
 
-    # 用量限制（可选，由管理员为用户设置 usage_quota）
-    if x_user_id is not None:
-        user = db.query(User).filter(User.id == x_user_id).first()
+    # 调用方身份：会话令牌优先，显式开启时接受普通用户的裸 X-User-Id（已弃用）
+    token = bearer_token(authorization)
+    if token:
+        x_user_id = principal_from_token(token).id
+        user = principal_cache.get(db, x_user_id)
         if not user:
             raise HTTPException(status_code=404, detail="用户未找到")
+    elif x_user_id is not None:
+        user = legacy_principal(db, x_user_id)
+
+    # 用量限制（可选，由管理员为用户设置 usage_quota）
+    remaining_headers: Dict[str, str] = {}
+    if x_user_id is not None:
         if user.status != "active":
             raise HTTPException(status_code=403, detail="用户已禁用")
-        # 日配额重置：每日首次请求时
-        from datetime import date
-        today = date.today()
-        if user.daily_reset_at != today:
-            user.daily_reset_at = today
-            user.daily_used = 0
-            db.add(user)
-            db.commit()
-        if user.usage_quota is not None and user.usage_used >= user.usage_quota:
-            raise HTTPException(status_code=429, detail="已达到总配额上限; 请联系商务电话: 18959650938,陈先生")
-        if user.daily_quota is not None and user.daily_used >= user.daily_quota:
-            raise HTTPException(status_code=429, detail="已达到日配额上限; 请联系商务电话: 18959650938,陈先生")
+        # 日配额按自然日计算：跨天后的首次调用由计数器写入路径清零
+        counter = get_counter(db, user.id)
+        status = quota_status(user.usage_quota, user.daily_quota, counter)
+        if status["usage_remaining"] == 0:
+            change_feed.publish("quota", {"user_id": user.id, "kind": "total", "quota": user.usage_quota}, user.tenant_id, user.id)
+            raise HTTPException(status_code=429, detail="已达到总配额上限; 请联系商务电话: 18959650938,陈先生", headers=quota_headers(status))
+        if status["daily_remaining"] == 0:
+            change_feed.publish("quota", {"user_id": user.id, "kind": "daily", "quota": user.daily_quota}, user.tenant_id, user.id)
+            raise HTTPException(status_code=429, detail="已达到日配额上限; 请联系商务电话: 18959650938,陈先生", headers=quota_headers(status))
+        # 本次调用计入后的剩余额度，随响应头返回，客户端无需再查询用量
+        remaining_headers = quota_headers(quota_status(user.usage_quota, user.daily_quota, counter, pending=1))
+        response.headers.update(remaining_headers)
 
     # 直连上游
+    tenant_id = user.tenant_id if x_user_id is not None else None
+    current_upstream = upstream_config.get_current_upstream()
     if req.stream:
-        resp = StreamingResponse(_stream_generate(payload), media_type="text/event-stream")
+        resp = StreamingResponse(_stream_generate(payload), media_type="text/event-stream", headers=remaining_headers)
         # 流式响应暂不精确计数，按1次计
+        usage_timeseries.record(tenant_id=tenant_id, upstream=current_upstream)
         if x_user_id is not None:
-            user.usage_used += 1
-            user.daily_used += 1
-            db.add(user)
-            db.commit()
-            try:
-                evt = UsageEvent(user_id=user.id, tenant_id=user.tenant_id, event_type="generate", tokens_used=None, latency_ms=None, meta=json.dumps({"stream": True}))
-                db.add(evt)
-                db.commit()
-            except Exception:
-                db.rollback()
+            record_generate(db, user.id, user.tenant_id, stream=True)
         return resp
 
     # 动态获取当前上游服务URL
-    current_upstream = upstream_config.get_current_upstream()
     url = f"{current_upstream}/api/generate"
+    began = time.perf_counter()
     try:
         r = requests.post(url, headers=_upstream_headers(), json=payload, timeout=120)
     except requests.RequestException as e:
+        usage_timeseries.record(tenant_id=tenant_id, upstream=current_upstream, error=True)
         raise HTTPException(status_code=502, detail=str(e))
+    latency_ms = int((time.perf_counter() - began) * 1000)
 
     if r.status_code != 200:
+        usage_timeseries.record(tenant_id=tenant_id, upstream=current_upstream, error=True, latency_ms=latency_ms)
         raise HTTPException(status_code=r.status_code, detail=r.text)
 
     try:
         data = r.json()
-        if x_user_id is not None:
-            user.usage_used += 1
-            user.daily_used += 1
-            db.add(user)
-            db.commit()
-            try:
-                latency_ms = None
-                evt = UsageEvent(user_id=user.id, tenant_id=user.tenant_id, event_type="generate", tokens_used=None, latency_ms=latency_ms, meta=json.dumps({"stream": False}))
-                db.add(evt)
-                db.commit()
-            except Exception:
-                db.rollback()
-        return data
     except json.JSONDecodeError:
         # 上游非JSON时回传原文
+        usage_timeseries.record(tenant_id=tenant_id, upstream=current_upstream, latency_ms=latency_ms)
         return {"response": r.text}
-# 管理员简单鉴权（演示用）：通过请求头 X-Admin-Token 与环境变量 ADMIN_TOKEN 比对
-def require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
+    tokens_used = _upstream_tokens(data)
+    usage_timeseries.record(tenant_id=tenant_id, upstream=current_upstream, tokens=tokens_used, latency_ms=latency_ms)
+    if x_user_id is not None:
+        record_generate(db, user.id, user.tenant_id, stream=False, tokens_used=tokens_used, latency_ms=latency_ms)
+    return data
+
+
+def _upstream_tokens(data: Any) -> Optional[int]:
+    """从上游响应中取 token 数（Ollama 格式：prompt_eval_count + eval_count）"""
+    if not isinstance(data, dict):
+        return None
+    counts = [data.get(k) for k in ("prompt_eval_count", "eval_count")]
+    counts = [c for c in counts if isinstance(c, int)]
+    return sum(counts) if counts else None
+
+
+# 管理员鉴权：请求头 X-Admin-Token 与环境变量 ADMIN_TOKEN 比对，或系统管理员的会话令牌
+def require_admin(
+    x_admin_token: Optional[str] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
+) -> None:
+    token = bearer_token(authorization)
+    if token and not x_admin_token:
+        principal = principal_from_token(token)
+        if principal.role != "admin" and not principal.is_admin:
+            raise HTTPException(status_code=403, detail="需要系统管理员权限")
+        return
     expected = os.getenv("ADMIN_TOKEN")
     if not expected:
         # 未设置 ADMIN_TOKEN 时，默认拒绝
@@ -179,47 +249,69 @@ def require_admin(x_admin_token: Optional[str] = Header(default=None)) -> None:
 
 # 多租户权限控制：获取当前用户并验证权限
 
+def principal_from_token(token: str) -> Principal:
+    try:
+        return verify_token(token)
+    except InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+
+def legacy_principal(db: Session, x_user_id: int) -> Principal:
+    """已弃用的裸 X-User-Id：需 ALLOW_LEGACY_USER_HEADER=1，且只能代表普通用户，管理员必须使用会话令牌"""
+    if not ALLOW_LEGACY_USER_HEADER:
+        raise HTTPException(status_code=401, detail="请使用会话令牌登录")
+    user = principal_cache.get(db, x_user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    if user.role != "user" or user.is_admin:
+        raise HTTPException(status_code=401, detail="管理员请使用会话令牌登录")
+    warn_legacy_header()
+    return user
+
+
 def get_current_user(
     x_user_id: Optional[int] = Header(default=None),
-    db: Session = Depends(get_db)
-) -> User:
-    """获取当前登录用户"""
+    db: Session = Depends(get_db),
+    authorization: Optional[str] = Header(default=None),
+) -> Principal:
+    """获取当前登录用户：优先校验会话令牌（不访问数据库），显式开启时接受普通用户的 X-User-Id（走 principal 缓存）"""
+    token = bearer_token(authorization)
+    if token:
+        return principal_from_token(token)
     if x_user_id is None:
         raise HTTPException(status_code=401, detail="用户未登录")
-    user = db.query(User).filter(User.id == x_user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="用户不存在")
+    user = legacy_principal(db, x_user_id)
     if user.status != "active":
         raise HTTPException(status_code=403, detail="账户已被禁用")
     return user
 
 # 权限依赖
-def require_system_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_system_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """要求系统管理员权限（全局最高权限）"""
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="需要系统管理员权限")
     return current_user
 
-def require_hospital_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_hospital_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """要求医院管理员权限（仅本租户）"""
     if current_user.role != "hospital_admin":
         raise HTTPException(status_code=403, detail="需要医院管理员权限")
     return current_user
 
-def require_regular_user(current_user: User = Depends(get_current_user)) -> User:
+def require_regular_user(current_user: Principal = Depends(get_current_user)) -> Principal:
     """要求普通用户权限"""
     if current_user.role != "user":
         raise HTTPException(status_code=403, detail="需要普通用户权限")
     return current_user
 
-def require_hospital_admin_or_system_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_hospital_admin_or_system_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """要求医院管理员或系统管理员权限"""
     if current_user.role not in ("admin", "hospital_admin"):
         raise HTTPException(status_code=403, detail="需要管理员权限")
     return current_user
 
 # 租户隔离依赖
-def get_tenant_id(current_user: User = Depends(get_current_user)) -> int:
+def get_tenant_id(current_user: Principal = Depends(get_current_user)) -> int:
     """获取当前用户所属租户ID"""
     return current_user.tenant_id
 
@@ -228,21 +320,29 @@ def tenant_data_filter(query, tenant_id: int, model_cls):
     return query.filter(model_cls.tenant_id == tenant_id)
 
 
-def require_system_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_system_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """要求系统管理员权限"""
     if not current_user.is_admin or current_user.role != "admin":
         raise HTTPException(status_code=403, detail="需要系统管理员权限")
     return current_user
 
 
-def require_hospital_admin_or_system_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_hospital_admin_or_system_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """要求医院管理员或系统管理员权限"""
     if not (current_user.is_admin or current_user.role == "hospital_admin"):
         raise HTTPException(status_code=403, detail="需要管理员权限")
     return current_user
 
 
-def get_organization_filter(current_user: User, organization: Optional[str] = None) -> str:
+def existing_tenant(db: Session, organization: Optional[str]) -> int:
+    """机构对应的已有租户ID；不自动创建租户，机构不存在时返回 400"""
+    tenant_id = tenant_directory.resolve(db, organization)
+    if tenant_id is None:
+        raise HTTPException(status_code=400, detail=f"机构不存在: {organization}，请先创建机构租户")
+    return tenant_id
+
+
+def get_organization_filter(current_user: Principal, organization: Optional[str] = None) -> str:
     """根据用户权限获取机构过滤条件（兼容老逻辑，建议新代码用tenant_id隔离）"""
     if current_user.role == "admin":
         return organization if organization else None
@@ -256,9 +356,6 @@ def get_organization_filter(current_user: User, organization: Optional[str] = No
 # 用户与订阅：Schemas 与 Endpoints
 # -----------------------------
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
-
-
 class UserRegisterRequest(BaseModel):
     name: str = Field(min_length=1, max_length=100)
     organization: str = Field(min_length=1, max_length=255)
@@ -291,6 +388,12 @@ class UserResponse(BaseModel):
         from_attributes = True
 
 
+class LoginResponse(UserResponse):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int
+
+
 class SubscriptionUpsertRequest(BaseModel):
     plan: str = Field(default="free")
     status: str = Field(default="active")
@@ -308,20 +411,80 @@ class SubscriptionResponse(BaseModel):
         from_attributes = True
 
 
-def hash_password(raw: str) -> str:
-    return pwd_context.hash(raw)
+# 受信任的反向代理（逗号分隔的IP或网段，如 nginx 所在地址）；为空时不采用任何转发头
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(p.strip(), strict=False) for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()
+]
+
+
+def _trusted_proxy(host: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(addr in net for net in TRUSTED_PROXIES)
+
+
+def client_ip(request: Request) -> Optional[str]:
+    """客户端IP：直连地址是受信任代理时取其传入的 X-Real-IP，否则取直连地址（请求头可被客户端伪造）"""
+    peer = request.client.host if request.client else None
+    real_ip = request.headers.get("x-real-ip")
+    if real_ip and peer and _trusted_proxy(peer):
+        return real_ip.strip()
+    return peer
+
+
+def hash_password(raw: str, request: Optional[Request] = None) -> str:
+    """在密码哈希进程池中计算哈希；传入 request 时按客户端IP限制并发"""
+    return password_hasher.hash(raw, client=client_ip(request) if request else None)
+
+
+def verify_password(raw: str, hashed: str, request: Optional[Request] = None) -> bool:
+    return password_hasher.verify(raw, hashed, client=client_ip(request) if request else None)
 
 
 @app.on_event("startup")
 def on_startup() -> None:
+    # 核对 SQLite 存储配置已在连接上生效
+    pragmas = verify_storage(engine, storage_profile)
+    logger.info("SQLite 存储配置 %s: %s", storage_profile.name, ", ".join(f"{k}={v}" for k, v in pragmas.items()))
+    warn_missing_secret()
     # 初始化表
     Base.metadata.create_all(bind=engine)
     # 运行简单迁移（为已有 users 表添加新增列）
     run_simple_migrations()
+    # 旧库升级：用历史事件回填用量汇总表
+    db = SessionLocal()
+    try:
+        ensure_rollups(db, iter_archive_by_day())
+        ensure_columnar(db)
+        ensure_user_search(db)
+        ensure_change_log(db)
+        ensure_default_tenant(db)
+        ensure_org_stats(db)
+        active_users.ensure(db)
+        heavy_hitters.warm(db)
+    finally:
+        db.close()
+    # 用量事件保留策略：定期归档并清理过期事件
+    start_retention_worker()
+    # 机构统计：定期按原始数据重算修正
+    start_org_stats_worker()
+    # 列式存储：后台批量刷盘，请求路径只写入映射页
+    event_store.start_flusher()
+
+
+@app.on_event("shutdown")
+def on_shutdown() -> None:
+    # 持久化列式存储的写入进度
+    event_store.flush()
+    active_users.maybe_flush(force=True)
+    password_hasher.shutdown()
+    checkpoint(engine, storage_profile)
 
 
 @app.post("/api/users/register", response_model=UserResponse)
-def register_user(req: UserRegisterRequest, db: Session = Depends(get_db)):
+def register_user(req: UserRegisterRequest, request: Request, db: Session = Depends(get_db)):
     # 唯一性检查
     exists = db.query(User).filter(User.email == req.email).first()
     if exists:
@@ -329,26 +492,30 @@ def register_user(req: UserRegisterRequest, db: Session = Depends(get_db)):
 
     user = User(
         email=req.email,
-        password_hash=hash_password(req.password),
+        password_hash=hash_password(req.password, request),
         name=req.name,
         organization=req.organization,
         phone=req.phone,
         usage_quota=6,  # 新注册用户默认配额为6
+        # 租户跟随机构；机构尚未建立租户时归入默认租户，由系统管理员调整
+        tenant_id=tenant_directory.resolve(db, req.organization) or DEFAULT_TENANT_ID,
     )
     db.add(user)
     db.commit()
+    user_counts.invalidate()
+    _user_changed("created", user.id, user.tenant_id, user)
     db.refresh(user)
 
     # 默认创建订阅记录
-    sub = Subscription(user_id=user.id, plan="free", status="active", auto_renew=True)
+    sub = Subscription(user_id=user.id, tenant_id=user.tenant_id, plan="free", status="active", auto_renew=True)
     db.add(sub)
     db.commit()
 
     return user
 
 
-@app.post("/api/users/login", response_model=UserResponse)
-def login_user(req: UserLoginRequest, db: Session = Depends(get_db)):
+@app.post("/api/users/login", response_model=LoginResponse)
+def login_user(req: UserLoginRequest, request: Request, db: Session = Depends(get_db)):
     """
     用户登录API - 安全验证用户身份
     """
@@ -358,15 +525,16 @@ def login_user(req: UserLoginRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=401, detail="邮箱或密码错误")
     
     # 验证密码
-    if not pwd_context.verify(req.password, user.password_hash):
+    if not verify_password(req.password, user.password_hash, request):
         raise HTTPException(status_code=401, detail="邮箱或密码错误")
     
     # 检查用户状态（如果有状态字段的话）
     if hasattr(user, 'status') and user.status == 'disabled':
         raise HTTPException(status_code=403, detail="账户已被禁用")
     
-    # 返回用户信息（不包含敏感信息）
-    return UserResponse(
+    # 返回用户信息（不包含敏感信息）与会话令牌
+    return LoginResponse(
+        **issue_token(user),
         id=user.id,
         email=user.email,
         name=user.name,
@@ -383,6 +551,98 @@ def login_user(req: UserLoginRequest, db: Session = Depends(get_db)):
     )
 
 
+@app.get("/api/users/me", response_model=UserResponse)
+def get_me(
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """当前登录用户信息（含用量）"""
+    user = db.query(User).filter(User.id == current_user.id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    return user
+
+
+@app.get("/api/me/usage")
+def get_my_usage(
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """当前用户的用量与剩余配额：配额取自 principal 缓存，计数器按主键读取窄表，不查询 users"""
+    principal = principal_cache.get(db, current_user.id)
+    if not principal:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    status = quota_status(principal.usage_quota, principal.daily_quota, get_counter(db, principal.id))
+    return JSONResponse({"user_id": principal.id, **status}, headers=quota_headers(status))
+
+
+@app.post("/api/users/logout")
+def logout_user(
+    current_user: Principal = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """退出登录：使该用户此前签发的全部会话令牌失效"""
+    revocations.revoke(db, current_user.id)
+    db.commit()
+    return {"message": "已退出登录"}
+
+
+def _stream_scope(principal: Principal):
+    """推送范围 (租户ID, 用户ID)：系统管理员不限，医院管理员为本租户，普通用户只收自己的事件"""
+    if principal.role == "admin" or principal.is_admin:
+        return None, None
+    if principal.role == "hospital_admin":
+        return principal.tenant_id, None
+    return principal.tenant_id, principal.id
+
+
+@app.post("/api/events/ticket")
+def change_events_ticket(
+    x_admin_token: Optional[str] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
+):
+    """换取建立变更推送连接用的一次性票据（有效期 CHANGE_FEED_TICKET_TTL 秒），令牌只经请求头传递"""
+    if x_admin_token:
+        expected = os.getenv("ADMIN_TOKEN")
+        if not expected or x_admin_token != expected:
+            raise HTTPException(status_code=403, detail="管理员令牌无效")
+        tenant_id = user_id = None
+    else:
+        token = bearer_token(authorization)
+        if not token:
+            raise HTTPException(status_code=401, detail="用户未登录")
+        tenant_id, user_id = _stream_scope(principal_from_token(token))
+    return {"ticket": stream_tickets.issue(tenant_id, user_id), "expires_in": int(stream_tickets.ttl)}
+
+
+@app.get("/api/events/stream")
+async def change_events(
+    ticket: Optional[str] = None,
+    authorization: Optional[str] = Header(default=None),
+    last_event_id: Optional[str] = Header(default=None),
+):
+    """变更推送（SSE）：系统管理员收全部事件，医院管理员收本租户事件，普通用户只收自己的用量与配额事件。
+    EventSource 无法设置请求头，先通过 POST /api/events/ticket 换取一次性票据并以 ticket 查询参数传入；
+    令牌不接受查询参数，以免出现在访问日志与浏览器历史中"""
+    if ticket:
+        scope = stream_tickets.redeem(ticket)
+        if scope is None:
+            raise HTTPException(status_code=401, detail="推送票据无效或已过期")
+        tenant_id, user_id = scope
+    else:
+        token = bearer_token(authorization)
+        if not token:
+            raise HTTPException(status_code=401, detail="用户未登录")
+        # 撤销列表过期时会查询数据库，放到线程池中执行
+        tenant_id, user_id = _stream_scope(await run_in_threadpool(principal_from_token, token))
+    sub = change_feed.subscribe(tenant_id, user_id, last_event_id)
+    return StreamingResponse(
+        change_feed.stream(sub),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 class AdminUserUpsertRequest(BaseModel):
     email: Optional[EmailStr] = None
     name: Optional[str] = None
@@ -395,108 +655,206 @@ class AdminUserUpsertRequest(BaseModel):
     notes: Optional[str] = None
 
 
+def _user_changed(op: str, user_id: int, tenant_id: Optional[int], user: Optional[User] = None) -> None:
+    """用户写入提交后：递增租户变更版本，并向订阅者推送变更（created/updated 附带用户数据）"""
+    change_versions.bump(tenant_id)
+    if not change_feed.has_subscribers(tenant_id, user_id):
+        return
+    data: Dict[str, Any] = {"op": op, "id": user_id}
+    if user is not None:
+        data["user"] = UserResponse.model_validate(user).model_dump(mode="json")
+    change_feed.publish("user", data, tenant_id, user_id)
+
+
+def _conditional(request: Request, response: Response, tenant_id: Optional[int], *variant) -> Optional[Response]:
+    """条件 GET：按租户变更版本生成 ETag，If-None-Match 命中时返回 304（不访问数据库）。
+    须在读取数据之前调用，保证并发写入只会让 ETag 偏新而不会偏旧"""
+    etag = change_versions.etag(tenant_id, request.url.path, sorted(request.query_params.multi_items()), *variant)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Authorization, X-User-Id, X-Admin-Token",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def _user_fields(fields: Optional[str]):
+    """列表接口的 fields 参数（逗号分隔），只查询并返回这些字段"""
+    try:
+        return parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/api/admin/users", response_model=List[UserResponse])
 
 
 def admin_list_users(
+    request: Request,
+    response: Response,
+    fields: Optional[str] = None,
     x_user_id: Optional[int] = Header(default=None),
     x_admin_token: Optional[str] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db)
 ):
     """列出用户 - 系统管理员可看所有，医院管理员仅看本租户。支持x_user_id和x_admin_token两种方式。"""
+    keys = _user_fields(fields)
     # 优先支持ADMIN_TOKEN
     if x_admin_token:
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
         # 系统管理员：可看所有用户
-        users = db.query(User).order_by(User.id.asc()).all()
-        return users
-    # 否则用x_user_id
-    if x_user_id is None:
+        not_modified = _conditional(request, response, None)
+        if not_modified:
+            return not_modified
+        return fast_response(user_dicts(user_query(db, fields=keys).order_by(User.id.asc()), keys), response)
+    # 否则用会话令牌 / x_user_id
+    if x_user_id is None and not authorization:
         raise HTTPException(status_code=401, detail="用户未登录")
-    current_user = get_current_user(x_user_id, db)
-    query = db.query(User)
+    current_user = get_current_user(x_user_id, db, authorization)
+    query = user_query(db, fields=keys)
     if current_user.role == "admin":
-        users = query.order_by(User.id.asc()).all()
-        return users
+        tenant_id = None
     elif current_user.role == "hospital_admin":
-        users = query.filter(User.tenant_id == current_user.tenant_id).order_by(User.id.asc()).all()
-        return users
+        tenant_id = current_user.tenant_id
+        query = query.filter(User.tenant_id == tenant_id)
     else:
         raise HTTPException(status_code=403, detail="无权访问用户列表")
+    not_modified = _conditional(request, response, tenant_id)
+    if not_modified:
+        return not_modified
+    return fast_response(user_dicts(query.order_by(User.id.asc()), keys), response)
 
 
 # 分页与排序
 
+def _user_list_scope(current_user: Principal) -> Optional[int]:
+    """用户列表的可见范围：系统管理员为全部（None），医院管理员为本租户"""
+    if current_user.role == "admin":
+        return None
+    if current_user.role == "hospital_admin":
+        return current_user.tenant_id
+    raise HTTPException(status_code=403, detail="无权访问用户列表")
+
+
+def _user_list_filters(current_user: Principal, search: Optional[str]):
+    """用户列表的租户隔离与搜索条件，返回 (过滤条件, 计数缓存键)"""
+    filters = []
+    tenant_id = _user_list_scope(current_user)
+    if tenant_id is not None:
+        filters.append(User.tenant_id == tenant_id)
+    if search:
+        filters.append(user_search_filter(search))
+    return filters, (tenant_id, search or None)
+
+
+def _paginate_users(db: Session, current_user: Principal, search, sort, order, size, cursor, page, with_total, keys):
+    filters, count_key = _user_list_filters(current_user, search)
+    size = max(1, min(MAX_PAGE_SIZE, size))
+    try:
+        return paginate_users(
+            db, filters, count_key, sort, order, size, cursor,
+            offset=(max(1, page) - 1) * size, with_total=with_total, fields=keys,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/api/admin/users:paged", response_model=List[UserResponse])
 def admin_list_users_paged(
+    request: Request,
+    response: Response,
     page: int = 1,
     size: int = 20,
     sort: str = "id",
     order: str = "asc",
     search: Optional[str] = None,
-    current_user: User = Depends(require_hospital_admin_or_system_admin),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: Principal = Depends(require_hospital_admin_or_system_admin),
     db: Session = Depends(get_db),
 ):
-    """分页列出用户 - 按租户隔离，支持搜索"""
-    page = max(1, page)
-    size = max(1, min(200, size))
-    sort_field = getattr(User, sort, User.id)
-    q = db.query(User)
-    if current_user.role == "admin":
-        pass
-    elif current_user.role == "hospital_admin":
-        q = q.filter(User.tenant_id == current_user.tenant_id)
-    else:
-        raise HTTPException(status_code=403, detail="无权访问用户列表")
-    if search:
-        like = f"%{search}%"
-        q = q.filter((User.name.ilike(like)) | (User.email.ilike(like)) | (User.organization.ilike(like)))
-    q = q.order_by(sort_field.asc() if order != "desc" else sort_field.desc())
-    return q.offset((page - 1) * size).limit(size).all()
+    """分页列出用户 - 按租户隔离，支持搜索；下一页游标在 X-Next-Cursor 响应头中"""
+    keys = _user_fields(fields)
+    not_modified = _conditional(request, response, _user_list_scope(current_user))
+    if not_modified:
+        return not_modified
+    result = _paginate_users(db, current_user, search, sort, order, size, cursor, page, False, keys)
+    if result["next_cursor"]:
+        response.headers["X-Next-Cursor"] = result["next_cursor"]
+    return fast_response(user_dicts(result["items"], keys), response)
 
 
 # 分页返回 items+total
 
 @app.get("/api/admin/users:paged2")
 def admin_list_users_paged2(
+    request: Request,
+    response: Response,
     page: int = 1,
     size: int = 20,
     sort: str = "id",
     order: str = "asc",
     search: Optional[str] = None,
-    current_user: User = Depends(require_hospital_admin_or_system_admin),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: Principal = Depends(require_hospital_admin_or_system_admin),
     db: Session = Depends(get_db),
 ):
-    """分页返回用户列表和总数 - 按租户隔离，支持搜索"""
-    page = max(1, page)
-    size = max(1, min(200, size))
-    sort_field = getattr(User, sort, User.id)
-    q = db.query(User)
-    count_query = db.query(func.count(User.id))
-    if current_user.role == "admin":
-        pass
-    elif current_user.role == "hospital_admin":
-        q = q.filter(User.tenant_id == current_user.tenant_id)
-        count_query = count_query.filter(User.tenant_id == current_user.tenant_id)
+    """游标分页返回用户列表、下一页游标和总数（总数为缓存的近似值）- 按租户隔离，支持搜索"""
+    keys = _user_fields(fields)
+    not_modified = _conditional(request, response, _user_list_scope(current_user))
+    if not_modified:
+        return not_modified
+    result = _paginate_users(db, current_user, search, sort, order, size, cursor, page, True, keys)
+    result["items"] = user_dicts(result["items"], keys)
+    return fast_response(result, response)
+
+
+@app.get("/api/admin/users:changes")
+def admin_user_changes(
+    request: Request,
+    response: Response,
+    since: int = 0,
+    limit: int = 1000,
+    x_user_id: Optional[int] = Header(default=None),
+    x_admin_token: Optional[str] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
+    db: Session = Depends(get_db),
+):
+    """增量同步：返回变更序号大于 since 的用户与已删除的用户ID（墓碑）。
+    首次同步传 since=0；has_more 为真时用返回的 version 继续拉取，之后保存 version 供下次使用"""
+    if x_admin_token:
+        expected = os.getenv("ADMIN_TOKEN")
+        if not expected or x_admin_token != expected:
+            raise HTTPException(status_code=403, detail="管理员令牌无效")
+        tenant_id = None
+    elif x_user_id is not None or authorization:
+        tenant_id = _user_list_scope(get_current_user(x_user_id, db, authorization))
     else:
-        raise HTTPException(status_code=403, detail="无权访问用户列表")
-    if search:
-        like = f"%{search}%"
-        q = q.filter((User.name.ilike(like)) | (User.email.ilike(like)) | (User.organization.ilike(like)))
-        count_query = count_query.filter((User.name.ilike(like)) | (User.email.ilike(like)) | (User.organization.ilike(like)))
-    total = count_query.scalar() or 0
-    q = q.order_by(sort_field.asc() if order != "desc" else sort_field.desc())
-    items = q.offset((page - 1) * size).limit(size).all()
-    return {"items": items, "total": total}
+        raise HTTPException(status_code=401, detail="用户未登录")
+    not_modified = _conditional(request, response, tenant_id)
+    if not_modified:
+        return not_modified
+    result = changes_since(db, max(0, since), limit, tenant_id)
+    if not result["items"] and not result["deleted"] and since > current_version(db):
+        # 客户端的版本来自另一个数据库（如恢复了备份），需要全量同步
+        raise HTTPException(status_code=409, detail="同步版本无效，请使用 since=0 重新全量同步")
+    return fast_response(result, response)
 
 
 @app.post("/api/admin/users", response_model=UserResponse)
 def admin_create_user(
     payload: UserRegisterRequest,
+    request: Request,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """创建用户 - 支持多租户权限控制"""
@@ -507,9 +865,9 @@ def admin_create_user(
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
         current_user = None  # 系统管理员，无机构限制
-    elif x_user_id:
+    elif x_user_id or authorization:
         # 使用新的用户权限方式
-        current_user = get_current_user(x_user_id, db)
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin and current_user.role != "hospital_admin":
             raise HTTPException(status_code=403, detail="需要管理员权限")
     else:
@@ -520,20 +878,17 @@ def admin_create_user(
         raise HTTPException(status_code=400, detail="邮箱已被注册")
     
     # 医院管理员只能在自己机构和租户内创建用户，tenant_id强制为自己租户
-    tenant_id = None
     if current_user and current_user.role == "hospital_admin":
         if payload.organization != current_user.organization:
             raise HTTPException(status_code=403, detail="只能在自己机构内创建用户")
         tenant_id = current_user.tenant_id
-    elif current_user and current_user.role == "admin":
-        # 系统管理员可指定租户，若未指定则默认1
-        tenant_id = getattr(payload, "tenant_id", 1)
     else:
-        tenant_id = 1
+        # 系统管理员：租户跟随机构（须为已有租户）
+        tenant_id = existing_tenant(db, payload.organization)
 
     user = User(
         email=payload.email,
-        password_hash=hash_password(payload.password),
+        password_hash=hash_password(payload.password, request),
         name=payload.name,
         organization=payload.organization,
         phone=payload.phone,
@@ -543,6 +898,8 @@ def admin_create_user(
     )
     db.add(user)
     db.commit()
+    user_counts.invalidate()
+    _user_changed("created", user.id, user.tenant_id, user)
     db.refresh(user)
     return user
 
@@ -553,6 +910,7 @@ def admin_update_user(
     payload: AdminUserUpsertRequest,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """更新用户信息 - 支持多租户权限控制"""
@@ -563,9 +921,9 @@ def admin_update_user(
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
         current_user = None  # 系统管理员，无机构限制
-    elif x_user_id:
+    elif x_user_id or authorization:
         # 使用新的用户权限方式
-        current_user = get_current_user(x_user_id, db)
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin and current_user.role != "hospital_admin":
             raise HTTPException(status_code=403, detail="需要管理员权限")
     else:
@@ -575,11 +933,13 @@ def admin_update_user(
     if not user:
         raise HTTPException(status_code=404, detail="用户未找到")
     
-    # 医院管理员只能修改自己机构的用户
+    # 医院管理员只能修改自己机构的普通用户
     if current_user is not None:
         if current_user.role == "hospital_admin" and not current_user.is_admin:
             if user.organization != current_user.organization:
                 raise HTTPException(status_code=403, detail="只能修改本机构用户")
+            if user.id != current_user.id and (user.is_admin or user.role != "user"):
+                raise HTTPException(status_code=403, detail="不能修改管理员账户")
     
     if payload.email is not None:
         # 检查邮箱唯一
@@ -594,7 +954,9 @@ def admin_update_user(
         if current_user is not None and current_user.role == "hospital_admin" and not current_user.is_admin:
             if payload.organization != current_user.organization:
                 raise HTTPException(status_code=403, detail="不能修改用户所属机构")
-        user.organization = payload.organization
+        if payload.organization != user.organization:
+            user.organization = payload.organization
+            user.tenant_id = existing_tenant(db, payload.organization)
     if payload.phone is not None:
         user.phone = payload.phone
     if payload.is_admin is not None:
@@ -610,12 +972,31 @@ def admin_update_user(
         user.status = payload.status
     if payload.notes is not None:
         user.notes = payload.notes
+    # 状态、权限或机构变化后，已签发令牌中的信息失效
+    changed = _changed_attrs(user) if db.is_modified(user) else set()
+    if {"status", "is_admin", "organization"} & changed:
+        revocations.revoke(db, user.id)
+    old_tenant_id = inspect(user).attrs.tenant_id.history.deleted
+    if "tenant_id" in changed:
+        # 机构变更：用量事件与汇总行随用户迁到新租户
+        db.flush()
+        move_usage_history(db, user.tenant_id, [user.id])
     db.add(user)
     db.commit()
+    principal_cache.invalidate([user.id])
+    if old_tenant_id:
+        user_counts.invalidate()
+        change_versions.bump(old_tenant_id[0])
+    _user_changed("updated", user.id, user.tenant_id, user)
     db.refresh(user)
     return user
 
 
+def _changed_attrs(obj) -> set:
+    state = inspect(obj)
+    return {attr.key for attr in state.attrs if attr.history.has_changes()}
+
+
 @app.delete("/api/admin/users/{user_id}")
 def admin_delete_user(
     user_id: int,
@@ -625,8 +1006,13 @@ def admin_delete_user(
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="用户未找到")
+    tenant_id = user.tenant_id
     db.delete(user)
+    revocations.revoke(db, user_id)
     db.commit()
+    principal_cache.invalidate([user_id])
+    user_counts.invalidate()
+    _user_changed("deleted", user_id, tenant_id)
     return {"message": "已删除"}
 
 
@@ -634,16 +1020,30 @@ def admin_delete_user(
 @app.get("/api/admin/users:search", response_model=List[UserResponse])
 def admin_search_users(
     q: Optional[str] = None,
+    limit: int = 50,
+    fields: Optional[str] = None,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    stmt = db.query(User)
-    if q:
-        like = f"%{q}%"
-        stmt = stmt.filter(
-            (User.email.like(like)) | (User.name.like(like)) | (User.phone.like(like))
-        )
-    return stmt.order_by(User.id.asc()).all()
+    """按姓名、邮箱、机构、手机号搜索用户，结果按相关度排序"""
+    keys = _user_fields(fields)
+    limit = max(1, min(MAX_PAGE_SIZE, limit))
+    query = user_query(db, fields=keys)
+    if not q or not q.strip():
+        return fast_response(user_dicts(query.order_by(User.id.asc()).limit(limit), keys))
+    return fast_response(user_dicts(search_users(db, q, limit, query=query), keys))
+
+
+@app.post("/api/admin/users:rebuild-search-index")
+def admin_rebuild_user_search(
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """按 users 表重建用户全文索引"""
+    if not ensure_user_search(db):
+        raise HTTPException(status_code=501, detail="当前 SQLite 不支持 FTS5 trigram 全文索引")
+    rebuild_user_search(db)
+    return {"message": "用户搜索索引已重建"}
 
 
 class AdminResetPasswordRequest(BaseModel):
@@ -654,15 +1054,18 @@ class AdminResetPasswordRequest(BaseModel):
 def admin_reset_password(
     user_id: int,
     payload: AdminResetPasswordRequest,
+    request: Request,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="用户未找到")
-    user.password_hash = hash_password(payload.new_password)
+    user.password_hash = hash_password(payload.new_password, request)
+    revocations.revoke(db, user_id)
     db.add(user)
     db.commit()
+    principal_cache.invalidate([user_id])
     return {"message": "密码已重置"}
 
 
@@ -675,105 +1078,189 @@ def admin_reset_usage(
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="用户未找到")
-    user.usage_used = 0
-    user.daily_used = 0
-    db.add(user)
+    reset_usage(db, user.id)
     db.commit()
+    principal_cache.invalidate([user_id])
+    change_versions.bump(user.tenant_id)
+    change_feed.publish("usage", {"user_id": user_id, "usage_used": 0, "daily_used": 0}, user.tenant_id, user_id)
     return {"message": "用量已重置"}
 
 
-# 简单CSV导出（所有用户）
-from fastapi.responses import PlainTextResponse
-
-
-@app.get("/api/admin/users:export-csv", response_class=PlainTextResponse)
-def admin_export_csv(_: None = Depends(require_admin), db: Session = Depends(get_db)):
-    rows = db.query(User).order_by(User.id.asc()).all()
-    headers = [
-        "id",
-        "email",
-        "name",
-        "organization",
-        "phone",
-        "is_admin",
-        "status",
-        "usage_quota",
-        "usage_used",
-        "daily_quota",
-        "daily_used",
-    ]
-    out = [";".join(headers)]
-    for u in rows:
-        out.append(
-            ";".join(
-                [
-                    str(u.id),
-                    u.email or "",
-                    u.name or "",
-                    u.organization or "",
-                    u.phone or "",
-                    "1" if u.is_admin else "0",
-                    u.status or "",
-                    "" if u.usage_quota is None else str(u.usage_quota),
-                    str(u.usage_used or 0),
-                    "" if u.daily_quota is None else str(u.daily_quota),
-                    str(u.daily_used or 0),
-                ]
-            )
-        )
-    return "\n".join(out)
+# 批量操作：超过该数量时按租户推送 resync，不再逐个用户推送
+BULK_EVENT_LIMIT = 200
+
+
+class BulkUserFilter(BaseModel):
+    ids: Optional[List[int]] = Field(default=None, max_length=MAX_BULK_IDS)
+    tenant_id: Optional[int] = None
+    organization: Optional[str] = None
+    status: Optional[str] = None
+
+
+class BulkUserRequest(BaseModel):
+    op: str
+    filter: BulkUserFilter
+    # set_quota：未提供的字段不变，显式为 null 表示不限制
+    usage_quota: Optional[int] = Field(default=None, ge=0)
+    daily_quota: Optional[int] = Field(default=None, ge=0)
+
+
+@app.post("/api/admin/users:bulk")
+def admin_bulk_users(
+    payload: BulkUserRequest,
+    x_admin_token: Optional[str] = Header(default=None),
+    x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
+    db: Session = Depends(get_db),
+):
+    """批量设置配额、重置用量、启用/禁用、删除用户，在一个事务内完成。
+    医院管理员只能对本租户的普通用户设置配额或启用/禁用"""
+    if x_admin_token:
+        require_admin(x_admin_token, None)
+        tenant_scope = None
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
+        tenant_scope = _user_list_scope(current_user)
+        if tenant_scope is not None and payload.op not in ("set_quota", "enable", "disable"):
+            raise HTTPException(status_code=403, detail="该批量操作需要系统管理员权限")
+    else:
+        raise HTTPException(status_code=401, detail="需要管理员权限")
+    if payload.op not in BULK_OPS:
+        raise HTTPException(status_code=400, detail=f"不支持的批量操作，可选: {', '.join(BULK_OPS)}")
+
+    f = payload.filter
+    if f.ids is None and f.tenant_id is None and f.organization is None and f.status is None:
+        raise HTTPException(status_code=400, detail="请至少指定一个筛选条件")
+    tenant_ids = {t for t in (f.tenant_id, tenant_scope) if t is not None}
+    if f.organization is not None:
+        # 机构与租户一一对应；机构不存在时不匹配任何用户
+        tenant_ids.add(tenant_directory.resolve(db, f.organization))
+    if tenant_scope is not None and tenant_ids != {tenant_scope}:
+        raise HTTPException(status_code=403, detail="只能操作本租户用户")
+    conditions = bulk_conditions(ids=f.ids, status=f.status)
+    if len(tenant_ids) > 1 or None in tenant_ids:
+        conditions.append(false())
+    elif tenant_ids:
+        conditions.append(User.tenant_id == tenant_ids.pop())
+    if tenant_scope is not None:
+        # 与单个修改一致：医院管理员只能操作本租户的普通用户，管理员账户不在范围内
+        conditions += [User.role == "user", User.is_admin.is_(False)]
+
+    values = {k: getattr(payload, k) for k in ("usage_quota", "daily_quota") if k in payload.model_fields_set}
+    if payload.op == "set_quota" and not values:
+        raise HTTPException(status_code=400, detail="请指定 usage_quota 或 daily_quota")
+    affected, rows = run_bulk(db, payload.op, conditions, values)
+
+    user_ids = [user_id for user_id, _ in rows]
+    principal_cache.invalidate(user_ids)
+    if payload.op == "delete":
+        user_counts.invalidate()
+    if len(rows) > BULK_EVENT_LIMIT:
+        for tenant_id in {tenant_id for _, tenant_id in rows}:
+            change_versions.bump(tenant_id)
+            change_feed.publish("resync", {"reason": "bulk", "op": payload.op}, tenant_id)
+    elif payload.op == "reset_usage":
+        for user_id, tenant_id in rows:
+            change_versions.bump(tenant_id)
+            change_feed.publish("usage", {"user_id": user_id, "usage_used": 0, "daily_used": 0}, tenant_id, user_id)
+    elif payload.op == "delete":
+        for user_id, tenant_id in rows:
+            _user_changed("deleted", user_id, tenant_id)
+    elif rows:
+        users = {}
+        if any(change_feed.has_subscribers(tenant_id, user_id) for user_id, tenant_id in rows):
+            users = {u.id: u for u in db.query(User).filter(User.id.in_(user_ids))}
+        for user_id, tenant_id in rows:
+            _user_changed("updated", user_id, tenant_id, users.get(user_id))
+    return {"op": payload.op, "matched": len(rows), "affected": affected}
+
+
+# 流式导出（用户 / 用量事件）
+def _export_response(chunks, fmt: str, gzip: bool, filename: str) -> StreamingResponse:
+    media_type = "application/x-ndjson" if fmt == "ndjson" else "text/csv; charset=utf-8"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+def _check_export_format(fmt: str) -> str:
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format 仅支持 csv 或 ndjson")
+    return fmt
+
+
+@app.get("/api/admin/users:export-csv")
+def admin_export_csv(
+    tenant_id: Optional[int] = None,
+    gzip: bool = False,
+    _: None = Depends(require_admin),
+):
+    """导出用户CSV（与导入格式一致），流式输出"""
+    return _export_response(export_users(tenant_id, "csv", gzip), "csv", gzip, "users")
+
+
+@app.get("/api/admin/users:export")
+def admin_export_users(
+    format: str = "csv",
+    tenant_id: Optional[int] = None,
+    gzip: bool = False,
+    _: None = Depends(require_admin),
+):
+    """导出用户（csv / ndjson），可按租户过滤、可 gzip 压缩"""
+    fmt = _check_export_format(format)
+    return _export_response(export_users(tenant_id, fmt, gzip), fmt, gzip, "users")
+
+
+@app.get("/api/admin/usage:export")
+def admin_export_usage_events(
+    format: str = "csv",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    tenant_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    gzip: bool = False,
+    _: None = Depends(require_admin),
+):
+    """导出用量事件（仅热数据，已归档部分见冷归档文件），按时间升序流式输出"""
+    fmt = _check_export_format(format)
+    def parse_dt(s):
+        if not s:
+            return None
+        try:
+            return datetime.fromisoformat(s)
+        except Exception:
+            raise HTTPException(status_code=400, detail="时间格式无效")
+    chunks = export_usage_events(parse_dt(start), parse_dt(end), tenant_id, user_id, fmt, gzip)
+    return _export_response(chunks, fmt, gzip, "usage_events")
 
 
 # CSV 导入（upsert by email）
 from fastapi import UploadFile, File
 
+DEFAULT_IMPORT_PASSWORD = "changeme123"
+
 
 @app.post("/api/admin/users:import-csv")
-async def admin_import_users_csv(
+def admin_import_users_csv(
+    request: Request,
     file: UploadFile = File(...),
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    content = await file.read()
-    text = content.decode("utf-8", errors="ignore")
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    if not lines:
-        return {"imported": 0}
-    header = [h.strip() for h in lines[0].split(";")]
-    idx = {name: i for i, name in enumerate(header)}
-    cnt = 0
-    for line in lines[1:]:
-        parts = [p.strip() for p in line.split(";")]
-        email = parts[idx.get("email", -1)] if idx.get("email") is not None else None
-        if not email:
-            continue
-        user = db.query(User).filter(User.email == email).first()
-        def getv(key):
-            i = idx.get(key)
-            return parts[i] if (i is not None and i < len(parts)) else None
-        if user is None:
-            user = User(
-                email=email,
-                password_hash=hash_password("changeme123"),
-                name=getv("name") or None,
-                organization=getv("organization") or None,
-                phone=getv("phone") or None,
-            )
-            db.add(user)
-        # upsert fields
-        uq = getv("usage_quota")
-        dq = getv("daily_quota")
-        user.name = getv("name") or user.name
-        user.organization = getv("organization") or user.organization
-        user.phone = getv("phone") or user.phone
-        user.status = getv("status") or user.status
-        user.notes = getv("notes") or user.notes
-        user.is_admin = (getv("is_admin") == "1") if getv("is_admin") is not None else user.is_admin
-        user.usage_quota = int(uq) if (uq not in (None, "")) else user.usage_quota
-        user.daily_quota = int(dq) if (dq not in (None, "")) else user.daily_quota
-        cnt += 1
-    db.commit()
-    return {"imported": cnt}
+    """流式导入用户（分号分隔，按邮箱 upsert），新用户默认密码 changeme123，返回逐行错误"""
+    try:
+        report = import_users_csv(db, file.file, hash_password(DEFAULT_IMPORT_PASSWORD, request))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # 导入可能修改任意用户的状态与配额（含出错前已提交的批次）
+        principal_cache.invalidate()
+        user_counts.invalidate()
+        change_versions.bump()
+        change_feed.publish("resync", {"reason": "import"})
+    return report
 
 
 # 用量汇总（按时间范围）
@@ -782,13 +1269,17 @@ from datetime import datetime
 
 @app.get("/api/admin/usage:summary")
 def admin_usage_summary(
+    request: Request,
+    response: Response,
     start: Optional[str] = None,
     end: Optional[str] = None,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    # 仅统计事件数量
-    q = db.query(UsageEvent)
+    not_modified = _conditional(request, response, None)
+    if not_modified:
+        return not_modified
+    # 基于汇总表统计事件数量
     def parse_dt(s):
         if not s:
             return None
@@ -798,22 +1289,36 @@ def admin_usage_summary(
             return None
     sdt = parse_dt(start)
     edt = parse_dt(end)
-    if sdt:
-        q = q.filter(UsageEvent.created_at >= sdt)
-    if edt:
-        q = q.filter(UsageEvent.created_at <= edt)
-    total = q.count()
-    return {"total_events": total, "window": {"start": start, "end": end}}
+    agg = aggregate_usage(db, sdt, edt, group_by="total").get(None, {})
+    latency_count = agg.get("latency_count", 0)
+    return {
+        "total_events": agg.get("event_count", 0),
+        "total_tokens": agg.get("tokens_sum", 0),
+        "avg_latency_ms": round(agg["latency_sum"] / latency_count, 1) if latency_count else None,
+        "window": {"start": start, "end": end},
+    }
 
 
 @app.get("/api/admin/usage:by-user")
 def admin_usage_by_user(
+    request: Request,
+    response: Response,
     start: Optional[str] = None,
     end: Optional[str] = None,
+    top: Optional[int] = None,
+    window: str = "24h",
+    tenant_id: Optional[int] = None,
+    exact: bool = False,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
+    """按用户统计；指定 top 且未指定 start/end 时，从流式 Top-K 返回最近 window 内的近似排行（含误差）"""
     from datetime import datetime
+    # 滑动窗口排行随时间推移而变化，ETag 按当前小时区分
+    sliding = hour_bucket(datetime.utcnow()) if top is not None and not (start or end) else None
+    not_modified = _conditional(request, response, tenant_id, sliding)
+    if not_modified:
+        return not_modified
     def parse_dt(s):
         if not s:
             return None
@@ -821,25 +1326,46 @@ def admin_usage_by_user(
             return datetime.fromisoformat(s)
         except Exception:
             return None
+    if top is not None:
+        top = max(1, min(100, top))
+        if not (start or end):
+            try:
+                hours = parse_window(window)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if not exact:
+                return heavy_hitters.top(top, hours, tenant_id=tenant_id)
+            # 精确模式（审计用）：按相同的小时桶窗口读汇总表
+            start_dt = hour_bucket(datetime.utcnow()) - timedelta(hours=hours - 1)
+            rows = aggregate_usage(db, start_dt, None, group_by="user", tenant_id=tenant_id)
+            ordered = sorted(rows.items(), key=lambda kv: (-kv[1]["event_count"], kv[0]))[:top]
+            return {
+                "items": [{"user_id": uid, "count": agg["event_count"], "error": 0, "guaranteed": agg["event_count"]} for uid, agg in ordered],
+                "total_events": sum(agg["event_count"] for agg in rows.values()),
+                "max_error": 0,
+                "window_start": start_dt.isoformat(),
+            }
     sdt = parse_dt(start)
     edt = parse_dt(end)
-    q = db.query(UsageEvent.user_id.label("user_id"), func.count(UsageEvent.id).label("count"))
-    if sdt:
-        q = q.filter(UsageEvent.created_at >= sdt)
-    if edt:
-        q = q.filter(UsageEvent.created_at <= edt)
-    q = q.group_by(UsageEvent.user_id).order_by(func.count(UsageEvent.id).desc())
-    rows = q.all()
-    return [{"user_id": r.user_id, "count": r.count} for r in rows]
+    rows = aggregate_usage(db, sdt, edt, group_by="user", tenant_id=tenant_id)
+    ordered = sorted(rows.items(), key=lambda kv: (-kv[1]["event_count"], kv[0]))
+    if top is not None:
+        ordered = ordered[:top]
+    return [{"user_id": uid, "count": agg["event_count"]} for uid, agg in ordered]
 
 
 @app.get("/api/admin/usage:by-day")
 def admin_usage_by_day(
+    request: Request,
+    response: Response,
     start: Optional[str] = None,
     end: Optional[str] = None,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
+    not_modified = _conditional(request, response, None)
+    if not_modified:
+        return not_modified
     from datetime import datetime
     def parse_dt(s):
         if not s:
@@ -850,16 +1376,203 @@ def admin_usage_by_day(
             return None
     sdt = parse_dt(start)
     edt = parse_dt(end)
-    # SQLite: 使用 date() 提取日期
-    day_expr = func.date(UsageEvent.created_at)
-    q = db.query(day_expr.label("day"), func.count(UsageEvent.id).label("count"))
-    if sdt:
-        q = q.filter(UsageEvent.created_at >= sdt)
-    if edt:
-        q = q.filter(UsageEvent.created_at <= edt)
-    q = q.group_by(day_expr).order_by(day_expr.asc())
-    rows = q.all()
-    return [{"date": r.day, "count": r.count} for r in rows]
+    # 日期按UTC划分，与汇总表的日桶一致
+    rows = aggregate_usage(db, sdt, edt, group_by="day")
+    return [{"date": day, "count": agg["event_count"]} for day, agg in sorted(rows.items())]
+
+
+@app.post("/api/admin/usage:rebuild-rollups")
+def admin_rebuild_usage_rollups(
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """根据 usage_events 与冷归档全量重建用量汇总表"""
+    result = backfill_rollups(db, iter_archive_by_day())
+    heavy_hitters.warm(db)
+    change_versions.bump()
+    return result
+
+
+@app.get("/api/admin/usage:events")
+def admin_usage_events(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    tenant_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    limit: int = 1000,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """查询用量事件明细：热数据与冷归档合并返回"""
+    def parse_dt(s):
+        if not s:
+            return None
+        try:
+            return datetime.fromisoformat(s)
+        except Exception:
+            return None
+    limit = max(1, min(10000, limit))
+    result = query_events(db, parse_dt(start), parse_dt(end), tenant_id=tenant_id, user_id=user_id, limit=limit)
+    result["window"] = {"start": start, "end": end}
+    return result
+
+
+@app.post("/api/admin/usage:retention-run")
+def admin_run_usage_retention(
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """立即执行一次用量事件归档与清理"""
+    return run_retention(db)
+
+
+@app.get("/api/admin/analytics:usage")
+def admin_usage_analytics(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    tenant_id: Optional[int] = None,
+    top: int = 10,
+    _: None = Depends(require_admin),
+):
+    """基于列式存储的用量分析：按天统计、用户排行与延迟分位数"""
+    def parse_dt(s):
+        if not s:
+            return None
+        try:
+            return datetime.fromisoformat(s)
+        except Exception:
+            return None
+    began = time.perf_counter()
+    data = event_store.scan(parse_dt(start), parse_dt(end), tenant_id=tenant_id)
+    result = analyze(data, top=max(1, min(100, top)))
+    result["rejected_rows"] = event_store.rejected
+    result["elapsed_ms"] = round((time.perf_counter() - began) * 1000, 2)
+    result["window"] = {"start": start, "end": end}
+    return result
+
+
+@app.post("/api/admin/analytics:rebuild-columnar")
+def admin_rebuild_columnar(
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """从 usage_events 与冷归档重建列式分析存储"""
+    return rebuild_from_db(db)
+
+
+@app.get("/api/admin/usage:active-users")
+def admin_usage_active_users(
+    day: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    tenant_id: Optional[int] = None,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """去重活跃用户数（HyperLogLog 近似）：默认返回截至 day 的日/周/月活，指定 start/end 时返回该范围"""
+    def parse_day(s):
+        if not s:
+            return None
+        try:
+            return date.fromisoformat(s[:10])
+        except Exception:
+            raise HTTPException(status_code=400, detail="日期格式应为 YYYY-MM-DD")
+    if start or end:
+        lo = parse_day(start) or date.min
+        hi = parse_day(end) or datetime.utcnow().date()
+        return {"tenant_id": tenant_id, "range": active_users.estimate(db, lo, hi, tenant_id), "window": {"start": start, "end": end}}
+    anchor = parse_day(day) or datetime.utcnow().date()
+    result = {"tenant_id": tenant_id, "day": anchor.isoformat()}
+    for name, days in (("dau", 1), ("wau", 7), ("mau", 30)):
+        result[name] = active_users.estimate(db, anchor - timedelta(days=days - 1), anchor, tenant_id)
+    return result
+
+
+@app.get("/api/admin/usage:realtime")
+def admin_usage_realtime(
+    minutes: int = 15,
+    tenant_id: Optional[int] = None,
+    upstream: Optional[str] = None,
+    _: None = Depends(require_admin),
+):
+    """实时用量：最近 minutes 分钟（最多1440）的逐分钟请求数、错误数、token 与 p95 延迟，只读内存"""
+    result = usage_timeseries.window(minutes, tenant_id=tenant_id, upstream=upstream)
+    result["upstreams"] = usage_timeseries.upstreams()
+    return result
+
+
+@app.post("/api/admin/usage:rebuild-active-users")
+def admin_rebuild_active_users(
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """从 usage_events 与冷归档重建活跃用户 sketch"""
+    return active_users.rebuild(db)
+
+
+class TenantRetentionRequest(BaseModel):
+    retention_days: Optional[int] = Field(default=None, ge=1, description="热数据保留天数，为空表示使用全局默认")
+
+
+class TenantCreateRequest(BaseModel):
+    name: str = Field(min_length=1, max_length=100, description="机构名称，即租户名")
+    description: Optional[str] = Field(default=None, max_length=1000)
+
+
+@app.post("/api/admin/tenants")
+def admin_create_tenant(
+    payload: TenantCreateRequest,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """创建机构租户；用户的机构只能解析到已创建的租户"""
+    try:
+        tenant_id = tenant_directory.create(db, payload.name, payload.description)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if tenant_id is None:
+        raise HTTPException(status_code=409, detail="机构已存在")
+    return {"id": tenant_id, "name": payload.name.strip(), "description": payload.description}
+
+
+@app.post("/api/admin/tenants:backfill")
+def admin_backfill_tenants(
+    dry_run: bool = False,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """一次性迁移：把旧库用户按机构归入已有租户（只执行一次，受影响用户需重新登录）。
+    没有对应租户的机构在 unmatched 中返回；dry_run=true 只统计不写入"""
+    try:
+        result = backfill_user_tenants(db, dry_run=dry_run)
+    except MigrationApplied as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not dry_run and result["users_moved"]:
+        principal_cache.invalidate()
+        user_counts.invalidate()
+        change_versions.bump()
+        change_feed.publish("resync", {"reason": "tenants"})
+    return result
+
+
+@app.put("/api/admin/tenants/{tenant_id}/retention")
+def admin_set_tenant_retention(
+    tenant_id: int,
+    payload: TenantRetentionRequest,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """设置租户的用量事件保留天数"""
+    tenant = db.query(Tenant).filter(Tenant.id == tenant_id).first()
+    if not tenant:
+        raise HTTPException(status_code=404, detail="租户未找到")
+    tenant.retention_days = payload.retention_days
+    db.commit()
+    return {
+        "tenant_id": tenant.id,
+        "retention_days": tenant.retention_days,
+        "effective_retention_days": tenant.retention_days or DEFAULT_RETENTION_DAYS,
+    }
 
 
 @app.get("/api/users/{user_id}/subscription", response_model=SubscriptionResponse)
@@ -876,19 +1589,21 @@ class PasswordChangeRequest(BaseModel):
 
 
 @app.post("/api/users/{user_id}/password:change")
-def change_password(user_id: int, req: PasswordChangeRequest, db: Session = Depends(get_db)):
+def change_password(user_id: int, req: PasswordChangeRequest, request: Request, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="用户未找到")
 
     # 校验旧密码
-    if not pwd_context.verify(req.old_password, user.password_hash):
+    if not verify_password(req.old_password, user.password_hash, request):
         raise HTTPException(status_code=400, detail="原密码不正确")
 
-    user.password_hash = hash_password(req.new_password)
+    user.password_hash = hash_password(req.new_password, request)
+    revocations.revoke(db, user.id)
     db.add(user)
     db.commit()
-    return {"message": "密码已更新"}
+    # 其他会话全部失效，为当前调用方签发新令牌
+    return {"message": "密码已更新", **issue_token(user)}
 
 
 @app.put("/api/users/{user_id}/subscription", response_model=SubscriptionResponse)
@@ -906,6 +1621,7 @@ def upsert_subscription(
     if sub is None:
         sub = Subscription(
             user_id=user_id,
+            tenant_id=user.tenant_id,
             plan=req.plan,
             status=req.status,
             auto_renew=req.auto_renew,
@@ -948,6 +1664,7 @@ class SwitchUpstreamRequest(BaseModel):
 def admin_list_upstream_services(
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """列出所有上游服务配置"""
@@ -956,8 +1673,8 @@ def admin_list_upstream_services(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -985,6 +1702,7 @@ def admin_add_upstream_service(
     request: UpstreamServiceRequest,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """添加新的上游服务"""
@@ -992,8 +1710,8 @@ def admin_add_upstream_service(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -1029,6 +1747,7 @@ def admin_update_upstream_service(
     request: UpstreamServiceRequest,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """更新上游服务配置"""
@@ -1036,8 +1755,8 @@ def admin_update_upstream_service(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -1072,6 +1791,7 @@ def admin_delete_upstream_service(
     service_key: str,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """删除上游服务"""
@@ -1079,8 +1799,8 @@ def admin_delete_upstream_service(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -1099,6 +1819,7 @@ def admin_switch_upstream_service(
     request: SwitchUpstreamRequest,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """切换当前使用的主上游服务"""
@@ -1106,8 +1827,8 @@ def admin_switch_upstream_service(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -1127,6 +1848,7 @@ def admin_switch_upstream_service(
 def admin_get_current_upstream_service(
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """获取当前使用的主上游服务信息"""
@@ -1134,8 +1856,8 @@ def admin_get_current_upstream_service(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -1159,6 +1881,7 @@ def admin_get_current_upstream_service(
 def admin_check_upstream_health(
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """检查所有上游服务的健康状态"""
@@ -1166,8 +1889,8 @@ def admin_check_upstream_health(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
-        current_user = get_current_user(x_user_id, db)
+    elif x_user_id or authorization:
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
@@ -1209,8 +1932,11 @@ class OrganizationResponse(BaseModel):
 
 @app.get("/api/admin/organizations", response_model=List[OrganizationResponse])
 def admin_list_organizations(
+    request: Request,
+    response: Response,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """列出所有机构 - 仅系统管理员可访问"""
@@ -1220,112 +1946,116 @@ def admin_list_organizations(
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
+    elif x_user_id or authorization:
         # 使用新的用户权限方式
-        current_user = get_current_user(x_user_id, db)
+        current_user = get_current_user(x_user_id, db, authorization)
         if not current_user.is_admin or current_user.role != "admin":
             raise HTTPException(status_code=403, detail="需要系统管理员权限")
     else:
         raise HTTPException(status_code=401, detail="需要管理员权限")
-    # 查询所有机构及其统计信息（简化版本，避免SQLite兼容性问题）
-    org_stats = db.query(
-        User.organization.label("name"),
-        func.count(User.id).label("user_count"),
-        func.sum(User.usage_used).label("total_usage"),
-        func.min(User.created_at).label("created_at")
-    ).filter(
-        User.organization.isnot(None)
-    ).group_by(
-        User.organization
-    ).order_by(
-        User.organization
-    ).all()
-    
-    # 单独查询活跃用户数
-    result = []
-    for stat in org_stats:
-        active_users = db.query(func.count(User.id)).filter(
-            User.organization == stat.name,
-            User.status == "active"
-        ).scalar() or 0
-        
-        result.append(OrganizationResponse(
-            name=stat.name,
-            user_count=stat.user_count,
-            total_usage=stat.total_usage or 0,
-            active_users=active_users,
-            created_at=stat.created_at.isoformat() if stat.created_at else None
-        ))
-    
-    return result
+    not_modified = _conditional(request, response, None)
+    if not_modified:
+        return not_modified
+    # 读取物化的机构统计表（触发器增量维护），与用户数无关
+    return [
+        OrganizationResponse(
+            name=stat["name"],
+            user_count=stat["user_count"],
+            total_usage=stat["total_usage"],
+            active_users=stat["active_users"],
+            created_at=stat["created_at"].isoformat() if stat["created_at"] else None,
+        )
+        for stat in list_organizations(db)
+    ]
 
 
 @app.get("/api/admin/organizations/{org_name}/users", response_model=List[UserResponse])
 def admin_list_organization_users(
     org_name: str,
+    request: Request,
+    response: Response,
+    size: int = 20,
+    sort: str = "id",
+    order: str = "asc",
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
-    """列出指定机构的用户"""
+    """分页列出指定机构的用户（按机构对应的租户查询）；下一页游标在 X-Next-Cursor 响应头中"""
+    keys = _user_fields(fields)
+    tenant_id = tenant_directory.resolve(db, org_name)
     # 兼容旧的ADMIN_TOKEN方式和新的用户权限方式
     if x_admin_token:
         # 使用旧的ADMIN_TOKEN方式，系统管理员可以查看任何机构
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
+    elif x_user_id or authorization:
         # 使用新的用户权限方式
-        current_user = get_current_user(x_user_id, db)
+        current_user = get_current_user(x_user_id, db, authorization)
         # 医院管理员只能查看自己机构
         if current_user.role == "hospital_admin" and not current_user.is_admin:
-            if org_name != current_user.organization:
+            if tenant_id != current_user.tenant_id:
                 raise HTTPException(status_code=403, detail="只能查看本机构用户")
     else:
         raise HTTPException(status_code=401, detail="需要管理员权限")
-    
-    users = db.query(User).filter(
-        User.organization == org_name
-    ).order_by(User.id.asc()).all()
-    
-    return users
+    if tenant_id is None:
+        return []
+    not_modified = _conditional(request, response, tenant_id)
+    if not_modified:
+        return not_modified
+
+    try:
+        users, next_cursor = keyset_page(
+            projected_user_query(db, sort, keys).filter(User.tenant_id == tenant_id), sort, order, size, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return fast_response(user_dicts(users, keys), response)
 
 
 @app.get("/api/admin/organizations/{org_name}/stats")
 def admin_get_organization_stats(
     org_name: str,
+    request: Request,
+    response: Response,
     start: Optional[str] = None,
     end: Optional[str] = None,
     x_admin_token: Optional[str] = Header(default=None),
     x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
 ):
     """获取机构使用统计"""
+    tenant_id = tenant_directory.resolve(db, org_name)
     # 兼容旧的ADMIN_TOKEN方式和新的用户权限方式
     if x_admin_token:
         # 使用旧的ADMIN_TOKEN方式，系统管理员可以查看任何机构
         expected = os.getenv("ADMIN_TOKEN")
         if not expected or x_admin_token != expected:
             raise HTTPException(status_code=403, detail="管理员令牌无效")
-    elif x_user_id:
+    elif x_user_id or authorization:
         # 使用新的用户权限方式
-        current_user = get_current_user(x_user_id, db)
+        current_user = get_current_user(x_user_id, db, authorization)
         # 医院管理员只能查看自己机构
         if current_user.role == "hospital_admin" and not current_user.is_admin:
-            if org_name != current_user.organization:
+            if tenant_id != current_user.tenant_id:
                 raise HTTPException(status_code=403, detail="只能查看本机构统计")
     else:
         raise HTTPException(status_code=401, detail="需要管理员权限")
-    
-    # 基础统计
-    user_count = db.query(func.count(User.id)).filter(User.organization == org_name).scalar() or 0
-    active_users = db.query(func.count(User.id)).filter(
-        User.organization == org_name,
-        User.status == "active"
-    ).scalar() or 0
-    total_usage = db.query(func.sum(User.usage_used)).filter(User.organization == org_name).scalar() or 0
-    
-    # 使用事件统计
+    not_modified = _conditional(request, response, tenant_id)
+    if not_modified:
+        return not_modified
+
+    # 基础统计（物化表，按租户+机构主键读取）
+    totals = organization_totals(db, org_name, tenant_id)
+
+    # 使用事件统计：不限时间窗口时直接取物化的事件数
     def parse_dt(s):
         if not s:
             return None
@@ -1337,35 +2067,81 @@ def admin_get_organization_stats(
     sdt = parse_dt(start)
     edt = parse_dt(end)
     
-    usage_query = db.query(UsageEvent).join(User).filter(User.organization == org_name)
-    if sdt:
-        usage_query = usage_query.filter(UsageEvent.created_at >= sdt)
-    if edt:
-        usage_query = usage_query.filter(UsageEvent.created_at <= edt)
-    
-    event_count = usage_query.count()
+    if tenant_id is None or (sdt is None and edt is None):
+        event_count = totals["event_count"]
+    else:
+        # 用量事件与汇总行的 tenant_id 随用户机构维护，直接按租户索引统计，无需联表 users
+        agg = aggregate_usage(db, sdt, edt, group_by="total", tenant_id=tenant_id).get(None, {})
+        event_count = agg.get("event_count", 0)
     
     return {
         "organization": org_name,
-        "user_count": user_count,
-        "active_users": active_users,
-        "total_usage": total_usage,
+        "user_count": totals["user_count"],
+        "active_users": totals["active_users"],
+        "total_usage": totals["total_usage"],
         "event_count": event_count,
         "window": {"start": start, "end": end}
     }
 
 
+@app.post("/api/admin/organizations:reconcile-stats")
+def admin_reconcile_organization_stats(
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """按原始数据重算机构统计表（后台任务也会定期执行）"""
+    result = reconcile_org_stats(db)
+    change_versions.bump()
+    return result
+
+
+@app.get("/api/admin/tenants/{tenant_id}/stats")
+def admin_get_tenant_stats(
+    tenant_id: int,
+    request: Request,
+    response: Response,
+    x_admin_token: Optional[str] = Header(default=None),
+    x_user_id: Optional[int] = Header(default=None),
+    authorization: Optional[str] = Header(default=None),
+    db: Session = Depends(get_db),
+):
+    """租户汇总统计（含未填写机构的用户）；医院管理员只能查看本租户"""
+    if x_admin_token:
+        expected = os.getenv("ADMIN_TOKEN")
+        if not expected or x_admin_token != expected:
+            raise HTTPException(status_code=403, detail="管理员令牌无效")
+    elif x_user_id is not None or authorization:
+        scope = _user_list_scope(get_current_user(x_user_id, db, authorization))
+        if scope is not None and scope != tenant_id:
+            raise HTTPException(status_code=403, detail="只能查看本租户统计")
+    else:
+        raise HTTPException(status_code=401, detail="需要管理员权限")
+    not_modified = _conditional(request, response, tenant_id)
+    if not_modified:
+        return not_modified
+    totals = tenant_totals(db, tenant_id)
+    return {
+        "tenant_id": tenant_id,
+        "user_count": totals["user_count"],
+        "active_users": totals["active_users"],
+        "total_usage": totals["total_usage"],
+        "event_count": totals["event_count"],
+        "organizations": len(list_organizations(db, tenant_id)),
+    }
+
+
 @app.post("/api/admin/organizations/{org_name}/users")
 def admin_create_organization_user(
     org_name: str,
     payload: UserRegisterRequest,
-    current_user: User = Depends(require_hospital_admin_or_system_admin),
+    request: Request,
+    current_user: Principal = Depends(require_hospital_admin_or_system_admin),
     db: Session = Depends(get_db),
 ):
     """为指定机构创建用户"""
     # 医院管理员只能在自己的机构创建用户
     if current_user.role == "hospital_admin" and not current_user.is_admin:
-        if org_name != current_user.organization:
+        if tenant_directory.resolve(db, org_name) != current_user.tenant_id:
             raise HTTPException(status_code=403, detail="只能在本机构创建用户")
     
     # 检查邮箱是否已存在
@@ -1376,19 +2152,22 @@ def admin_create_organization_user(
     # 创建用户，强制设置机构
     user = User(
         email=payload.email,
-        password_hash=hash_password(payload.password),
+        password_hash=hash_password(payload.password, request),
         name=payload.name,
         organization=org_name,  # 强制设置为指定机构
         phone=payload.phone,
         role="user",
         usage_quota=6,  # 新创建用户默认配额为6
+        tenant_id=existing_tenant(db, org_name),
     )
     db.add(user)
     db.commit()
+    user_counts.invalidate()
+    _user_changed("created", user.id, user.tenant_id, user)
     db.refresh(user)
     
     # 创建默认订阅
-    sub = Subscription(user_id=user.id, plan="free", status="active", auto_renew=True)
+    sub = Subscription(user_id=user.id, tenant_id=user.tenant_id, plan="free", status="active", auto_renew=True)
     db.add(sub)
     db.commit()
     
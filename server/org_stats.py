@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from .db import OrganizationStats, SessionLocal, User
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# 机构 / 租户统计（物化表）
+# -----------------------------
+# organization_stats 按 (租户, 机构) 保存用户数、活跃用户数、总用量（计数器 usage_used 之和）
+# 与事件数（日汇总表 event_count 之和，口径与不限时间窗口的 aggregate_usage 相同，按用户当前所属机构归属）。
+# 触发器在用户增删改、计数器写入、日汇总写入时按差值更新对应行，批量导入与重建汇总表同样生效；
+# 用户数归零的行被删除。机构列表与机构/租户统计只读这张小表，不再随用户数增长。
+# created_at 为机构首个用户的加入时间，删除用户不回退。
+# 后台定期按原始数据重算（reconcile），修正手工改库等绕过触发器造成的偏差。
+
+# 后台重算间隔（秒），0 表示不启动后台任务
+RECONCILE_INTERVAL = int(os.getenv("ORG_STATS_RECONCILE_INTERVAL", "3600"))
+
+_FIELDS = ("user_count", "active_users", "total_usage", "event_count")
+
+_run_lock = threading.Lock()
+
+
+def _user_key(row: str) -> str:
+    return f"tenant_id = {row}.tenant_id AND organization = coalesce({row}.organization, '')"
+
+
+def _usage_of(user_id: str) -> str:
+    return f"coalesce((SELECT usage_used FROM user_usage_counters WHERE user_id = {user_id}), 0)"
+
+
+def _events_of(user_id: str) -> str:
+    return f"(SELECT coalesce(sum(event_count), 0) FROM usage_rollups_daily WHERE user_id = {user_id})"
+
+
+def _add_user(row: str) -> str:
+    return (
+        "INSERT INTO organization_stats"
+        "(tenant_id, organization, user_count, active_users, total_usage, event_count, created_at) "
+        f"VALUES ({row}.tenant_id, coalesce({row}.organization, ''), 1, {row}.status = 'active', "
+        f"{_usage_of(row + '.id')}, {_events_of(row + '.id')}, {row}.created_at) "
+        "ON CONFLICT(tenant_id, organization) DO UPDATE SET "
+        "user_count = user_count + 1, "
+        "active_users = active_users + excluded.active_users, "
+        "total_usage = total_usage + excluded.total_usage, "
+        "event_count = event_count + excluded.event_count, "
+        "created_at = min(coalesce(created_at, excluded.created_at), excluded.created_at);"
+    )
+
+
+def _remove_user(row: str) -> str:
+    return (
+        "UPDATE organization_stats SET "
+        "user_count = user_count - 1, "
+        f"active_users = active_users - ({row}.status = 'active'), "
+        f"total_usage = total_usage - {_usage_of(row + '.id')}, "
+        f"event_count = event_count - {_events_of(row + '.id')} "
+        f"WHERE {_user_key(row)}; "
+        f"DELETE FROM organization_stats WHERE {_user_key(row)} AND user_count <= 0;"
+    )
+
+
+def _shift(column: str, user_id: str, delta: str) -> str:
+    # 用户已删除（找不到所属机构）时不更新：删除用户的触发器已扣除其全部贡献
+    return (
+        f"UPDATE organization_stats SET {column} = {column} + ({delta}) "
+        f"WHERE (tenant_id, organization) = "
+        f"(SELECT tenant_id, coalesce(organization, '') FROM users WHERE id = {user_id});"
+    )
+
+
+_TRIGGERS = {
+    "org_stats_user_ai": f"AFTER INSERT ON users BEGIN {_add_user('new')} END",
+    "org_stats_user_ad": f"AFTER DELETE ON users BEGIN {_remove_user('old')} END",
+    "org_stats_user_au": (
+        "AFTER UPDATE OF tenant_id, organization, status ON users "
+        "WHEN old.tenant_id IS NOT new.tenant_id OR old.organization IS NOT new.organization "
+        "OR old.status IS NOT new.status "
+        f"BEGIN {_remove_user('old')} {_add_user('new')} END"
+    ),
+    "org_stats_counter_ai": (
+        f"AFTER INSERT ON user_usage_counters BEGIN {_shift('total_usage', 'new.user_id', 'new.usage_used')} END"
+    ),
+    "org_stats_counter_au": (
+        "AFTER UPDATE OF usage_used ON user_usage_counters WHEN new.usage_used IS NOT old.usage_used "
+        f"BEGIN {_shift('total_usage', 'new.user_id', 'new.usage_used - old.usage_used')} END"
+    ),
+    "org_stats_counter_ad": (
+        f"AFTER DELETE ON user_usage_counters BEGIN {_shift('total_usage', 'old.user_id', '-old.usage_used')} END"
+    ),
+    "org_stats_rollup_ai": (
+        f"AFTER INSERT ON usage_rollups_daily BEGIN {_shift('event_count', 'new.user_id', 'new.event_count')} END"
+    ),
+    "org_stats_rollup_au": (
+        "AFTER UPDATE OF event_count ON usage_rollups_daily WHEN new.event_count IS NOT old.event_count "
+        f"BEGIN {_shift('event_count', 'new.user_id', 'new.event_count - old.event_count')} END"
+    ),
+    "org_stats_rollup_ad": (
+        f"AFTER DELETE ON usage_rollups_daily BEGIN {_shift('event_count', 'old.user_id', '-old.event_count')} END"
+    ),
+}
+
+# 按原始数据重算全部 (租户, 机构) 的统计
+_RECOMPUTE = """
+    SELECT u.tenant_id, coalesce(u.organization, '') AS organization,
+           count(*) AS user_count,
+           sum(u.status = 'active') AS active_users,
+           sum(coalesce(c.usage_used, 0)) AS total_usage,
+           sum(coalesce(r.event_count, 0)) AS event_count,
+           min(u.created_at) AS created_at
+    FROM users u
+    LEFT JOIN user_usage_counters c ON c.user_id = u.id
+    LEFT JOIN (
+        SELECT user_id, sum(event_count) AS event_count FROM usage_rollups_daily GROUP BY user_id
+    ) r ON r.user_id = u.id
+    GROUP BY u.tenant_id, coalesce(u.organization, '')
+"""
+
+
+def ensure_org_stats(db: Session) -> None:
+    """启动时创建维护触发器；统计表为空而已有用户（旧库升级）时全量计算一次"""
+    for name, body in _TRIGGERS.items():
+        db.execute(text(f"CREATE TRIGGER IF NOT EXISTS {name} {body}"))
+    db.commit()
+    if db.query(OrganizationStats.tenant_id).first() is None and db.query(User.id).first() is not None:
+        reconcile_org_stats(db)
+
+
+def reconcile_org_stats(db: Session) -> Dict[str, int]:
+    """按原始数据重算并修正统计表，返回 {organizations, corrected}；在同一个写事务内完成"""
+    with _run_lock:
+        # 先执行写语句取得写锁，重算期间的并发写入排在本事务之后，不会丢失增量
+        db.execute(text("DELETE FROM organization_stats WHERE user_count <= 0"))
+        current: Dict[Tuple[int, str], Any] = {
+            (row.tenant_id, row.organization): row
+            for row in db.execute(text("SELECT * FROM organization_stats"))
+        }
+        corrected = 0
+        computed = db.execute(text(_RECOMPUTE)).fetchall()
+        for row in computed:
+            key = (row.tenant_id, row.organization)
+            old = current.pop(key, None)
+            # 首个用户加入时间只会更早，不因删除用户而推后
+            created_at = row.created_at if old is None or old.created_at is None else min(old.created_at, row.created_at)
+            if old is not None and created_at == old.created_at and all(
+                getattr(old, f) == (getattr(row, f) or 0) for f in _FIELDS
+            ):
+                continue
+            corrected += 1
+            db.execute(
+                text(
+                    "INSERT OR REPLACE INTO organization_stats"
+                    "(tenant_id, organization, user_count, active_users, total_usage, event_count, created_at) "
+                    "VALUES (:tenant_id, :organization, :user_count, :active_users, :total_usage, :event_count, :created_at)"
+                ),
+                {
+                    "tenant_id": row.tenant_id,
+                    "organization": row.organization,
+                    **{f: getattr(row, f) or 0 for f in _FIELDS},
+                    "created_at": created_at,
+                },
+            )
+        for tenant_id, organization in current:
+            corrected += 1
+            db.execute(
+                text("DELETE FROM organization_stats WHERE tenant_id = :tenant_id AND organization = :organization"),
+                {"tenant_id": tenant_id, "organization": organization},
+            )
+        db.commit()
+    return {"organizations": len(computed), "corrected": corrected}
+
+
+def _totals(db: Session, *filters) -> Dict[str, Any]:
+    row = db.query(
+        *(func.coalesce(func.sum(getattr(OrganizationStats, f)), 0).label(f) for f in _FIELDS),
+        func.min(OrganizationStats.created_at).label("created_at"),
+    ).filter(*filters).one()
+    return {f: int(getattr(row, f)) for f in _FIELDS} | {"created_at": row.created_at}
+
+
+def list_organizations(db: Session, tenant_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """按机构名排列的统计（同名机构跨租户时合并），不含未填写机构的用户"""
+    q = db.query(
+        OrganizationStats.organization.label("name"),
+        *(func.sum(getattr(OrganizationStats, f)).label(f) for f in _FIELDS),
+        func.min(OrganizationStats.created_at).label("created_at"),
+    ).filter(OrganizationStats.organization != "")
+    if tenant_id is not None:
+        q = q.filter(OrganizationStats.tenant_id == tenant_id)
+    rows = q.group_by(OrganizationStats.organization).order_by(OrganizationStats.organization).all()
+    return [row._asdict() for row in rows]
+
+
+def organization_totals(db: Session, organization: str, tenant_id: Optional[int]) -> Dict[str, Any]:
+    """机构统计（主键读取）；机构不存在时各项为 0"""
+    return _totals(db, OrganizationStats.tenant_id == tenant_id, OrganizationStats.organization == organization)
+
+
+def tenant_totals(db: Session, tenant_id: int) -> Dict[str, Any]:
+    """租户汇总（含未填写机构的用户）"""
+    return _totals(db, OrganizationStats.tenant_id == tenant_id)
+
+
+def _reconcile_loop(interval: int) -> None:
+    while True:
+        time.sleep(interval)
+        db = SessionLocal()
+        try:
+            result = reconcile_org_stats(db)
+            if result["corrected"]:
+                logger.info("机构统计已修正 %d 行", result["corrected"])
+        except Exception:
+            db.rollback()
+            logger.exception("机构统计重算失败")
+        finally:
+            db.close()
+
+
+def start_org_stats_worker() -> None:
+    """启动后台重算线程（ORG_STATS_RECONCILE_INTERVAL=0 时不启动）"""
+    if RECONCILE_INTERVAL <= 0:
+        return
+    threading.Thread(target=_reconcile_loop, args=(RECONCILE_INTERVAL,), daemon=True).start()
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import Query, Session
+
+from .db import User
+from .serialization import USER_KEYS, user_query
+
+
+# -----------------------------
+# 用户列表游标（keyset）分页
+# -----------------------------
+# 游标编码上一页最后一行的 (排序键, id)，下一页用 (排序键, id) > (值, id) 直接在索引上定位，
+# 不再 OFFSET 跳过前面的行，第 N 页与第 1 页代价相同。排序只允许有索引的列，
+# 且排序键后总是追加 id 作为唯一的次序键。总数按 (租户, 搜索词) 缓存 USER_COUNT_CACHE_TTL 秒，为近似值。
+
+COUNT_CACHE_TTL = float(os.getenv("USER_COUNT_CACHE_TTL", "30"))
+COUNT_CACHE_MAX = 1024
+MAX_PAGE_SIZE = 200
+
+# 排序字段 -> 列；均有 (tenant_id, 列) 或 (列) 索引，SQLite 二级索引隐含 rowid(id) 作为末列
+SORT_COLUMNS = {
+    "id": User.id,
+    "created_at": User.created_at,
+    "email": User.email,
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def sort_column(sort: str):
+    column = SORT_COLUMNS.get(sort)
+    if column is None:
+        raise ValueError(f"不支持的排序字段: {sort}（可选 {', '.join(SORT_COLUMNS)}）")
+    return column
+
+
+def _dump_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _load_value(value: Any) -> Any:
+    if isinstance(value, dict) and "dt" in value:
+        return datetime.fromisoformat(value["dt"])
+    return value
+
+
+def encode_cursor(sort: str, order: str, value: Any, last_id: int) -> str:
+    payload = json.dumps([sort, order, _dump_value(value), last_id], separators=(",", ":"), ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str, order: str) -> Tuple[Any, int]:
+    """解析游标，返回 (排序键, id)；游标须与本次请求的排序方式一致"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c_sort, c_order, value, last_id = json.loads(raw)
+        value, last_id = _load_value(value), int(last_id)
+    except Exception:
+        raise InvalidCursor("游标无效")
+    if c_sort != sort or c_order != order:
+        raise InvalidCursor("游标与排序方式不一致")
+    return value, last_id
+
+
+def keyset_page(
+    q: Query,
+    sort: str = "id",
+    order: str = "asc",
+    size: int = 20,
+    cursor: Optional[str] = None,
+    offset: int = 0,
+) -> Tuple[List[Any], Optional[str]]:
+    """按 (排序键, id) 取一页，返回 (本页行, 下一页游标)；没有更多数据时游标为 None。
+    offset 仅用于兼容旧的 page 参数，传入游标时忽略"""
+    column = sort_column(sort)
+    desc = order == "desc"
+    order = "desc" if desc else "asc"
+    size = max(1, min(MAX_PAGE_SIZE, size))
+    single = column is User.id
+    key = User.id if single else tuple_(column, User.id)
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort, order)
+        bound = last_id if single else tuple_(value, last_id)
+        q = q.filter(key < bound if desc else key > bound)
+    if single:
+        q = q.order_by(User.id.desc() if desc else User.id.asc())
+    else:
+        q = q.order_by(*((column.desc(), User.id.desc()) if desc else (column.asc(), User.id.asc())))
+    if offset and not cursor:
+        q = q.offset(offset)
+    rows = q.limit(size + 1).all()
+    if len(rows) <= size:
+        return rows, None
+    rows = rows[:size]
+    last = rows[-1]
+    return rows, encode_cursor(sort, order, getattr(last, column.key), last.id)
+
+
+def projected_user_query(db: Session, sort: str = "id", fields: Sequence[str] = USER_KEYS) -> Query:
+    """分页用的用户投影查询；排序键不在 fields 中时额外查询该列以便生成游标"""
+    column = sort_column(sort)
+    if column.key in fields:
+        return user_query(db, fields=fields)
+    return user_query(db, column, fields=fields)
+
+
+class CountCache:
+    """按查询条件缓存 COUNT 结果，过期前直接返回（近似总数）"""
+
+    def __init__(self, ttl: float = COUNT_CACHE_TTL, max_entries: int = COUNT_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, Tuple[float, int]] = {}
+
+    def get(self, key: Hashable, compute: Callable[[], int]) -> int:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None and hit[0] > now:
+                return hit[1]
+        total = compute()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = (now + self.ttl, total)
+        return total
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+# 全局实例
+user_counts = CountCache()
+
+
+def paginate_users(
+    db: Session,
+    filters: Sequence[Any],
+    count_key: Hashable,
+    sort: str = "id",
+    order: str = "asc",
+    size: int = 20,
+    cursor: Optional[str] = None,
+    offset: int = 0,
+    with_total: bool = True,
+    fields: Sequence[str] = USER_KEYS,
+) -> Dict[str, Any]:
+    """返回 {items, next_cursor, has_more, total}，items 为投影行（见 serialization.user_dicts），total 来自计数缓存"""
+    items, next_cursor = keyset_page(
+        projected_user_query(db, sort, fields).filter(*filters), sort, order, size, cursor, offset
+    )
+    page: Dict[str, Any] = {"items": items, "next_cursor": next_cursor, "has_more": next_cursor is not None}
+    if with_total:
+        page["total"] = user_counts.get(
+            count_key, lambda: db.query(func.count(User.id)).filter(*filters).scalar() or 0
+        )
+    return page
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+
+# -----------------------------
+# 密码哈希服务
+# -----------------------------
+# pbkdf2 哈希会持续占用 CPU 数十毫秒。放在请求线程池内执行既占线程又受 GIL 限制，
+# 登录高峰时会拖慢生成接口。这里把哈希/校验交给独立的进程池：
+# - 全局并发上限（排队 + 执行），等待超时返回 503，避免请求无限堆积；
+# - 单个客户端 IP 的并发上限，超出返回 429，防止个别来源占满进程池。
+# PASSWORD_HASH_WORKERS=0 时在当前线程内计算（测试/单核环境）。
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", "29000"))  # passlib 默认值
+MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(max(1, HASH_WORKERS) * 8)))
+PER_CLIENT_LIMIT = int(os.getenv("PASSWORD_HASH_PER_CLIENT", "4"))
+QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "5"))
+
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"], deprecated="auto", pbkdf2_sha256__rounds=HASH_ROUNDS
+)
+
+
+def _hash(raw: str) -> str:
+    return pwd_context.hash(raw)
+
+
+def _verify(raw: str, hashed: str) -> bool:
+    # 校验使用哈希串中记录的轮数，调整 PASSWORD_HASH_ROUNDS 不影响已有密码
+    return pwd_context.verify(raw, hashed)
+
+
+class PasswordHasher:
+    def __init__(
+        self,
+        workers: int = HASH_WORKERS,
+        max_pending: int = MAX_PENDING,
+        per_client: int = PER_CLIENT_LIMIT,
+        timeout: float = QUEUE_TIMEOUT,
+    ):
+        self.workers = workers
+        self.per_client = per_client
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, int] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _run(self, fn, *args, client: Optional[str] = None):
+        if client:
+            with self._lock:
+                if self._inflight.get(client, 0) >= self.per_client:
+                    raise HTTPException(status_code=429, detail="请求过于频繁，请稍后再试")
+                self._inflight[client] = self._inflight.get(client, 0) + 1
+        try:
+            if not self._slots.acquire(timeout=self.timeout):
+                raise HTTPException(status_code=503, detail="服务繁忙，请稍后再试")
+            try:
+                if self.workers <= 0:
+                    return fn(*args)
+                return self._executor().submit(fn, *args).result()
+            finally:
+                self._slots.release()
+        finally:
+            if client:
+                with self._lock:
+                    left = self._inflight[client] - 1
+                    if left:
+                        self._inflight[client] = left
+                    else:
+                        del self._inflight[client]
+
+    def hash(self, raw: str, client: Optional[str] = None) -> str:
+        """计算密码哈希（阻塞调用，须在线程池中执行）"""
+        return self._run(_hash, raw, client=client)
+
+    def verify(self, raw: str, hashed: str, client: Optional[str] = None) -> bool:
+        """校验密码（阻塞调用，须在线程池中执行）"""
+        return self._run(_verify, raw, hashed, client=client)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# 全局实例
+password_hasher = PasswordHasher()
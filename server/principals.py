@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .db import User
+
+
+# -----------------------------
+# 已认证用户（principal）缓存
+# -----------------------------
+# 鉴权只需要角色、租户、状态与配额等少量字段，按用户ID缓存在内存中，
+# 热点接口的权限判断不再每次查询 users 表。修改这些字段的接口须调用 invalidate；
+# TTL 兜底处理其他进程或直接改库造成的变更。
+
+PRINCIPAL_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_MAX = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    id: int
+    tenant_id: Optional[int]
+    role: str
+    status: str
+    is_admin: bool
+    organization: Optional[str]
+    # 由会话令牌还原的 principal 不含配额，配额检查须走缓存查询
+    usage_quota: Optional[int] = None
+    daily_quota: Optional[int] = None
+
+
+_COLUMNS = (
+    User.id,
+    User.tenant_id,
+    User.role,
+    User.status,
+    User.is_admin,
+    User.organization,
+    User.usage_quota,
+    User.daily_quota,
+)
+
+
+class PrincipalCache:
+    def __init__(self, ttl: float = PRINCIPAL_TTL, max_entries: int = PRINCIPAL_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Tuple[float, Principal]]" = OrderedDict()
+        self._generation = 0
+
+    def get(self, db: Session, user_id: int) -> Optional[Principal]:
+        """按用户ID取 principal，未命中或过期时只查询鉴权所需的列"""
+        now = time.monotonic()
+        with self._lock:
+            hit = self._entries.get(user_id)
+            if hit is not None and hit[0] > now:
+                self._entries.move_to_end(user_id)
+                return hit[1]
+            generation = self._generation
+        row = db.query(*_COLUMNS).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        principal = Principal(
+            id=row.id,
+            tenant_id=row.tenant_id,
+            role=row.role or "user",
+            status=row.status or "active",
+            is_admin=bool(row.is_admin),
+            organization=row.organization,
+            usage_quota=row.usage_quota,
+            daily_quota=row.daily_quota,
+        )
+        with self._lock:
+            # 查询期间发生过失效时不回填，避免写回旧数据
+            if generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, principal)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_ids: Optional[Iterable[int]] = None) -> None:
+        """使指定用户（为空时为全部）的缓存失效"""
+        with self._lock:
+            self._generation += 1
+            if user_ids is None:
+                self._entries.clear()
+                return
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+
+# 全局实例
+principal_cache = PrincipalCache()
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import distinct
+from sqlalchemy.orm import Session
+
+from .db import DB_PATH, SessionLocal, Tenant, UsageEvent
+from .rollups import to_naive_utc
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# 用量事件保留策略与冷归档
+# -----------------------------
+# 超过热数据窗口的事件按 租户/日期 分区导出为 gzip NDJSON，再以小批次事务删除，
+# 每个批次只短暂持有 SQLite 写锁。用量汇总表不受清理影响，看板统计保持完整。
+
+ARCHIVE_DIR = os.getenv("USAGE_ARCHIVE_DIR", os.path.join(os.path.dirname(DB_PATH), "archive"))
+DEFAULT_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "180"))
+PURGE_CHUNK_SIZE = int(os.getenv("USAGE_PURGE_CHUNK_SIZE", "500"))
+# 批次之间让出写锁的间隔（秒）
+PURGE_CHUNK_PAUSE = float(os.getenv("USAGE_PURGE_CHUNK_PAUSE", "0.05"))
+# 后台清理间隔（秒），0 表示不启动后台任务
+RETENTION_INTERVAL = int(os.getenv("USAGE_RETENTION_INTERVAL", "3600"))
+
+_run_lock = threading.Lock()
+
+
+def archive_path(tenant_id: int, day: date) -> str:
+    """归档文件路径：archive/tenant_<id>/<YYYY>/<MM>/usage_events-<YYYY-MM-DD>.ndjson.gz"""
+    return os.path.join(
+        ARCHIVE_DIR,
+        f"tenant_{tenant_id}",
+        f"{day.year:04d}",
+        f"{day.month:02d}",
+        f"usage_events-{day.isoformat()}.ndjson.gz",
+    )
+
+
+def event_to_dict(evt: UsageEvent) -> Dict[str, Any]:
+    created_at = to_naive_utc(evt.created_at)
+    return {
+        "id": evt.id,
+        "tenant_id": evt.tenant_id,
+        "user_id": evt.user_id,
+        "event_type": evt.event_type,
+        "created_at": created_at.isoformat() if created_at else None,
+        "tokens_used": evt.tokens_used,
+        "latency_ms": evt.latency_ms,
+        "meta": evt.meta,
+    }
+
+
+def retention_days_for(db: Session) -> Dict[int, int]:
+    """各租户的保留天数（未配置的租户使用全局默认值）"""
+    configured = {
+        t.id: t.retention_days
+        for t in db.query(Tenant.id, Tenant.retention_days).all()
+        if t.retention_days is not None
+    }
+    tenant_ids = [row[0] for row in db.query(distinct(UsageEvent.tenant_id)).all()]
+    return {tid: configured.get(tid, DEFAULT_RETENTION_DAYS) for tid in tenant_ids}
+
+
+def _append_archive(rows: List[Dict[str, Any]]) -> None:
+    """按 (租户, 日期) 分组追加写入归档；每次追加生成一个新的 gzip member"""
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        day = datetime.fromisoformat(row["created_at"]).date()
+        groups.setdefault(archive_path(row["tenant_id"], day), []).append(row)
+    for path, items in groups.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, "ab") as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileobj.fileno())
+
+
+def purge_tenant(
+    db: Session,
+    tenant_id: int,
+    cutoff: datetime,
+    chunk_size: int = PURGE_CHUNK_SIZE,
+) -> int:
+    """归档并删除某租户 cutoff 之前的事件，返回处理条数
+
+    先写归档再删除；若中途失败，重跑可能产生重复归档行，读取归档时按事件 id 去重。
+    """
+    cutoff = to_naive_utc(cutoff)
+    purged = 0
+    while True:
+        chunk = (
+            db.query(UsageEvent)
+            .filter(UsageEvent.tenant_id == tenant_id, UsageEvent.created_at < cutoff)
+            .order_by(UsageEvent.created_at.asc(), UsageEvent.id.asc())
+            .limit(chunk_size)
+            .all()
+        )
+        if not chunk:
+            break
+        rows = [event_to_dict(evt) for evt in chunk]
+        _append_archive(rows)
+        ids = [row["id"] for row in rows]
+        try:
+            db.query(UsageEvent).filter(UsageEvent.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        db.expunge_all()
+        purged += len(ids)
+        if len(chunk) < chunk_size:
+            break
+        if PURGE_CHUNK_PAUSE > 0:
+            time.sleep(PURGE_CHUNK_PAUSE)
+    return purged
+
+
+def run_retention(db: Session, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """对所有租户执行一次保留策略"""
+    now = to_naive_utc(now or datetime.utcnow())
+    if not _run_lock.acquire(blocking=False):
+        return {"status": "running", "tenants": {}}
+    try:
+        result: Dict[str, Any] = {"status": "ok", "tenants": {}}
+        for tenant_id, days in retention_days_for(db).items():
+            cutoff = now - timedelta(days=days)
+            purged = purge_tenant(db, tenant_id, cutoff)
+            result["tenants"][tenant_id] = {
+                "retention_days": days,
+                "cutoff": cutoff.isoformat(),
+                "archived": purged,
+            }
+        return result
+    finally:
+        _run_lock.release()
+
+
+def _archive_days(
+    tenant_id: Optional[int], start: Optional[datetime], end: Optional[datetime]
+) -> Iterator[Tuple[date, str]]:
+    """列出时间范围内存在的归档文件 (日期, 路径)"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    if tenant_id is not None:
+        tenant_dirs = [f"tenant_{tenant_id}"]
+    else:
+        tenant_dirs = sorted(d for d in os.listdir(ARCHIVE_DIR) if d.startswith("tenant_"))
+    first = start.date() if start else None
+    last = end.date() if end else None
+    for tenant_dir in tenant_dirs:
+        root = os.path.join(ARCHIVE_DIR, tenant_dir)
+        for dirpath, _, filenames in os.walk(root):
+            for name in sorted(filenames):
+                if not (name.startswith("usage_events-") and name.endswith(".ndjson.gz")):
+                    continue
+                day = date.fromisoformat(name[len("usage_events-"):-len(".ndjson.gz")])
+                if (first and day < first) or (last and day > last):
+                    continue
+                yield day, os.path.join(dirpath, name)
+
+
+def _read_archive(path: str) -> Iterator[Dict[str, Any]]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _paths_by_day(
+    tenant_id: Optional[int], start: Optional[datetime], end: Optional[datetime]
+) -> List[Tuple[date, List[str]]]:
+    """范围内的归档文件按日期升序分组（同一天可能有多个租户的文件）"""
+    by_day: Dict[date, List[str]] = {}
+    for day, path in _archive_days(tenant_id, start, end):
+        by_day.setdefault(day, []).append(path)
+    return sorted(by_day.items())
+
+
+def iter_archive_by_day() -> Iterator[Tuple[date, List[Dict[str, Any]]]]:
+    """按日期升序遍历全部归档，同一天跨租户合并并按 id 去重，用于重建派生存储"""
+    for day, paths in _paths_by_day(None, None, None):
+        rows: Dict[int, Dict[str, Any]] = {}
+        for path in paths:
+            for row in _read_archive(path):
+                rows[row["id"]] = row
+        yield day, list(rows.values())
+
+
+def _event_key(row: Dict[str, Any]) -> Tuple[datetime, int]:
+    return datetime.fromisoformat(row["created_at"]), row["id"]
+
+
+def _archived_rows(
+    tenant_id: Optional[int], user_id: Optional[int], start: Optional[datetime], end: Optional[datetime]
+) -> Iterator[Dict[str, Any]]:
+    """逐日读取范围内的归档事件，按 (时间, id) 升序产出；内存中只保留一天的数据"""
+    for _, paths in _paths_by_day(tenant_id, start, end):
+        rows: Dict[int, Dict[str, Any]] = {}
+        for path in paths:
+            for row in _read_archive(path):
+                created_at = datetime.fromisoformat(row["created_at"])
+                if (start and created_at < start) or (end and created_at > end):
+                    continue
+                if user_id is not None and row["user_id"] != user_id:
+                    continue
+                rows[row["id"]] = row
+        yield from sorted(rows.values(), key=_event_key)
+
+
+def query_events(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    tenant_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    limit: int = 1000,
+) -> Dict[str, Any]:
+    """跨热数据与冷归档查询事件明细，按时间升序，按事件 id 去重。
+    归档逐日读取、热数据分批读取，两路按时间归并，取满 limit 条即停止"""
+    start = to_naive_utc(start)
+    end = to_naive_utc(end)
+
+    q = db.query(UsageEvent)
+    if tenant_id is not None:
+        q = q.filter(UsageEvent.tenant_id == tenant_id)
+    if user_id is not None:
+        q = q.filter(UsageEvent.user_id == user_id)
+    if start:
+        q = q.filter(UsageEvent.created_at >= start)
+    if end:
+        q = q.filter(UsageEvent.created_at <= end)
+    hot_rows = (
+        (event_to_dict(evt), "hot")
+        for evt in q.order_by(UsageEvent.created_at.asc(), UsageEvent.id.asc()).yield_per(max(1, min(limit + 1, 1000)))
+    )
+    archived_rows = ((row, "archived") for row in _archived_rows(tenant_id, user_id, start, end))
+
+    items: List[Dict[str, Any]] = []
+    counts = {"hot": 0, "archived": 0}
+    truncated = False
+    prev = None
+    # 清理中断时同一事件可能同时存在于归档与热数据，归并后二者相邻，以热数据为准
+    for row, source in heapq.merge(hot_rows, archived_rows, key=lambda item: _event_key(item[0])):
+        if row["id"] == prev:
+            continue
+        prev = row["id"]
+        if len(items) == limit:
+            truncated = True
+            break
+        items.append(row)
+        counts[source] += 1
+    return {"items": items, "hot": counts["hot"], "archived": counts["archived"], "truncated": truncated}
+
+
+def _retention_loop(interval: int) -> None:
+    while True:
+        time.sleep(interval)
+        db = SessionLocal()
+        try:
+            run_retention(db)
+        except Exception:
+            logger.exception("用量事件清理失败")
+        finally:
+            db.close()
+
+
+def start_retention_worker() -> None:
+    """启动后台清理线程（USAGE_RETENTION_INTERVAL=0 时不启动）"""
+    if RETENTION_INTERVAL <= 0:
+        return
+    threading.Thread(target=_retention_loop, args=(RETENTION_INTERVAL,), daemon=True).start()
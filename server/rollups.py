@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, literal, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .db import UsageEvent, UsageRollupDaily, UsageRollupHourly
+
+
+# -----------------------------
+# 用量汇总（rollup）维护与查询
+# -----------------------------
+# usage_events 只追加，汇总表按小时/天聚合 (tenant_id, user_id) 的次数、token 与延迟之和。
+# 查询时将时间窗口拆成「整天 → 日表、整小时 → 小时表、不足一小时的边缘 → 原始事件」，
+# 结果与直接扫描 usage_events 完全一致，而扫描量只与桶数相关。
+# 边缘切片若早于保留期（事件已归档清理），只能统计到仍在热数据中的事件。
+
+_AGG_FIELDS = ("event_count", "tokens_sum", "latency_sum", "latency_count")
+
+
+def to_naive_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    """统一转为不带时区的UTC时间（SQLite中时间按UTC字符串存储）"""
+    if dt is None:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def hour_bucket(dt: datetime) -> datetime:
+    return to_naive_utc(dt).replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil_hour(dt: datetime) -> datetime:
+    floor = dt.replace(minute=0, second=0, microsecond=0)
+    return floor if floor == dt else floor + timedelta(hours=1)
+
+
+def _ceil_day(dt: datetime) -> datetime:
+    floor = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return floor if floor == dt else floor + timedelta(days=1)
+
+
+def _floor_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def apply_event(
+    db: Session,
+    tenant_id: int,
+    user_id: int,
+    created_at: datetime,
+    tokens_used: Optional[int] = None,
+    latency_ms: Optional[int] = None,
+) -> None:
+    """将一条用量事件增量累加到小时表与日表（与事件写入处于同一事务，不提交）"""
+    hour = hour_bucket(created_at)
+    values = {
+        "event_count": 1,
+        "tokens_sum": tokens_used or 0,
+        "latency_sum": latency_ms or 0,
+        "latency_count": 1 if latency_ms is not None else 0,
+    }
+    _add(db, UsageRollupHourly, hour, tenant_id, user_id, values)
+    _add(db, UsageRollupDaily, hour.date(), tenant_id, user_id, values)
+
+
+def _add(db: Session, model, bucket: Any, tenant_id: int, user_id: int, values: Dict[str, int]) -> None:
+    """把聚合值累加到汇总表的一个桶（UPSERT）"""
+    tbl = model.__table__
+    stmt = sqlite_insert(tbl).values(bucket=bucket, tenant_id=tenant_id, user_id=user_id, **values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tbl.c.bucket, tbl.c.tenant_id, tbl.c.user_id],
+        set_={f: tbl.c[f] + stmt.excluded[f] for f in _AGG_FIELDS},
+    )
+    db.execute(stmt)
+
+
+def _fold_archived_day(db: Session, rows: List[Dict[str, Any]], chunk: int = 500) -> None:
+    """把一天的归档事件累加到汇总表；仍在 usage_events 中的事件（清理中断）已由 SQL 统计过，跳过"""
+    ids = [row["id"] for row in rows]
+    hot = set()
+    for i in range(0, len(ids), chunk):
+        hot.update(r[0] for r in db.query(UsageEvent.id).filter(UsageEvent.id.in_(ids[i:i + chunk])))
+    buckets: Dict[Tuple[Any, Any, int, int], List[int]] = {}
+    for row in rows:
+        if row["id"] in hot:
+            continue
+        hour = hour_bucket(datetime.fromisoformat(row["created_at"]))
+        latency = row.get("latency_ms")
+        delta = (1, row.get("tokens_used") or 0, latency or 0, 1 if latency is not None else 0)
+        for model, bucket in ((UsageRollupHourly, hour), (UsageRollupDaily, hour.date())):
+            acc = buckets.setdefault((model, bucket, row["tenant_id"], row["user_id"]), [0, 0, 0, 0])
+            for i, v in enumerate(delta):
+                acc[i] += v
+    for (model, bucket, tenant_id, user_id), acc in buckets.items():
+        _add(db, model, bucket, tenant_id, user_id, dict(zip(_AGG_FIELDS, acc)))
+
+
+def backfill_rollups(
+    db: Session, archived: Iterable[Tuple[date, List[Dict[str, Any]]]] = ()
+) -> Dict[str, int]:
+    """根据 usage_events 与冷归档全量重建汇总表（单事务内完成，期间写入会被 SQLite 写锁串行化）
+
+    archived 为按日期遍历的归档事件（retention.iter_archive_by_day）；不传时已归档清理的历史将从汇总表中消失。
+    """
+    latency_count = "SUM(CASE WHEN latency_ms IS NULL THEN 0 ELSE 1 END)"
+    aggregates = (
+        "COUNT(*), COALESCE(SUM(tokens_used), 0), COALESCE(SUM(latency_ms), 0), " + latency_count
+    )
+    columns = "bucket, tenant_id, user_id, event_count, tokens_sum, latency_sum, latency_count"
+    try:
+        db.execute(text("DELETE FROM usage_rollups_hourly"))
+        db.execute(text("DELETE FROM usage_rollups_daily"))
+        db.execute(text(
+            f"INSERT INTO usage_rollups_hourly ({columns}) "
+            f"SELECT strftime('%Y-%m-%d %H:00:00.000000', created_at) AS b, tenant_id, user_id, {aggregates} "
+            "FROM usage_events GROUP BY b, tenant_id, user_id"
+        ))
+        db.execute(text(
+            f"INSERT INTO usage_rollups_daily ({columns}) "
+            f"SELECT date(created_at) AS b, tenant_id, user_id, {aggregates} "
+            "FROM usage_events GROUP BY b, tenant_id, user_id"
+        ))
+        for _, rows in archived:
+            _fold_archived_day(db, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    hourly = db.query(func.count()).select_from(UsageRollupHourly).scalar() or 0
+    daily = db.query(func.count()).select_from(UsageRollupDaily).scalar() or 0
+    return {"hourly_buckets": hourly, "daily_buckets": daily}
+
+
+def ensure_rollups(db: Session, archived: Iterable[Tuple[date, List[Dict[str, Any]]]] = ()) -> None:
+    """启动时检查：已有事件但汇总表为空（旧库升级）时执行一次回填"""
+    has_rollups = db.query(UsageRollupDaily.bucket).first()
+    has_events = db.query(UsageEvent.id).first()
+    if has_events and not has_rollups:
+        backfill_rollups(db, archived)
+
+
+def plan_window(
+    start: Optional[datetime], end: Optional[datetime]
+) -> List[Tuple[str, Any, Any]]:
+    """把 [start, end] 拆分为若干段：("raw", lo, hi) / ("hourly", lo, hi) / ("daily", lo, hi)
+
+    raw 段为闭区间的边缘切片，hourly/daily 段为左闭右开的桶区间；None 表示不限。
+    """
+    start = to_naive_utc(start)
+    end = to_naive_utc(end)
+    if start is not None and end is not None:
+        if start > end:
+            return []
+        if _ceil_hour(start) > end.replace(minute=0, second=0, microsecond=0):
+            # 窗口落在同一小时内，直接扫原始事件
+            return [("raw", start, end)]
+
+    segments: List[Tuple[str, Any, Any]] = []
+    h_lo = _ceil_hour(start) if start is not None else None
+    h_hi = end.replace(minute=0, second=0, microsecond=0) if end is not None else None
+    if start is not None and start < h_lo:
+        segments.append(("raw", start, h_lo - timedelta(microseconds=1)))
+
+    d_lo = _ceil_day(h_lo) if h_lo is not None else None
+    d_hi = _floor_day(h_hi) if h_hi is not None else None
+    if d_lo is None or d_hi is None or d_lo <= d_hi:
+        if h_lo is not None and h_lo < d_lo:
+            segments.append(("hourly", h_lo, d_lo))
+        segments.append(("daily", d_lo.date() if d_lo else None, d_hi.date() if d_hi else None))
+        if h_hi is not None and d_hi < h_hi:
+            segments.append(("hourly", d_hi, h_hi))
+    elif h_lo < h_hi:
+        segments.append(("hourly", h_lo, h_hi))
+
+    if end is not None:
+        segments.append(("raw", h_hi, end))
+    return segments
+
+
+def _segment_query(db: Session, kind: str, lo: Any, hi: Any, group_by: str):
+    if kind == "raw":
+        ts = UsageEvent.created_at
+        day = func.date(UsageEvent.created_at)
+        cols = [
+            func.count(UsageEvent.id),
+            func.coalesce(func.sum(UsageEvent.tokens_used), 0),
+            func.coalesce(func.sum(UsageEvent.latency_ms), 0),
+            func.count(UsageEvent.latency_ms),
+        ]
+        tenant_col, user_col = UsageEvent.tenant_id, UsageEvent.user_id
+    else:
+        model = UsageRollupHourly if kind == "hourly" else UsageRollupDaily
+        ts = model.bucket
+        day = func.date(model.bucket) if kind == "hourly" else model.bucket
+        cols = [func.sum(getattr(model, f)) for f in _AGG_FIELDS]
+        tenant_col, user_col = model.tenant_id, model.user_id
+
+    key = {"total": literal(None), "user": user_col, "day": day}[group_by]
+    q = db.query(key.label("key"), *cols)
+    if lo is not None:
+        q = q.filter(ts >= lo)
+    if hi is not None:
+        q = q.filter(ts <= hi if kind == "raw" else ts < hi)
+    return q, tenant_col, user_col
+
+
+def aggregate_usage(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    group_by: str = "total",
+    tenant_id: Optional[int] = None,
+    user_ids=None,
+) -> Dict[Any, Dict[str, int]]:
+    """按时间窗口聚合用量，group_by 取 total/user/day；user_ids 可为列表或子查询"""
+    result: Dict[Any, Dict[str, int]] = {}
+    for kind, lo, hi in plan_window(start, end):
+        q, tenant_col, user_col = _segment_query(db, kind, lo, hi, group_by)
+        if tenant_id is not None:
+            q = q.filter(tenant_col == tenant_id)
+        if user_ids is not None:
+            q = q.filter(user_col.in_(user_ids))
+        if group_by != "total":
+            q = q.group_by("key")
+        for row in q.all():
+            if not row[1]:
+                continue
+            key = row[0]
+            if isinstance(key, date):
+                key = key.isoformat()
+            acc = result.setdefault(key, dict.fromkeys(_AGG_FIELDS, 0))
+            for f, v in zip(_AGG_FIELDS, row[1:]):
+                acc[f] += int(v or 0)
+    return result
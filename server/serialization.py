@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import orjson
+from fastapi import Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import func
+from sqlalchemy.orm import Query, Session
+
+from .db import User, UserUsageCounter
+
+
+# -----------------------------
+# 大列表的快速序列化
+# -----------------------------
+# 列表接口原先返回 ORM 对象，由 response_model 逐行 from_attributes 校验后再用标准库 json 编码，
+# 大租户下序列化占了大部分耗时。这里直接查询所需的列（计数器 LEFT JOIN 一并取出），
+# 按预先确定的字段顺序把行元组拼成 dict，再由 orjson 一次编码，不再构造 ORM 对象与 Pydantic 模型。
+# 输出与 UserResponse 的 JSON 完全一致；接口保留 response_model 仅用于生成 OpenAPI 文档。
+# 列表接口支持 fields=id,name,usage_used 只返回部分字段：字段列表直接决定 SELECT 的列，
+# 不需要计数器字段时也不再 JOIN 计数器表，数据库读取量与响应体都随字段数缩小。
+
+_counter = UserUsageCounter.__table__.c
+
+# 输出字段 -> 列表达式，顺序与 UserResponse 一致
+USER_FIELDS: Dict[str, Any] = {
+    "id": User.id,
+    "email": User.email,
+    "name": User.name,
+    "organization": User.organization,
+    "phone": User.phone,
+    "is_admin": User.is_admin,
+    "usage_quota": User.usage_quota,
+    "usage_used": func.coalesce(_counter.usage_used, 0),
+    "daily_quota": User.daily_quota,
+    "daily_used": func.coalesce(_counter.daily_used, 0),
+    "daily_reset_at": _counter.daily_reset_at,
+    "status": User.status,
+    "role": User.role,
+}
+
+USER_KEYS = tuple(USER_FIELDS)
+
+_COUNTER_KEYS = frozenset({"usage_used", "daily_used", "daily_reset_at"})
+
+_USER_COLUMNS = {key: column.label(key) for key, column in USER_FIELDS.items()}
+
+
+def parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    """解析逗号分隔的字段列表，按 USER_FIELDS 的顺序返回；id 总是包含。未指定时为全部字段"""
+    if fields is None or not fields.strip():
+        return USER_KEYS
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - USER_FIELDS.keys()
+    if unknown:
+        raise ValueError(f"不支持的字段: {', '.join(sorted(unknown))}（可选 {', '.join(USER_KEYS)}）")
+    requested.add("id")
+    return tuple(key for key in USER_KEYS if key in requested)
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"无法序列化类型 {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """orjson 编码；datetime/date 输出 ISO 格式，与 Pydantic 的 JSON 模式一致"""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(JSONResponse):
+    """orjson 编码的 JSON 响应"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def fast_response(content: Any, response: Optional[Response] = None, status_code: int = 200) -> FastJSONResponse:
+    """直接返回 FastJSONResponse（跳过 response_model 校验）；
+    带上依赖注入的 response 上已设置的响应头（ETag、X-Next-Cursor 等）"""
+    headers = None
+    if response is not None:
+        headers = {k: v for k, v in response.headers.items() if k not in ("content-length", "content-type")}
+    return FastJSONResponse(content, status_code=status_code, headers=headers)
+
+
+def user_query(db: Session, *extra: Any, fields: Sequence[str] = USER_KEYS) -> Query:
+    """只查询 fields 对应列的用户查询（不加载 ORM 对象），只有需要计数器字段时才 JOIN 计数器表；
+    extra 为额外需要的列（如游标排序键），不出现在输出中"""
+    q = db.query(*(_USER_COLUMNS[key] for key in fields), *extra)
+    if _COUNTER_KEYS.intersection(fields):
+        q = q.outerjoin(UserUsageCounter.__table__, _counter.user_id == User.id)
+    return q
+
+
+def user_dicts(rows: Iterable[Sequence[Any]], keys: Sequence[str] = USER_KEYS) -> List[Dict[str, Any]]:
+    """投影查询的行 -> dict；行中多出的列（extra）被忽略"""
+    return [dict(zip(keys, row)) for row in rows]
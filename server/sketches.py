@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import zlib
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# -----------------------------
+# 概率数据结构（近似统计）
+# -----------------------------
+
+
+def hash64(value) -> int:
+    """稳定的64位哈希（跨进程一致，不受 PYTHONHASHSEED 影响）"""
+    return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计：可合并，标准误差约 1.04/sqrt(2^p)"""
+
+    def __init__(self, p: int = 12, registers: Optional[bytes] = None):
+        if not 4 <= p <= 16:
+            raise ValueError("p 需在 4~16 之间")
+        self.p = p
+        self.m = 1 << p
+        if registers is not None and len(registers) != self.m:
+            raise ValueError("寄存器长度与精度不匹配")
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, value) -> bool:
+        """加入一个元素，寄存器发生变化时返回 True"""
+        h = hash64(value)
+        idx = h >> (64 - self.p)
+        rest = (h << self.p) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.p + 1 if rest == 0 else 65 - rest.bit_length()
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """原地合并另一个相同精度的 sketch（并集）"""
+        if other.p != self.p:
+            raise ValueError("只能合并相同精度的 HyperLogLog")
+        merged = np.maximum(np.frombuffer(self.registers, dtype=np.uint8), np.frombuffer(other.registers, dtype=np.uint8))
+        self.registers = bytearray(merged.tobytes())
+        return self
+
+    def estimate(self) -> float:
+        m = self.m
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        total = float(np.ldexp(1.0, -np.frombuffer(self.registers, dtype=np.uint8).astype(np.int32)).sum())
+        raw = alpha * m * m / total
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # 小基数修正：线性计数
+            return m * math.log(m / zeros)
+        return raw
+
+    def to_bytes(self) -> bytes:
+        """压缩序列化（小租户寄存器大多为0，压缩后通常只有几十字节）"""
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes, p: int = 12) -> "HyperLogLog":
+        return cls(p, zlib.decompress(data))
+
+    @classmethod
+    def union(cls, sketches: Iterable["HyperLogLog"], p: int = 12) -> "HyperLogLog":
+        stacked = [np.frombuffer(s.registers, dtype=np.uint8) for s in sketches if s.p == p]
+        if not stacked:
+            return cls(p)
+        return cls(p, np.maximum.reduce(stacked).tobytes())
+
+
+class SpaceSaving:
+    """Space-Saving 频繁项统计：最多保留 capacity 个计数器，
+    任一元素的计数高估不超过总量/capacity，真实值落在 [count - error, count] 内"""
+
+    def __init__(self, capacity: int = 256):
+        if capacity < 1:
+            raise ValueError("capacity 必须大于0")
+        self.capacity = capacity
+        self.counts: Dict[Hashable, int] = {}
+        self.errors: Dict[Hashable, int] = {}
+        self.total = 0
+
+    def add(self, item: Hashable, weight: int = 1) -> None:
+        self.total += weight
+        if item in self.counts:
+            self.counts[item] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = weight
+            self.errors[item] = 0
+            return
+        # 替换当前最小的计数器，新元素继承其计数作为误差上界
+        victim = min(self.counts, key=self.counts.__getitem__)
+        floor = self.counts.pop(victim)
+        self.errors.pop(victim)
+        self.counts[item] = floor + weight
+        self.errors[item] = floor
+
+    @property
+    def floor(self) -> int:
+        """未被跟踪元素的计数上界"""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    @classmethod
+    def merge_top(cls, summaries: Sequence["SpaceSaving"], k: int) -> List[Tuple[Hashable, int, int]]:
+        """合并多个 summary 并返回前 k 项 (item, 计数上界, 误差)，按上界降序"""
+        floors = [s.floor for s in summaries]
+        candidates = set()
+        for s in summaries:
+            candidates.update(s.counts)
+        ranked = []
+        for item in candidates:
+            upper = lower = 0
+            for s, floor in zip(summaries, floors):
+                if item in s.counts:
+                    upper += s.counts[item]
+                    lower += s.counts[item] - s.errors[item]
+                else:
+                    upper += floor
+            ranked.append((item, upper, upper - lower))
+        ranked.sort(key=lambda r: (-r[1], r[2], r[0]))
+        return ranked[:k]
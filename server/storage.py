@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+# -----------------------------
+# SQLite 存储配置（PRAGMA profile）
+# -----------------------------
+# 通过 APP_DB_PROFILE 选择一组 PRAGMA，在连接池每次新建连接时（engine connect 事件）执行。
+# 默认 balanced：WAL 模式下读不阻塞写、写不阻塞读，用量计数写入不再让用户列表等读请求排队；
+# synchronous=NORMAL 在 WAL 下断电最多丢失最近提交的事务，不会损坏数据库。
+# cache_size 与 mmap_size 是每个连接的设置，因此同时改用 QueuePool 复用连接（legacy 仍为每次会话新建连接）。
+# APP_DB_PRAGMAS 可逐项覆盖，如 "cache_size=-65536,mmap_size=0"。
+# 配置名与取值在导入时校验，启动时再读回实际生效的值核对（verify），不一致则拒绝启动。
+
+DEFAULT_PROFILE = "balanced"
+MAX_OVERFLOW = 32
+
+# 按执行顺序排列；journal_mode 须在任何事务之前设置
+PRAGMA_NAMES = ("journal_mode", "synchronous", "busy_timeout", "cache_size", "mmap_size", "temp_store")
+
+_JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+_SYNCHRONOUS = {"OFF": 0, "NORMAL": 1, "FULL": 2, "EXTRA": 3}
+_TEMP_STORE = {"DEFAULT": 0, "FILE": 1, "MEMORY": 2}
+
+
+@dataclass(frozen=True)
+class StorageProfile:
+    name: str
+    description: str
+    pragmas: Mapping[str, Any] = field(default_factory=dict)
+    pool_size: int = 8  # 0 表示不复用连接（NullPool）
+
+    @property
+    def wal(self) -> bool:
+        return self.pragmas.get("journal_mode") == "WAL"
+
+
+def _level(value: Any, names: Mapping[str, int], pragma: str) -> int:
+    if isinstance(value, str) and value.strip().upper() in names:
+        return names[value.strip().upper()]
+    try:
+        level = int(value)
+    except (TypeError, ValueError):
+        level = -1
+    if level not in names.values():
+        raise ValueError(f"PRAGMA {pragma} 取值无效: {value}（可选 {', '.join(names)}）")
+    return level
+
+
+def normalize_pragma(name: str, value: Any) -> Any:
+    """校验并规范化 PRAGMA 取值：journal_mode 为大写字符串，其余为整数"""
+    if name == "journal_mode":
+        mode = str(value).strip().upper()
+        if mode not in _JOURNAL_MODES:
+            raise ValueError(f"PRAGMA journal_mode 取值无效: {value}（可选 {', '.join(_JOURNAL_MODES)}）")
+        return mode
+    if name == "synchronous":
+        return _level(value, _SYNCHRONOUS, name)
+    if name == "temp_store":
+        return _level(value, _TEMP_STORE, name)
+    if name not in PRAGMA_NAMES:
+        raise ValueError(f"不支持的 PRAGMA: {name}（可选 {', '.join(PRAGMA_NAMES)}）")
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"PRAGMA {name} 须为整数: {value}")
+    if number < 0 and name != "cache_size":
+        raise ValueError(f"PRAGMA {name} 不能为负数: {value}")
+    return number
+
+
+def _wal(synchronous: str, busy_timeout: int, cache_kib: int, mmap_mib: int) -> Dict[str, Any]:
+    return {
+        "journal_mode": "WAL",
+        "synchronous": _SYNCHRONOUS[synchronous],
+        "busy_timeout": busy_timeout,
+        "cache_size": -cache_kib,  # 负数表示 KiB
+        "mmap_size": mmap_mib * 1024 * 1024,
+        "temp_store": _TEMP_STORE["MEMORY"],
+    }
+
+
+PROFILES: Dict[str, StorageProfile] = {
+    profile.name: profile
+    for profile in (
+        StorageProfile("legacy", "SQLite 默认设置（回滚日志、每次会话新建连接），用于对比与排查", {}, pool_size=0),
+        StorageProfile("balanced", "WAL + synchronous=NORMAL，适合单机生产部署", _wal("NORMAL", 5000, 16384, 256)),
+        StorageProfile("durable", "WAL + synchronous=FULL，每次提交都落盘", _wal("FULL", 10000, 16384, 256)),
+        StorageProfile(
+            "fast", "WAL + synchronous=OFF，仅用于测试、演示与临时库（崩溃或断电可能损坏数据库）",
+            _wal("OFF", 5000, 65536, 1024), pool_size=4,
+        ),
+    )
+}
+
+
+def parse_overrides(text: Optional[str]) -> Dict[str, Any]:
+    """解析 "name=value,name=value" 形式的 PRAGMA 覆盖项"""
+    overrides: Dict[str, Any] = {}
+    for item in (text or "").split(","):
+        if not item.strip():
+            continue
+        name, sep, value = item.partition("=")
+        name = name.strip().lower()
+        if not sep or not value.strip():
+            raise ValueError(f"APP_DB_PRAGMAS 格式应为 name=value: {item.strip()}")
+        overrides[name] = normalize_pragma(name, value.strip())
+    return overrides
+
+
+def load_profile(
+    name: Optional[str] = None, overrides: Optional[str] = None, pool_size: Optional[str] = None
+) -> StorageProfile:
+    """按名称（默认读 APP_DB_PROFILE）取配置并应用 APP_DB_PRAGMAS / APP_DB_POOL_SIZE 覆盖；取值无效时抛出 ValueError"""
+    name = (name if name is not None else os.getenv("APP_DB_PROFILE", DEFAULT_PROFILE)).strip().lower()
+    profile = PROFILES.get(name)
+    if profile is None:
+        raise ValueError(f"未知的 APP_DB_PROFILE: {name}（可选 {', '.join(PROFILES)}）")
+    pragmas = {**profile.pragmas, **parse_overrides(overrides if overrides is not None else os.getenv("APP_DB_PRAGMAS"))}
+    size = pool_size if pool_size is not None else os.getenv("APP_DB_POOL_SIZE")
+    if size is not None and size.strip():
+        if not size.strip().isdigit():
+            raise ValueError(f"APP_DB_POOL_SIZE 须为非负整数: {size}")
+        pool = int(size)
+    else:
+        pool = profile.pool_size
+    pragmas = {k: pragmas[k] for k in PRAGMA_NAMES if k in pragmas}
+    return StorageProfile(profile.name, profile.description, pragmas, pool)
+
+
+def engine_options(profile: StorageProfile) -> Dict[str, Any]:
+    """create_engine 的连接池参数"""
+    if profile.pool_size <= 0:
+        return {"poolclass": NullPool}
+    return {"poolclass": QueuePool, "pool_size": profile.pool_size, "max_overflow": MAX_OVERFLOW}
+
+
+def _sql_value(name: str, value: Any) -> str:
+    return value if name == "journal_mode" else str(int(value))
+
+
+def install_pragmas(engine: Engine, profile: StorageProfile) -> None:
+    """注册 connect 事件：每个新建的连接依次执行配置中的 PRAGMA"""
+    statements = [f"PRAGMA {name} = {_sql_value(name, value)}" for name, value in profile.pragmas.items()]
+    if not statements:
+        return
+
+    def apply(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+    event.listen(engine, "connect", apply)
+
+
+def effective_pragmas(engine: Engine) -> Dict[str, Any]:
+    """从一个池化连接读回当前生效的 PRAGMA 值（规范化后）"""
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        values = {}
+        for name in PRAGMA_NAMES:
+            cursor.execute(f"PRAGMA {name}")
+            values[name] = normalize_pragma(name, cursor.fetchone()[0])
+        cursor.close()
+        return values
+    finally:
+        raw.close()
+
+
+def verify(engine: Engine, profile: StorageProfile) -> Dict[str, Any]:
+    """启动时核对配置是否生效，返回实际值；不一致时抛出 RuntimeError。
+    mmap_size 受编译选项 SQLITE_MAX_MMAP_SIZE 限制，实际值小于配置时视为已生效"""
+    actual = effective_pragmas(engine)
+    mismatched = []
+    for name, expected in profile.pragmas.items():
+        value = actual[name]
+        if name == "mmap_size" and value <= expected:
+            continue
+        if value != expected:
+            mismatched.append(f"{name}={value}（配置为 {expected}）")
+    if mismatched:
+        raise RuntimeError(f"SQLite 存储配置 {profile.name} 未生效: {'; '.join(mismatched)}")
+    return actual
+
+
+def checkpoint(engine: Engine, profile: StorageProfile) -> None:
+    """WAL 模式下把日志写回主库并截断，关闭服务后单独复制 app.db 即为完整数据"""
+    if not profile.wal:
+        return
+    raw = engine.raw_connection()
+    try:
+        raw.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        raw.close()
+
+
+# 全局配置（导入时按环境变量加载并校验）
+storage_profile = load_profile()
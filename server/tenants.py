@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .db import DataMigration, Tenant, User, utcnow
+from .tokens import revocations
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# 机构与租户的映射
+# -----------------------------
+# 每个机构对应一个同名租户（tenants.name 唯一），未填写机构的用户归入默认租户。
+# 租户只由系统管理员显式创建（create / init_admin.py），注册、创建、导入用户时按机构名解析到
+# 已有租户，拼写不同的机构名不会自动生成新租户；修改机构时用户及其用量事件、汇总行一并迁到新租户。
+# 机构维度的查询因此都可以用 tenant_id 索引前缀，不再按机构名过滤 users 或与 users 联表。
+# 机构名到租户ID的映射缓存在进程内（租户不会被删除）。
+# 旧库（所有用户都在默认租户）按机构归入已有租户由一次性迁移 backfill_user_tenants 完成。
+
+DEFAULT_TENANT_ID = 1
+DEFAULT_TENANT_NAME = "默认租户"
+
+_ROLLUP_TABLES = ("usage_rollups_hourly", "usage_rollups_daily")
+_ROLLUP_SUMS = ("event_count", "tokens_sum", "latency_sum", "latency_count")
+
+
+def _normalize(organization: Optional[str]) -> Optional[str]:
+    organization = (organization or "").strip()
+    return organization or None
+
+
+class TenantDirectory:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[str, int] = {}
+
+    def resolve(self, db: Session, organization: Optional[str]) -> Optional[int]:
+        """机构名对应的租户ID；未填写机构时为默认租户，机构不存在时为 None"""
+        name = _normalize(organization)
+        if name is None:
+            return DEFAULT_TENANT_ID
+        with self._lock:
+            tenant_id = self._ids.get(name)
+        if tenant_id is None:
+            tenant_id = db.query(Tenant.id).filter(Tenant.name == name).scalar()
+            if tenant_id is not None:
+                with self._lock:
+                    self._ids[name] = tenant_id
+        return tenant_id
+
+    def create(self, db: Session, organization: Optional[str], description: Optional[str] = None) -> Optional[int]:
+        """显式创建机构对应的租户并提交，返回新租户ID；同名租户已存在时返回 None"""
+        name = _normalize(organization)
+        if name is None:
+            raise ValueError("机构名称不能为空")
+        now = utcnow()
+        # 并发创建同名机构时只有一条插入生效
+        result = db.execute(
+            sqlite_insert(Tenant)
+            .values(name=name, description=description, created_at=now, updated_at=now)
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+        db.commit()
+        if not result.rowcount:
+            return None
+        return self.resolve(db, name)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._ids.clear()
+
+
+# 全局实例
+tenant_directory = TenantDirectory()
+
+
+def move_usage_history(db: Session, tenant_id: int, user_ids: Optional[Sequence[int]] = None) -> None:
+    """把用户的用量事件与汇总行迁到其当前租户（不提交事务）。
+    user_ids 为空时处理该租户下的全部用户"""
+    if user_ids is not None and not user_ids:
+        return
+    if user_ids is None:
+        members = "SELECT id FROM users WHERE tenant_id = :tenant_id"
+        params: Dict[str, object] = {"tenant_id": tenant_id}
+    else:
+        members = ", ".join(f":u{i}" for i in range(len(user_ids)))
+        params = {"tenant_id": tenant_id, **{f"u{i}": uid for i, uid in enumerate(user_ids)}}
+    scope = f"user_id IN ({members}) AND tenant_id != :tenant_id"
+    db.execute(text(f"UPDATE usage_events SET tenant_id = :tenant_id WHERE {scope}"), params)
+    sums = ", ".join(_ROLLUP_SUMS)
+    merge = ", ".join(f"{c} = {c} + excluded.{c}" for c in _ROLLUP_SUMS)
+    for table in _ROLLUP_TABLES:
+        # 目标租户下已有同一 (时间桶, 用户) 的行时累加
+        db.execute(text(
+            f"INSERT INTO {table} (bucket, tenant_id, user_id, {sums}) "
+            f"SELECT bucket, :tenant_id, user_id, {sums} FROM {table} WHERE {scope} "
+            f"ON CONFLICT(bucket, tenant_id, user_id) DO UPDATE SET {merge}"
+        ), params)
+        db.execute(text(f"DELETE FROM {table} WHERE {scope}"), params)
+
+
+def ensure_default_tenant(db: Session) -> None:
+    if db.query(Tenant.id).filter(Tenant.id == DEFAULT_TENANT_ID).first() is None:
+        db.add(Tenant(id=DEFAULT_TENANT_ID, name=DEFAULT_TENANT_NAME))
+        db.commit()
+
+
+class MigrationApplied(Exception):
+    pass
+
+
+BACKFILL_MIGRATION = "backfill_user_tenants"
+
+
+def backfill_user_tenants(db: Session, dry_run: bool = False) -> Dict[str, Any]:
+    """一次性迁移：按机构把用户归入已存在的同名租户，迁移其用量历史并使其已签发的令牌失效。
+    不创建租户，没有对应租户的机构列在 unmatched 中，其用户保持原租户。
+    整个迁移在一个事务内完成并写入执行标记，已执行过时抛出 MigrationApplied；dry_run 只统计不写入"""
+    ensure_default_tenant(db)
+    if db.query(DataMigration.name).filter(DataMigration.name == BACKFILL_MIGRATION).first() is not None:
+        raise MigrationApplied("租户回填已执行")
+    if not dry_run:
+        # 先写标记：并发执行时后到者因主键冲突失败
+        db.add(DataMigration(name=BACKFILL_MIGRATION))
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            raise MigrationApplied("租户回填已执行")
+    moved = 0
+    unmatched: List[Dict[str, Any]] = []
+    organizations = db.query(User.organization, func.count(User.id)).group_by(User.organization).all()
+    for organization, user_count in organizations:
+        tenant_id = tenant_directory.resolve(db, organization)
+        if tenant_id is None:
+            unmatched.append({"organization": organization, "users": user_count})
+            continue
+        filters = (
+            User.tenant_id != tenant_id,
+            User.organization.is_(None) if organization is None else User.organization == organization,
+        )
+        user_ids = [row[0] for row in db.query(User.id).filter(*filters)]
+        moved += len(user_ids)
+        if dry_run or not user_ids:
+            continue
+        db.query(User).filter(*filters).update({User.tenant_id: tenant_id}, synchronize_session=False)
+        move_usage_history(db, tenant_id)
+        for user_id in user_ids:
+            revocations.revoke(db, user_id)
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+        logger.info("已按机构校正 %d 个用户的租户，%d 个机构没有对应租户", moved, len(unmatched))
+    return {
+        "organizations": len(organizations),
+        "users_moved": moved,
+        "unmatched": unmatched,
+        "dry_run": dry_run,
+    }
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import bisect
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# -----------------------------
+# 实时用量时间序列（进程内环形缓冲）
+# -----------------------------
+# 按分钟粒度保存最近 24 小时：全局、每个租户、每个上游各一条序列，每条 1440 个槽位。
+# 槽位按「分钟序号 % 1440」复用，读取时用槽位中记录的分钟序号判断是否过期，
+# 因此无需后台清理线程，查询只读取窗口内的槽位，不访问数据库。
+
+SLOTS = 24 * 60
+
+# 延迟直方图桶上界（毫秒）：按 2^(1/4) 递增，p95 误差不超过约 19%
+LATENCY_BOUNDS: List[float] = []
+_b = 1.0
+while _b < 600_000:
+    LATENCY_BOUNDS.append(round(_b, 1))
+    _b *= 2 ** 0.25
+
+
+class _Series:
+    __slots__ = ("minute", "requests", "errors", "tokens", "latency")
+
+    def __init__(self):
+        self.minute = [-1] * SLOTS
+        self.requests = [0] * SLOTS
+        self.errors = [0] * SLOTS
+        self.tokens = [0] * SLOTS
+        # 稀疏直方图：桶下标 -> 次数；该分钟没有延迟样本时为 None
+        self.latency: List[Optional[Dict[int, int]]] = [None] * SLOTS
+
+    def slot(self, minute: int) -> int:
+        idx = minute % SLOTS
+        if self.minute[idx] != minute:
+            self.minute[idx] = minute
+            self.requests[idx] = self.errors[idx] = self.tokens[idx] = 0
+            self.latency[idx] = None
+        return idx
+
+
+def _percentile(hist: Dict[int, int], q: float) -> Optional[float]:
+    total = sum(hist.values())
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for idx in sorted(hist):
+        seen += hist[idx]
+        if seen >= rank:
+            return LATENCY_BOUNDS[min(idx, len(LATENCY_BOUNDS) - 1)]
+    return LATENCY_BOUNDS[-1]
+
+
+class UsageTimeSeries:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, Any], _Series] = {}
+        self.total_events = 0  # 单调递增，前端据此判断是否有新调用
+
+    @staticmethod
+    def _minute(ts: Optional[float] = None) -> int:
+        return int((ts if ts is not None else time.time()) // 60)
+
+    def record(
+        self,
+        tenant_id: Optional[int] = None,
+        upstream: Optional[str] = None,
+        error: bool = False,
+        tokens: Optional[int] = None,
+        latency_ms: Optional[float] = None,
+        ts: Optional[float] = None,
+    ) -> None:
+        """记录一次生成调用（成功或失败）"""
+        minute = self._minute(ts)
+        bucket = bisect.bisect_left(LATENCY_BOUNDS, latency_ms) if latency_ms is not None else None
+        keys = [("all", None)]
+        if tenant_id is not None:
+            keys.append(("tenant", tenant_id))
+        if upstream:
+            keys.append(("upstream", upstream))
+        with self._lock:
+            self.total_events += 1
+            for key in keys:
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = _Series()
+                idx = series.slot(minute)
+                series.requests[idx] += 1
+                if error:
+                    series.errors[idx] += 1
+                if tokens:
+                    series.tokens[idx] += tokens
+                if bucket is not None:
+                    hist = series.latency[idx]
+                    if hist is None:
+                        hist = series.latency[idx] = {}
+                    hist[bucket] = hist.get(bucket, 0) + 1
+
+    def window(
+        self,
+        minutes: int = 60,
+        tenant_id: Optional[int] = None,
+        upstream: Optional[str] = None,
+        now: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """返回最近 minutes 分钟（含当前分钟）的逐分钟数据与窗口汇总"""
+        minutes = max(1, min(SLOTS, minutes))
+        if tenant_id is not None:
+            key = ("tenant", tenant_id)
+        elif upstream:
+            key = ("upstream", upstream)
+        else:
+            key = ("all", None)
+        current = self._minute(now)
+        points: List[Dict[str, Any]] = []
+        merged: Dict[int, int] = {}
+        totals = {"requests": 0, "errors": 0, "tokens": 0}
+        with self._lock:
+            series = self._series.get(key)
+            seq = self.total_events
+            for minute in range(current - minutes + 1, current + 1):
+                idx = minute % SLOTS
+                if series is None or series.minute[idx] != minute:
+                    requests = errors = tokens = 0
+                    hist = None
+                else:
+                    requests, errors, tokens = series.requests[idx], series.errors[idx], series.tokens[idx]
+                    hist = series.latency[idx]
+                if hist:
+                    for b, c in hist.items():
+                        merged[b] = merged.get(b, 0) + c
+                totals["requests"] += requests
+                totals["errors"] += errors
+                totals["tokens"] += tokens
+                points.append({
+                    "minute": datetime.fromtimestamp(minute * 60, tz=timezone.utc).isoformat(),
+                    "requests": requests,
+                    "errors": errors,
+                    "tokens": tokens,
+                    "p95_ms": _percentile(hist, 0.95) if hist else None,
+                })
+        totals["p95_ms"] = _percentile(merged, 0.95)
+        return {"seq": seq, "minutes": minutes, "points": points, "totals": totals}
+
+    def upstreams(self) -> List[str]:
+        with self._lock:
+            return sorted(k[1] for k in self._series if k[0] == "upstream")
+
+
+# 全局实例
+usage_timeseries = UsageTimeSeries()
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import literal, select, true
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from .db import SessionLocal, SessionRevocation
+from .principals import Principal
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# 无状态会话令牌
+# -----------------------------
+# 令牌格式：base64url(JSON载荷).base64url(HMAC-SHA256签名)，载荷包含用户ID、租户、角色、
+# 机构与签发/过期时间（毫秒）。校验只需密钥，不访问数据库，多实例部署共享 SESSION_SECRET 即可。
+# 禁用、删除、重置密码或修改权限时按用户写入撤销时间，早于该时间签发的令牌全部失效；
+# 撤销表很小，各实例定期从数据库刷新到内存。
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(12 * 3600)))  # 秒
+REVOCATION_REFRESH = float(os.getenv("SESSION_REVOCATION_REFRESH", "10"))  # 秒
+# 已弃用：设为 1 时仍接受旧客户端的裸 X-User-Id 请求头（未经认证，仅限普通用户，管理员一律要求令牌）
+ALLOW_LEGACY_USER_HEADER = os.getenv("ALLOW_LEGACY_USER_HEADER", "0") == "1"
+
+_secret = os.getenv("SESSION_SECRET")
+# 未设置时使用随机密钥，应用启动时记录警告（见 warn_missing_secret）
+SESSION_SECRET_GENERATED = not _secret
+SESSION_SECRET = (_secret or secrets.token_urlsafe(32)).encode("utf-8")
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _sign(body: str) -> str:
+    return _b64encode(hmac.new(SESSION_SECRET, body.encode("ascii"), hashlib.sha256).digest())
+
+
+def warn_missing_secret() -> None:
+    """未设置 SESSION_SECRET 时记录警告（应用启动时调用一次）"""
+    if SESSION_SECRET_GENERATED:
+        logger.warning("未设置 SESSION_SECRET，使用随机密钥：重启后已签发的令牌失效，多实例部署时必须设置")
+
+
+_legacy_warned = False
+
+
+def warn_legacy_header() -> None:
+    """首次接受裸 X-User-Id 时记录一次弃用警告"""
+    global _legacy_warned
+    if not _legacy_warned:
+        _legacy_warned = True
+        logger.warning("已接受未经认证的 X-User-Id 请求头（ALLOW_LEGACY_USER_HEADER=1），该方式已弃用，请尽快改用会话令牌")
+
+
+class RevocationList:
+    def __init__(self, refresh: float = REVOCATION_REFRESH):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._revoked: Dict[int, int] = {}  # 用户ID -> 撤销时间（毫秒）
+        self._loaded_at = 0.0
+
+    def _reload(self) -> None:
+        db = SessionLocal()
+        try:
+            horizon = _now_ms() - SESSION_TTL * 1000
+            rows = db.query(SessionRevocation).filter(SessionRevocation.revoked_at_ms > horizon).all()
+            revoked = {row.user_id: row.revoked_at_ms for row in rows}
+        finally:
+            db.close()
+        with self._lock:
+            self._revoked = revoked
+            self._loaded_at = time.monotonic()
+
+    def revoked_at(self, user_id: int) -> Optional[int]:
+        if time.monotonic() - self._loaded_at > self.refresh:
+            try:
+                self._reload()
+            except Exception:
+                logger.exception("刷新令牌撤销列表失败")
+                self._loaded_at = time.monotonic()
+        with self._lock:
+            return self._revoked.get(user_id)
+
+    def revoke(self, db: Session, user_id: int) -> None:
+        """撤销该用户此前签发的全部令牌（随调用方事务提交）"""
+        at = _now_ms()
+        row = db.query(SessionRevocation).filter(SessionRevocation.user_id == user_id).first()
+        if row is None:
+            db.add(SessionRevocation(user_id=user_id, revoked_at_ms=at))
+        else:
+            row.revoked_at_ms = at
+        with self._lock:
+            self._revoked[user_id] = at
+
+    def revoke_matching(self, db: Session, user_ids: Select) -> List[int]:
+        """批量撤销：一条 INSERT ... SELECT 写入 user_ids 查询选中的全部用户（随调用方事务提交），返回用户ID。
+        该写入同时取得 SQLite 写锁，其后同一事务内的查询与更新看到的是同一批用户"""
+        at = _now_ms()
+        subquery = user_ids.subquery()
+        db.execute(
+            sqlite_insert(SessionRevocation)
+            .from_select(["user_id", "revoked_at_ms"], select(subquery.c[0], literal(at)).where(true()))
+            .on_conflict_do_update(index_elements=["user_id"], set_={"revoked_at_ms": at})
+        )
+        ids = [row[0] for row in db.execute(user_ids)]
+        with self._lock:
+            for user_id in ids:
+                self._revoked[user_id] = at
+        return ids
+
+
+revocations = RevocationList()
+
+
+def issue_token(user, ttl: int = SESSION_TTL) -> Dict[str, object]:
+    """为用户签发令牌，user 可为 User 或 Principal"""
+    issued = _now_ms()
+    # 保证签发时间晚于该用户最近一次撤销（同一毫秒内重新登录）
+    last = revocations.revoked_at(user.id)
+    if last is not None and issued <= last:
+        issued = last + 1
+    claims = {
+        "uid": user.id,
+        "tid": user.tenant_id,
+        "role": user.role or "user",
+        "adm": bool(user.is_admin),
+        "org": user.organization,
+        "iat": issued,
+        "exp": issued + ttl * 1000,
+    }
+    body = _b64encode(json.dumps(claims, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    return {"access_token": f"{body}.{_sign(body)}", "token_type": "bearer", "expires_in": ttl}
+
+
+def verify_token(token: str) -> Principal:
+    """校验签名、有效期与撤销状态，返回令牌中的 principal（不含配额）"""
+    try:
+        body, signature = token.split(".")
+        # 非 ASCII 字符在编码时抛出 UnicodeEncodeError（ValueError 子类）
+        valid = hmac.compare_digest(signature.encode("ascii"), _sign(body).encode("ascii"))
+    except ValueError:
+        raise InvalidToken("令牌格式无效")
+    if not valid:
+        raise InvalidToken("令牌签名无效")
+    try:
+        claims = json.loads(_b64decode(body))
+        user_id = int(claims["uid"])
+        issued, expires = int(claims["iat"]), int(claims["exp"])
+    except Exception:
+        raise InvalidToken("令牌内容无效")
+    if expires <= _now_ms():
+        raise InvalidToken("令牌已过期")
+    revoked = revocations.revoked_at(user_id)
+    if revoked is not None and issued <= revoked:
+        raise InvalidToken("令牌已失效")
+    return Principal(
+        id=user_id,
+        tenant_id=claims.get("tid"),
+        role=claims.get("role") or "user",
+        status="active",
+        is_admin=bool(claims.get("adm")),
+        organization=claims.get("org"),
+    )
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """从 Authorization 请求头中取出 Bearer 令牌"""
+    if not authorization:
+        return None
+    scheme, _, value = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not value.strip():
+        return None
+    return value.strip()
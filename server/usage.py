@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import json
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import case
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .db import UsageEvent, UserUsageCounter, utcnow
+from .active_users import active_users
+from .heavy_hitters import heavy_hitters
+from .columnar import COLUMNAR_ENABLED, event_store
+from .rollups import apply_event
+from .versions import change_versions
+from .change_feed import change_feed
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# 用量计数写入路径
+# -----------------------------
+# 计数器存放在窄表 user_usage_counters 中，每次调用只做一次按主键的 UPSERT，
+# 不再重写 users 宽表（也不会触发 users.updated_at 的 onupdate）。
+
+
+def get_counter(db: Session, user_id: int) -> Optional[UserUsageCounter]:
+    """按主键读取用户计数器，未产生过用量时返回 None"""
+    return db.query(UserUsageCounter).filter(UserUsageCounter.user_id == user_id).first()
+
+
+def effective_daily_used(counter: Optional[UserUsageCounter], today: Optional[date] = None) -> int:
+    """计算当日已用次数：跨天后计数视为0（真正的清零在下一次写入时完成）"""
+    if counter is None:
+        return 0
+    today = today or date.today()
+    if counter.daily_reset_at != today:
+        return 0
+    return counter.daily_used or 0
+
+
+def quota_status(
+    usage_quota: Optional[int],
+    daily_quota: Optional[int],
+    counter: Optional[UserUsageCounter],
+    pending: int = 0,
+) -> Dict[str, Any]:
+    """配额状态；pending 为本次已放行但尚未写入计数器的调用次数。剩余为 None 表示不限"""
+    usage_used = (counter.usage_used if counter else 0) + pending
+    daily_used = effective_daily_used(counter) + pending
+    # 日用量按服务器本地自然日计算，次日零点归零
+    reset_at = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+    return {
+        "usage_used": usage_used,
+        "usage_quota": usage_quota,
+        "usage_remaining": None if usage_quota is None else max(0, usage_quota - usage_used),
+        "daily_used": daily_used,
+        "daily_quota": daily_quota,
+        "daily_remaining": None if daily_quota is None else max(0, daily_quota - daily_used),
+        "daily_reset_at": reset_at.astimezone().isoformat(),
+        "reset_epoch": int(reset_at.timestamp()),
+    }
+
+
+def quota_headers(status: Dict[str, Any]) -> Dict[str, str]:
+    """生成接口响应头：不限额度的项不返回；X-Quota-Reset 为日用量归零时间（Unix 秒）"""
+    headers = {"X-Quota-Reset": str(status["reset_epoch"])}
+    if status["usage_remaining"] is not None:
+        headers["X-Quota-Remaining"] = str(status["usage_remaining"])
+    if status["daily_remaining"] is not None:
+        headers["X-Daily-Remaining"] = str(status["daily_remaining"])
+    return headers
+
+
+def increment_usage(db: Session, user_id: int, amount: int = 1) -> None:
+    """原子地累加总用量与日用量，跨天时日用量从本次开始重新计数（不提交事务）"""
+    today = date.today()
+    tbl = UserUsageCounter.__table__
+    stmt = sqlite_insert(tbl).values(
+        user_id=user_id,
+        usage_used=amount,
+        daily_used=amount,
+        daily_reset_at=today,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tbl.c.user_id],
+        set_={
+            "usage_used": tbl.c.usage_used + amount,
+            "daily_used": case(
+                (tbl.c.daily_reset_at == today, tbl.c.daily_used + amount),
+                else_=amount,
+            ),
+            "daily_reset_at": today,
+        },
+    )
+    db.execute(stmt)
+
+
+def reset_usage(db: Session, user_id: int) -> None:
+    """清零用户的总用量与日用量（不提交事务）"""
+    db.query(UserUsageCounter).filter(UserUsageCounter.user_id == user_id).update(
+        {UserUsageCounter.usage_used: 0, UserUsageCounter.daily_used: 0},
+        synchronize_session=False,
+    )
+
+
+def record_generate(
+    db: Session,
+    user_id: int,
+    tenant_id: int,
+    stream: bool,
+    tokens_used: Optional[int] = None,
+    latency_ms: Optional[int] = None,
+) -> None:
+    """记录一次生成调用：计数器累加、用量事件与汇总表更新在同一事务内完成"""
+    created_at = utcnow()
+    try:
+        increment_usage(db, user_id)
+        db.add(
+            UsageEvent(
+                user_id=user_id,
+                tenant_id=tenant_id,
+                event_type="generate",
+                created_at=created_at,
+                tokens_used=tokens_used,
+                latency_ms=latency_ms,
+                meta=json.dumps({"stream": stream}),
+            )
+        )
+        apply_event(db, tenant_id, user_id, created_at, tokens_used, latency_ms)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    change_versions.bump(tenant_id)
+    if change_feed.has_subscribers(tenant_id, user_id):
+        counter = get_counter(db, user_id)
+        change_feed.publish(
+            "usage",
+            {"user_id": user_id, "usage_used": counter.usage_used, "daily_used": effective_daily_used(counter)},
+            tenant_id,
+            user_id,
+        )
+    # 列式分析存储为派生数据，写入失败不影响主流程（可重建）
+    if COLUMNAR_ENABLED:
+        try:
+            event_store.append(created_at, tenant_id, user_id, tokens_used, latency_ms)
+        except Exception:
+            logger.exception("列式存储写入失败")
+    heavy_hitters.observe(tenant_id, user_id, created_at)
+    try:
+        active_users.observe(db, tenant_id, user_id, created_at)
+        active_users.maybe_flush()
+    except Exception:
+        logger.exception("活跃用户统计写入失败")
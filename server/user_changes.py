@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from .db import User, UserChange
+from .serialization import user_dicts, user_query
+
+
+# -----------------------------
+# 用户增量同步（变更日志）
+# -----------------------------
+# user_changes 每个（租户, 用户）一行：users 的插入/更新与用量计数器的写入都会通过触发器把该行的 seq
+# 改为当前最大序号 + 1（seq 上有索引，取最大值为 O(log n)）；删除用户时保留为墓碑（deleted=1）。
+# 用户迁到其他租户时，原租户下的行同样改为墓碑，按原租户同步的客户端因此能收到删除。
+# SQLite 的写事务串行执行，序号单调递增且提交顺序与序号一致。日志行数与用户数（及迁移次数）相当，不随调用次数增长。
+# 客户端记住上次的 version，之后只拉取 seq 更大的行，传输量与变更量成正比，与租户规模无关。
+
+MAX_CHANGES_PAGE = 1000
+
+_NEXT_SEQ = "(SELECT coalesce(max(seq), 0) + 1 FROM user_changes)"
+
+
+def _upsert(user_id: str, tenant_id: str, deleted: int) -> str:
+    return (
+        f"INSERT INTO user_changes(tenant_id, user_id, seq, deleted) "
+        f"VALUES (coalesce({tenant_id}, 0), {user_id}, {_NEXT_SEQ}, {deleted}) "
+        f"ON CONFLICT(tenant_id, user_id) DO UPDATE SET seq = excluded.seq, deleted = excluded.deleted;"
+    )
+
+
+_COUNTER_TENANT = "(SELECT tenant_id FROM users WHERE id = new.user_id)"
+
+_TRIGGERS = {
+    "user_changes_ai": f"AFTER INSERT ON users BEGIN {_upsert('new.id', 'new.tenant_id', 0)} END",
+    "user_changes_au": f"AFTER UPDATE ON users BEGIN {_upsert('new.id', 'new.tenant_id', 0)} END",
+    "user_changes_au_tenant": (
+        f"AFTER UPDATE OF tenant_id ON users WHEN old.tenant_id IS NOT new.tenant_id "
+        f"BEGIN {_upsert('old.id', 'old.tenant_id', 1)} END"
+    ),
+    "user_changes_ad": f"AFTER DELETE ON users BEGIN {_upsert('old.id', 'old.tenant_id', 1)} END",
+    "user_changes_counter_ai": (
+        f"AFTER INSERT ON user_usage_counters BEGIN {_upsert('new.user_id', _COUNTER_TENANT, 0)} END"
+    ),
+    "user_changes_counter_au": (
+        f"AFTER UPDATE ON user_usage_counters BEGIN {_upsert('new.user_id', _COUNTER_TENANT, 0)} END"
+    ),
+}
+
+
+def ensure_change_log(db: Session) -> None:
+    """启动时按当前定义重建同步触发器；日志为空而已有用户（旧库升级）时按用户ID顺序补齐"""
+    for name, body in _TRIGGERS.items():
+        db.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        db.execute(text(f"CREATE TRIGGER {name} {body}"))
+    if db.query(UserChange.user_id).first() is None and db.query(User.id).first() is not None:
+        db.execute(text(
+            "INSERT INTO user_changes(tenant_id, user_id, seq, deleted) "
+            "SELECT coalesce(tenant_id, 0), id, row_number() OVER (ORDER BY id), 0 FROM users"
+        ))
+    db.commit()
+
+
+def current_version(db: Session) -> int:
+    return db.query(func.max(UserChange.seq)).scalar() or 0
+
+
+def changes_since(
+    db: Session, since: int, limit: int = MAX_CHANGES_PAGE, tenant_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """返回 seq 大于 since 的变更：{version, items(用户 dict), deleted(用户ID), has_more}。
+    has_more 为真时以返回的 version 作为 since 继续拉取"""
+    limit = max(1, min(MAX_CHANGES_PAGE, limit))
+    q = db.query(UserChange.user_id, UserChange.seq, UserChange.deleted).filter(UserChange.seq > since)
+    if tenant_id is not None:
+        q = q.filter(UserChange.tenant_id == tenant_id)
+    rows = q.order_by(UserChange.seq.asc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    live_ids = [r.user_id for r in rows if not r.deleted]
+    users: Dict[int, Dict[str, Any]] = {}
+    if live_ids:
+        uq = user_query(db).filter(User.id.in_(live_ids))
+        if tenant_id is not None:
+            # 已迁出本租户的用户按删除处理
+            uq = uq.filter(User.tenant_id == tenant_id)
+        users = {u["id"]: u for u in user_dicts(uq)}
+    # 不限租户时，迁移用户的墓碑与新租户下的行可能出现在同一页，每个用户只输出一次
+    items: List[Dict[str, Any]] = []
+    deleted: List[int] = []
+    seen = set()
+    for r in rows:
+        if r.user_id in seen:
+            continue
+        seen.add(r.user_id)
+        if r.user_id in users:
+            items.append(users[r.user_id])
+        else:
+            deleted.append(r.user_id)
+    return {
+        "version": rows[-1].seq if rows else since,
+        "items": items,
+        "deleted": deleted,
+        "has_more": has_more,
+    }
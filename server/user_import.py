@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import csv
+import io
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.orm import Session
+
+from .db import User, utcnow
+from .tenants import move_usage_history, tenant_directory
+from .tokens import revocations
+
+
+# -----------------------------
+# 用户 CSV 批量导入
+# -----------------------------
+# 上传内容按行流式解析（分号分隔，首行为表头），每 CHUNK_SIZE 行为一批：
+# 一次 IN 查询找出已存在的邮箱，新用户与已有用户分别用 executemany 批量 INSERT / UPDATE，
+# 每批提交一次，内存占用与文件大小无关。新用户的默认密码只计算一次哈希。
+# 租户按机构名解析到已有租户（见 tenants.py，不自动创建），机构不存在的行记为错误；
+# 机构变化的已有用户连同用量历史迁到新租户。
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 200
+
+_TEXT_FIELDS = ("name", "organization", "phone", "status", "notes")
+_INT_FIELDS = ("usage_quota", "daily_quota")
+# 这些字段变化后，已签发会话令牌中的信息失效
+_CLAIM_FIELDS = ("status", "is_admin", "organization")
+
+
+class ImportReport:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def error(self, line: int, email: Optional[str], message: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "email": email, "error": message})
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "imported": self.created + self.updated,
+            "created": self.created,
+            "updated": self.updated,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
+
+
+def _parse_row(
+    line: int, parts: List[str], idx: Dict[str, int], report: ImportReport
+) -> Optional[Dict[str, Any]]:
+    def getv(key):
+        i = idx.get(key)
+        value = parts[i].strip() if (i is not None and i < len(parts)) else ""
+        return value or None
+
+    email = getv("email")
+    if not email:
+        report.error(line, None, "缺少邮箱")
+        return None
+    if "@" not in email:
+        report.error(line, email, "邮箱格式无效")
+        return None
+    row: Dict[str, Any] = {"email": email}
+    for key in _TEXT_FIELDS:
+        row[key] = getv(key)
+    for key in _INT_FIELDS:
+        value = getv(key)
+        try:
+            row[key] = int(value) if value is not None else None
+        except ValueError:
+            report.error(line, email, f"{key} 不是整数: {value}")
+            return None
+    is_admin = getv("is_admin")
+    row["is_admin"] = None if is_admin is None else is_admin == "1"
+    return row
+
+
+def _read_rows(
+    stream: BinaryIO, report: ImportReport
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    reader = csv.reader(text, delimiter=";")
+    header = next(reader, None)
+    if not header:
+        return
+    idx = {name.strip(): i for i, name in enumerate(header)}
+    if "email" not in idx:
+        raise ValueError("CSV 缺少 email 列")
+    for parts in reader:
+        if not any(p.strip() for p in parts):
+            continue
+        row = _parse_row(reader.line_num, parts, idx, report)
+        if row is not None:
+            yield reader.line_num, row
+
+
+def _apply_chunk(db: Session, chunk: Dict[str, Dict[str, Any]], password_hash: str, report: ImportReport) -> None:
+    """写入一批（键为邮箱），整批在一个事务内提交"""
+    users = User.__table__
+    existing = {
+        r.email: r
+        for r in db.execute(
+            select(users.c.id, users.c.email, users.c.status, users.c.is_admin, users.c.organization)
+            .where(users.c.email.in_(list(chunk)))
+        )
+    }
+    now = utcnow()
+    inserts = []
+    updates = []
+    revoked = []
+    moved: Dict[int, List[int]] = {}
+    for email, row in chunk.items():
+        current = existing.get(email)
+        if current is None:
+            inserts.append({
+                "tenant_id": tenant_directory.resolve(db, row["organization"]),
+                "email": email,
+                "password_hash": password_hash,
+                "name": row["name"],
+                "organization": row["organization"],
+                "phone": row["phone"],
+                "status": row["status"] or "active",
+                "notes": row["notes"],
+                "is_admin": bool(row["is_admin"]),
+                "role": "user",
+                "usage_quota": row["usage_quota"],
+                "daily_quota": row["daily_quota"],
+                "created_at": now,
+                "updated_at": now,
+            })
+            continue
+        params = {f"b_{key}": row[key] for key in _TEXT_FIELDS + _INT_FIELDS + ("is_admin",)}
+        params["b_id"] = current.id
+        params["b_tenant_id"] = None
+        if row["organization"] is not None and row["organization"] != current.organization:
+            params["b_tenant_id"] = tenant_directory.resolve(db, row["organization"])
+            moved.setdefault(params["b_tenant_id"], []).append(current.id)
+        updates.append(params)
+        if any(row[key] is not None and row[key] != getattr(current, key) for key in _CLAIM_FIELDS):
+            revoked.append(current.id)
+
+    if inserts:
+        db.execute(users.insert(), inserts)
+        report.created += len(inserts)
+    if updates:
+        # 空值表示保持原值
+        values = {
+            key: func.coalesce(bindparam(f"b_{key}"), users.c[key])
+            for key in _TEXT_FIELDS + _INT_FIELDS + ("is_admin", "tenant_id")
+        }
+        values["updated_at"] = now
+        db.execute(users.update().where(users.c.id == bindparam("b_id")).values(**values), updates)
+        report.updated += len(updates)
+    for tenant_id, user_ids in moved.items():
+        move_usage_history(db, tenant_id, user_ids)
+    for user_id in revoked:
+        revocations.revoke(db, user_id)
+    db.commit()
+
+
+def import_users_csv(
+    db: Session, stream: BinaryIO, password_hash: str, chunk_size: int = CHUNK_SIZE
+) -> Dict[str, Any]:
+    """流式导入用户（按邮箱 upsert），返回导入报告"""
+    report = ImportReport()
+    chunk: Dict[str, Dict[str, Any]] = {}
+    lines: Dict[str, int] = {}
+
+    def flush() -> None:
+        try:
+            _apply_chunk(db, chunk, password_hash, report)
+        except Exception as e:
+            # 整批回滚，批内每行记为失败，继续处理后续批次
+            db.rollback()
+            for email in chunk:
+                report.error(lines[email], email, f"写入失败: {e.__class__.__name__}")
+
+    for line, row in _read_rows(stream, report):
+        if tenant_directory.resolve(db, row["organization"]) is None:
+            report.error(line, row["email"], f"机构不存在: {row['organization']}")
+            continue
+        # 同一批内重复的邮箱依次合并，后面行的非空字段覆盖前面的
+        previous = chunk.get(row["email"])
+        if previous is not None:
+            row = {**previous, **{k: v for k, v in row.items() if v is not None}}
+        chunk[row["email"]] = row
+        lines[row["email"]] = line
+        if len(chunk) >= chunk_size:
+            flush()
+            chunk, lines = {}, {}
+    if chunk:
+        flush()
+    return report.as_dict()
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import logging
+from typing import Any, List, Optional
+
+from sqlalchemy import column, literal_column, or_, select, table, text
+from sqlalchemy.orm import Query, Session
+
+from .db import User
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# 用户搜索（SQLite FTS5 trigram 全文索引）
+# -----------------------------
+# users_fts 是以 users 为外部内容表的 FTS5 虚拟表，trigram 分词按连续三个字符建索引，
+# 中文姓名、机构名与手机号片段都可以做任意位置的子串匹配，按 bm25 排序。
+# 触发器在 users 的 INSERT / UPDATE / DELETE 时同步索引，批量导入（executemany）同样生效。
+# trigram 无法索引不足三个字符的查询词，此时退回 LIKE 并限制返回条数；
+# SQLite 未编译 FTS5 或版本低于 3.34（无 trigram）时全部退回 LIKE。
+
+FTS_TABLE = "users_fts"
+MIN_FTS_CHARS = 3
+# bm25 列权重：name, email, organization, phone
+_WEIGHTS = (4.0, 2.0, 1.0, 2.0)
+
+_fts = table(FTS_TABLE, column("rowid"))
+_available: Optional[bool] = None
+
+_TRIGGERS = {
+    "users_fts_ai": f"""
+        CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, name, email, organization, phone)
+            VALUES (new.id, new.name, new.email, new.organization, new.phone);
+        END""",
+    "users_fts_ad": f"""
+        CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, email, organization, phone)
+            VALUES ('delete', old.id, old.name, old.email, old.organization, old.phone);
+        END""",
+    # 只有被索引的列变化时才重建该行索引，配额、状态等更新不受影响
+    "users_fts_au": f"""
+        CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF name, email, organization, phone ON users BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, email, organization, phone)
+            VALUES ('delete', old.id, old.name, old.email, old.organization, old.phone);
+            INSERT INTO {FTS_TABLE}(rowid, name, email, organization, phone)
+            VALUES (new.id, new.name, new.email, new.organization, new.phone);
+        END""",
+}
+
+
+def ensure_user_search(db: Session) -> bool:
+    """启动时创建全文索引表与同步触发器；新建时从 users 全量构建一次。返回是否可用"""
+    global _available
+    exists = db.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+    ).first()
+    try:
+        if not exists:
+            db.execute(text(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                "name, email, organization, phone, "
+                "content='users', content_rowid='id', tokenize='trigram')"
+            ))
+        for ddl in _TRIGGERS.values():
+            db.execute(text(ddl))
+        if not exists:
+            db.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        db.commit()
+        _available = True
+    except Exception as e:
+        db.rollback()
+        logger.warning("无法创建用户全文索引（需要 SQLite 3.34+ 且启用 FTS5），用户搜索退回 LIKE: %s", e)
+        _available = False
+    return _available
+
+
+def rebuild_user_search(db: Session) -> None:
+    """按 users 表重建全文索引（索引与数据不一致时手动修复）"""
+    db.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    db.commit()
+
+
+def _use_fts(q: str) -> bool:
+    return bool(_available) and len(q.strip()) >= MIN_FTS_CHARS
+
+
+def _match_expr(q: str) -> str:
+    # 整个查询词作为一个短语（双引号转义），避免用户输入被解析为 FTS 查询语法
+    return '"' + q.strip().replace('"', '""') + '"'
+
+
+def _like_filter(q: str):
+    # SQLite 的 LIKE 本身对 ASCII 不区分大小写，不用 ilike（lower() 包裹每一列更慢）
+    like = f"%{q.strip()}%"
+    return or_(User.name.like(like), User.email.like(like), User.organization.like(like), User.phone.like(like))
+
+
+def user_search_filter(q: str):
+    """用于列表查询的搜索条件：命中全文索引的用户ID集合，短查询词退回 LIKE"""
+    if not _use_fts(q):
+        return _like_filter(q)
+    matched = select(_fts.c.rowid).where(text(f"{FTS_TABLE} MATCH :fts_q").bindparams(fts_q=_match_expr(q)))
+    return User.id.in_(matched)
+
+
+def search_users(
+    db: Session, q: str, limit: int = 50, tenant_id: Optional[int] = None, query: Optional[Query] = None
+) -> List[Any]:
+    """按相关度返回匹配的用户（bm25 越小越相关，同分按ID）；query 可传入列投影查询，默认返回 ORM 对象"""
+    if query is None:
+        query = db.query(User)
+    if tenant_id is not None:
+        query = query.filter(User.tenant_id == tenant_id)
+    if not _use_fts(q):
+        return query.filter(_like_filter(q)).order_by(User.id.asc()).limit(limit).all()
+    weights = ", ".join(str(w) for w in _WEIGHTS)
+    return (
+        query.join(_fts, _fts.c.rowid == User.id)
+        .filter(text(f"{FTS_TABLE} MATCH :fts_q").bindparams(fts_q=_match_expr(q)))
+        .order_by(literal_column(f"bm25({FTS_TABLE}, {weights})"), User.id.asc())
+        .limit(limit)
+        .all()
+    )
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import hashlib
+import secrets
+import threading
+from datetime import date
+from typing import Any, Dict, Optional
+
+
+# -----------------------------
+# 按租户的数据变更版本（用于 ETag / 条件 GET）
+# -----------------------------
+# 用户或用量计数器的每次写入都会调用 bump(租户ID)，版本号全局单调递增；
+# 跨租户的列表（系统管理员视图、机构列表）使用全局版本。版本只存在于进程内存，
+# ETag 中带有进程启动时生成的 epoch，重启后旧 ETag 全部失效，不会误判为未修改。
+# 生成 ETag 只读内存，If-None-Match 命中时无需访问数据库即可返回 304。
+
+
+class ChangeVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.epoch = secrets.token_hex(4)
+        self._seq = 0
+        self._floor = 0  # bump(None)：所有租户同时视为已变更
+        self._tenants: Dict[int, int] = {}
+
+    def bump(self, tenant_id: Optional[int] = None) -> int:
+        """记录一次写入；tenant_id 为空表示影响范围未知（如批量导入），所有租户都失效"""
+        with self._lock:
+            self._seq += 1
+            if tenant_id is None:
+                self._floor = self._seq
+            else:
+                self._tenants[tenant_id] = self._seq
+            return self._seq
+
+    def version(self, tenant_id: Optional[int] = None) -> int:
+        """租户的当前版本；tenant_id 为空时返回全局版本"""
+        with self._lock:
+            if tenant_id is None:
+                return self._seq
+            return max(self._tenants.get(tenant_id, 0), self._floor)
+
+    def etag(self, tenant_id: Optional[int], *variant: Any) -> str:
+        """强 ETag：版本 + 请求变体（调用方视角、查询参数）+ 当日日期（日用量按天归零）"""
+        version = self.version(tenant_id)
+        digest = hashlib.blake2b(repr((tenant_id, date.today(), variant)).encode("utf-8"), digest_size=8).hexdigest()
+        return f'"{self.epoch}.{version}.{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match 使用弱比较：忽略代理可能加上的 W/ 前缀
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+# 全局实例
+change_versions = ChangeVersions()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 活跃用户 sketch 测试
+落库时与库中已有寄存器合并：重启前后（或多个进程）各自累积的 sketch 不会相互覆盖。
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date, datetime
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "active_users.db"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from server.active_users import ActiveUserTracker
+from server.db import Base, SessionLocal, engine, run_simple_migrations
+
+TENANT = 9201
+DAY = date(2021, 5, 6)
+WHEN = datetime(2021, 5, 6, 12, 0)
+
+
+def setup_module(module=None):
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+
+
+def estimate(tracker, db):
+    return tracker.estimate(db, DAY, DAY, tenant_id=TENANT)["active_users"]
+
+
+def test_flush_merges_with_stored_sketch_after_restart():
+    db = SessionLocal()
+    try:
+        # 旧进程累积了 1..60 但尚未落库时，新进程已启动并从库中加载（为空）的 sketch
+        old, new = ActiveUserTracker(), ActiveUserTracker()
+        for user_id in range(1, 61):
+            old.observe(db, TENANT, user_id, WHEN)
+        for user_id in range(61, 121):
+            new.observe(db, TENANT, user_id, WHEN)
+        # 旧进程退出时落库，随后新进程落库：不能覆盖旧进程写入的部分
+        assert old.maybe_flush(force=True) == 1
+        assert new.maybe_flush(force=True) == 1
+        assert 114 <= estimate(ActiveUserTracker(), db) <= 126
+        # 合并结果同时并回新进程的内存
+        assert 114 <= estimate(new, db) <= 126
+
+        # 重启后继续累积同一天：重复用户不增加计数，新用户合并进已有结果
+        restarted = ActiveUserTracker()
+        for user_id in range(100, 141):
+            restarted.observe(db, TENANT, user_id, WHEN)
+        restarted.maybe_flush(force=True)
+        assert 133 <= estimate(ActiveUserTracker(), db) <= 147
+    finally:
+        db.close()
+
+
+def main():
+    print("🔍 活跃用户 sketch 测试")
+    print("=" * 50)
+    setup_module()
+    test_flush_merges_with_stored_sketch_after_restart()
+    print("\n🎉 活跃用户 sketch 测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
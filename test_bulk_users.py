@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 批量用户操作测试
+医院管理员的租户与角色范围、删除时计数器与订阅的清理，以及禁用/删除后令牌撤销。
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "bulk_users.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, Subscription, User, UserUsageCounter
+from server.principals import principal_cache
+from server.usage import increment_usage
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+PASSWORD = "secret123"
+
+client = TestClient(app_main.app)
+
+
+def setup_module(module=None):
+    client.__enter__()
+
+
+def create_user(email, organization, role="user", is_admin=False):
+    # 机构须对应已有租户
+    resp = client.post("/api/admin/tenants", headers=ADMIN, json={"name": organization})
+    assert resp.status_code in (200, 409), resp.text
+    resp = client.post("/api/admin/users", headers=ADMIN, json={
+        "name": "批量测试", "organization": organization, "phone": "13800000000",
+        "email": email, "password": PASSWORD,
+    })
+    assert resp.status_code == 200, resp.text
+    user = resp.json()
+    if role != "user" or is_admin:
+        db = SessionLocal()
+        try:
+            db.query(User).filter(User.id == user["id"]).update({"role": role, "is_admin": is_admin})
+            db.commit()
+        finally:
+            db.close()
+        principal_cache.invalidate([user["id"]])
+    return user
+
+
+def login(email):
+    resp = client.post("/api/users/login", json={"email": email, "password": PASSWORD})
+    assert resp.status_code == 200, resp.text
+    return {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+
+def bulk(headers, op, **filter_):
+    return client.post("/api/admin/users:bulk", headers=headers, json={"op": op, "filter": filter_})
+
+
+def tenant_of(user_id):
+    db = SessionLocal()
+    try:
+        return db.query(User.tenant_id).filter(User.id == user_id).scalar()
+    finally:
+        db.close()
+
+
+def statuses(ids):
+    db = SessionLocal()
+    try:
+        return {u.id: u.status for u in db.query(User).filter(User.id.in_(ids))}
+    finally:
+        db.close()
+
+
+def test_hospital_admin_scope():
+    org, other = "批量医院甲", "批量医院乙"
+    manager = create_user("bulk-manager@bulk.example.com", org, role="hospital_admin")
+    colleague = create_user("bulk-colleague@bulk.example.com", org, role="hospital_admin")
+    sysadmin = create_user("bulk-sysadmin@bulk.example.com", org, role="admin", is_admin=True)
+    flagged = create_user("bulk-flagged@bulk.example.com", org, is_admin=True)
+    doctors = [create_user(f"bulk-doctor{i}@bulk.example.com", org) for i in range(3)]
+    outsider = create_user("bulk-outsider@bulk.example.com", other)
+    headers = login("bulk-manager@bulk.example.com")
+
+    # 只允许设置配额与启用/禁用
+    for op in ("delete", "reset_usage"):
+        assert bulk(headers, op, organization=org).status_code == 403
+    # 不能指定其他租户
+    assert bulk(headers, "disable", organization=other).status_code == 403
+    assert bulk(headers, "disable", tenant_id=tenant_of(outsider["id"])).status_code == 403
+
+    # 按 ID 选中时，其他租户的用户与本租户的管理员账户都不受影响
+    everyone = [manager, colleague, sysadmin, flagged, outsider] + doctors
+    resp = bulk(headers, "disable", ids=[u["id"] for u in everyone])
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["matched"] == len(doctors)
+    after = statuses([u["id"] for u in everyone])
+    assert all(after[d["id"]] == "disabled" for d in doctors)
+    assert all(after[u["id"]] == "active" for u in (manager, colleague, sysadmin, flagged, outsider))
+
+    # 单个修改同样不能改动管理员账户
+    resp = client.patch(f"/api/admin/users/{sysadmin['id']}", headers=headers, json={"status": "disabled"})
+    assert resp.status_code == 403
+
+    resp = bulk(headers, "enable", organization=org)
+    assert resp.status_code == 200 and resp.json()["matched"] == len(doctors)
+
+
+def test_delete_cleans_counters_and_subscriptions():
+    users = [create_user(f"bulk-delete{i}@bulk.example.com", "批量医院丙") for i in range(3)]
+    ids = [u["id"] for u in users]
+    db = SessionLocal()
+    try:
+        for user in users:
+            increment_usage(db, user["id"])
+        tenant_id = tenant_of(ids[0])
+        db.add(Subscription(tenant_id=tenant_id, user_id=ids[0], plan="pro"))
+        db.add(Subscription(tenant_id=tenant_id, user_id=ids[1], plan="basic"))
+        db.commit()
+    finally:
+        db.close()
+
+    resp = bulk(ADMIN, "delete", ids=ids)
+    assert resp.status_code == 200, resp.text
+    body = resp.json()
+    assert body["matched"] == 3
+    assert body["affected"] == {"revoked": 3, "counters": 3, "subscriptions": 2, "users": 3}
+    db = SessionLocal()
+    try:
+        assert db.query(User).filter(User.id.in_(ids)).count() == 0
+        assert db.query(UserUsageCounter).filter(UserUsageCounter.user_id.in_(ids)).count() == 0
+        assert db.query(Subscription).filter(Subscription.user_id.in_(ids)).count() == 0
+    finally:
+        db.close()
+
+
+def test_disable_and_delete_revoke_tokens():
+    org = "批量医院丁"
+    disabled = create_user("bulk-revoke-disable@bulk.example.com", org)
+    deleted = create_user("bulk-revoke-delete@bulk.example.com", org)
+    untouched = create_user("bulk-revoke-keep@bulk.example.com", org)
+    tokens = {u["id"]: login(u["email"]) for u in (disabled, deleted, untouched)}
+    for headers in tokens.values():
+        assert client.get("/api/users/me", headers=headers).status_code == 200
+
+    resp = bulk(ADMIN, "disable", ids=[disabled["id"]])
+    assert resp.status_code == 200 and resp.json()["affected"]["revoked"] == 1
+    resp = bulk(ADMIN, "delete", ids=[deleted["id"]])
+    assert resp.status_code == 200 and resp.json()["affected"]["revoked"] == 1
+
+    assert client.get("/api/users/me", headers=tokens[disabled["id"]]).status_code == 401
+    assert client.get("/api/users/me", headers=tokens[deleted["id"]]).status_code == 401
+    assert client.get("/api/users/me", headers=tokens[untouched["id"]]).status_code == 200
+
+    # 重新启用后旧令牌仍然无效，重新登录可用
+    assert bulk(ADMIN, "enable", ids=[disabled["id"]]).json()["matched"] == 1
+    assert client.get("/api/users/me", headers=tokens[disabled["id"]]).status_code == 401
+    assert client.get("/api/users/me", headers=login(disabled["email"])).status_code == 200
+
+
+def main():
+    print("🔍 批量用户操作测试")
+    print("=" * 50)
+    setup_module()
+    test_hospital_admin_scope()
+    test_delete_cleans_counters_and_subscriptions()
+    test_disable_and_delete_revoke_tokens()
+    print("\n🎉 批量用户操作测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 变更推送测试
+按范围订阅：系统管理员、医院管理员、普通用户各自收到哪些事件（含不带租户的广播 resync 与按租户的 resync），
+以及推送连接只接受一次性票据、不接受查询参数中的令牌。
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "change_feed.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.change_feed import ChangeFeed, StreamTickets, stream_tickets
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+TENANT, OTHER = 9501, 9502
+
+client = TestClient(app_main.app)
+
+
+def setup_module(module=None):
+    client.__enter__()
+
+
+def received(sub):
+    events = []
+    while not sub.queue.empty():
+        _, kind, _, _, payload = sub.queue.get_nowait()
+        events.append((kind, json.loads(payload).get("n")))
+    return events
+
+
+def test_scoped_subscribers():
+    async def run():
+        feed = ChangeFeed()
+        subs = {
+            "admin": feed.subscribe(None, None),
+            "manager": feed.subscribe(TENANT, None),
+            "user": feed.subscribe(TENANT, 1),
+            "neighbour": feed.subscribe(TENANT, 2),
+            "other": feed.subscribe(OTHER, 3),
+        }
+        feed.publish("usage", {"n": 1}, TENANT, 1)
+        feed.publish("usage", {"n": 2}, OTHER, 3)
+        # 批量导入：不带租户，广播给所有连接
+        feed.publish("resync", {"n": 3})
+        # 大批量操作：按租户，含该租户的普通用户
+        feed.publish("resync", {"n": 4}, TENANT)
+        feed.publish("user", {"n": 5}, TENANT, 2)
+        # 不带用户的普通事件不发给普通用户
+        feed.publish("user", {"n": 6}, TENANT)
+        await asyncio.sleep(0)
+        return {name: received(sub) for name, sub in subs.items()}
+
+    got = asyncio.run(run())
+    assert got["admin"] == [("usage", 1), ("usage", 2), ("resync", 3), ("resync", 4), ("user", 5), ("user", 6)]
+    assert got["manager"] == [("usage", 1), ("resync", 3), ("resync", 4), ("user", 5), ("user", 6)]
+    assert got["user"] == [("usage", 1), ("resync", 3), ("resync", 4)]
+    assert got["neighbour"] == [("resync", 3), ("resync", 4), ("user", 5)]
+    assert got["other"] == [("usage", 2), ("resync", 3)]
+
+
+def test_replayed_resync_reaches_user():
+    """断线重连补发时同样按范围过滤"""
+    async def run():
+        feed = ChangeFeed()
+        feed.publish("resync", {"n": 1}, TENANT)
+        feed.publish("usage", {"n": 2}, TENANT, 2)
+        sub = feed.subscribe(TENANT, 1, f"{feed.epoch}-0")
+        await asyncio.sleep(0)
+        return received(sub)
+
+    assert asyncio.run(run()) == [("resync", 1)]
+
+
+def test_tickets_single_use():
+    tickets = StreamTickets(ttl=30)
+    ticket = tickets.issue(TENANT, 1)
+    assert tickets.redeem(ticket) == (TENANT, 1)
+    assert tickets.redeem(ticket) is None
+    assert tickets.redeem("forged") is None
+    expired = StreamTickets(ttl=-1)
+    assert expired.redeem(expired.issue(None, None)) is None
+
+
+def test_stream_requires_ticket():
+    # 令牌不接受查询参数
+    assert client.get("/api/events/stream", params={"admin_token": "secret-admin"}).status_code == 401
+    assert client.post("/api/events/ticket", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.post("/api/events/ticket").status_code == 401
+
+    resp = client.post("/api/events/ticket", headers=ADMIN)
+    assert resp.status_code == 200, resp.text
+    ticket = resp.json()["ticket"]
+    # 票据绑定系统管理员范围，只能兑换一次
+    assert stream_tickets.redeem(ticket) == (None, None)
+    assert client.get("/api/events/stream", params={"ticket": ticket}).status_code == 401
+
+
+def main():
+    print("🔍 变更推送测试")
+    print("=" * 50)
+    setup_module()
+    test_scoped_subscribers()
+    test_replayed_resync_reaches_user()
+    test_tickets_single_use()
+    test_stream_requires_ticket()
+    print("\n🎉 变更推送测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
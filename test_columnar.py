@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 列式事件存储测试
+乱序写入：批内排序、迟到行插入可写段、早于已封存段的行拒绝并计数（不改写时间戳）；
+写入按行数或时间阈值批量刷盘（含后台刷盘线程），刷盘后重新打开存储不丢行。
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "columnar.db"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import numpy as np
+
+from server.columnar import COLUMNS, ColumnarEventStore
+
+
+def batch(ts, user_id=1):
+    n = len(ts)
+    return {
+        "ts": np.array(ts, dtype="<i8"),
+        "tenant_id": np.full(n, 1, dtype="<i4"),
+        "user_id": np.full(n, user_id, dtype="<i4"),
+        "tokens": np.array(ts, dtype="<i4"),  # 以 tokens 记录原始时间戳，校验行未错位
+        "latency": np.full(n, 10, dtype="<i4"),
+    }
+
+
+def test_out_of_order_rows_are_not_rewritten():
+    store = ColumnarEventStore(tempfile.mkdtemp(), segment_rows=8)
+    assert store.append_many(batch([50, 10, 30, 20])) == 4
+    data = store.scan()
+    assert data["ts"].tolist() == [10, 20, 30, 50]
+    assert (data["ts"] == data["tokens"]).all()
+
+    # 迟到的行插入可写段的对应位置
+    assert store.append_many(batch([40, 60, 25])) == 3
+    data = store.scan()
+    assert data["ts"].tolist() == [10, 20, 25, 30, 40, 50, 60]
+    assert (data["ts"] == data["tokens"]).all()
+
+    # 第一段写满后封存；早于新段起点的行被拒绝并计数，不会被改写成较晚的时间戳
+    assert store.append_many(batch([70, 80, 90])) == 3
+    assert store.append_many(batch([5, 75, 100])) == 2
+    assert store.rejected == 1
+    data = store.scan()
+    assert data["ts"].tolist() == [10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90, 100]
+    assert (data["ts"] == data["tokens"]).all()
+    assert store.scan(end=None, start=None, tenant_id=1)["ts"].tolist() == data["ts"].tolist()
+
+
+def test_manifest_flushed_in_batches():
+    root = tempfile.mkdtemp()
+    store = ColumnarEventStore(root, segment_rows=16, flush_rows=3, flush_seconds=3600)
+    for ts in (1, 2):
+        store.append_many(batch([ts]))
+    # 未达到行数阈值：请求路径不刷盘，清单尚未记录这两行，但读取可见
+    assert ColumnarEventStore(root).row_count() == 0
+    assert store.scan()["ts"].tolist() == [1, 2]
+    store.append_many(batch([3]))
+    # 达到阈值后刷盘：模拟进程异常退出后重新打开，不丢行
+    reopened = ColumnarEventStore(root)
+    assert reopened.row_count() == 3
+    reopened.append_many(batch([4]))
+    reopened.flush()
+    assert ColumnarEventStore(root).scan()["ts"].tolist() == [1, 2, 3, 4]
+    assert {col for col, _ in COLUMNS} == set(reopened.scan())
+
+
+def test_background_flusher():
+    root = tempfile.mkdtemp()
+    store = ColumnarEventStore(root, segment_rows=16, flush_rows=1000, flush_seconds=0.05)
+    store.start_flusher()
+    store.append_many(batch([1, 2]))
+    deadline = time.monotonic() + 5
+    while ColumnarEventStore(root).row_count() < 2 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert ColumnarEventStore(root).row_count() == 2
+
+
+def main():
+    print("🔍 列式事件存储测试")
+    print("=" * 50)
+    test_out_of_order_rows_are_not_rewritten()
+    test_manifest_flushed_in_batches()
+    test_background_flusher()
+    print("\n🎉 列式事件存储测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 条件 GET 测试
+版本化的列表接口返回 ETag，带相同 If-None-Match 时返回 304；
+用户写入（_user_changed）后 ETag 变化，医院管理员只受本租户的写入影响。
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "etags.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, User, utcnow
+from server.tenants import tenant_directory
+from server.tokens import issue_token
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+ORGANIZATION, OTHER = "ETag测试医院甲", "ETag测试医院乙"
+
+client = TestClient(app_main.app)
+_state = {}
+
+
+def setup_module(module=None):
+    client.__enter__()
+    db = SessionLocal()
+    try:
+        for name in (ORGANIZATION, OTHER):
+            tenant_directory.create(db, name)
+        tenants = {name: tenant_directory.resolve(db, name) for name in (ORGANIZATION, OTHER)}
+        users = {}
+        for key, organization, role in (
+            ("root", ORGANIZATION, "admin"),
+            ("manager", ORGANIZATION, "hospital_admin"),
+            ("member", ORGANIZATION, "user"),
+            ("other", OTHER, "user"),
+        ):
+            email = f"{key}@etags.example.com"
+            user = db.query(User).filter(User.email == email).first()
+            if user is None:
+                now = utcnow()
+                user = User(
+                    email=email, password_hash="x", name=f"ETag{key}", organization=organization,
+                    phone="13800000000", tenant_id=tenants[organization], role=role,
+                    is_admin=role == "admin", created_at=now, updated_at=now,
+                )
+                db.add(user)
+                db.commit()
+            users[key] = user
+        _state["tenants"] = tenants
+        _state["users"] = {key: u.id for key, u in users.items()}
+        _state["root"] = {"Authorization": f"Bearer {issue_token(users['root'])['access_token']}"}
+        _state["manager"] = {"Authorization": f"Bearer {issue_token(users['manager'])['access_token']}"}
+    finally:
+        db.close()
+
+
+def versioned_lists():
+    """(路径, 请求头, 查询参数)：覆盖所有带 ETag 的列表接口"""
+    tenant_id = _state["tenants"][ORGANIZATION]
+    return [
+        ("/api/admin/users", ADMIN, {}),
+        ("/api/admin/users", _state["root"], {"fields": "id,email"}),
+        ("/api/admin/users:paged", _state["root"], {"size": 5}),
+        ("/api/admin/users:paged2", _state["root"], {"size": 5}),
+        ("/api/admin/users:changes", ADMIN, {"since": 0}),
+        ("/api/admin/usage:summary", ADMIN, {}),
+        ("/api/admin/usage:by-user", ADMIN, {}),
+        ("/api/admin/usage:by-day", ADMIN, {}),
+        ("/api/admin/organizations", ADMIN, {}),
+        (f"/api/admin/organizations/{ORGANIZATION}/users", ADMIN, {}),
+        (f"/api/admin/organizations/{ORGANIZATION}/stats", ADMIN, {}),
+        (f"/api/admin/tenants/{tenant_id}/stats", ADMIN, {}),
+    ]
+
+
+def etag_of(path, headers, params):
+    resp = client.get(path, headers=headers, params=params)
+    assert resp.status_code == 200, (path, resp.text)
+    assert resp.headers["Cache-Control"] == "private, no-cache"
+    return resp.headers["ETag"]
+
+
+def revalidate(path, headers, params, etag):
+    return client.get(path, headers={**headers, "If-None-Match": etag}, params=params)
+
+
+def test_not_modified_on_matching_etag():
+    for path, headers, params in versioned_lists():
+        etag = etag_of(path, headers, params)
+        resp = revalidate(path, headers, params, etag)
+        assert resp.status_code == 304, path
+        assert resp.content == b"" and resp.headers["ETag"] == etag
+        # 代理加上的 W/ 前缀、列表中的多个值同样命中
+        assert revalidate(path, headers, params, f'W/{etag}').status_code == 304, path
+        assert revalidate(path, headers, params, f'"stale", {etag}').status_code == 304, path
+        assert revalidate(path, headers, params, '"stale"').status_code == 200, path
+
+
+def test_etag_changes_after_user_changed():
+    lists = versioned_lists()
+    before = {(path, tuple(params.items())): etag_of(path, headers, params) for path, headers, params in lists}
+    app_main._user_changed("updated", _state["users"]["member"], _state["tenants"][ORGANIZATION])
+    for path, headers, params in lists:
+        resp = revalidate(path, headers, params, before[(path, tuple(params.items()))])
+        assert resp.status_code == 200, path
+        assert resp.headers["ETag"] != before[(path, tuple(params.items()))], path
+
+
+def test_manager_etag_scoped_to_tenant():
+    path, headers = "/api/admin/users", _state["manager"]
+    etag = etag_of(path, headers, {})
+    # 其他租户的写入不影响医院管理员的缓存
+    app_main._user_changed("updated", _state["users"]["other"], _state["tenants"][OTHER])
+    assert revalidate(path, headers, {}, etag).status_code == 304
+    app_main._user_changed("updated", _state["users"]["member"], _state["tenants"][ORGANIZATION])
+    assert revalidate(path, headers, {}, etag).status_code == 200
+
+
+def test_update_endpoint_invalidates_etag():
+    etag = etag_of("/api/admin/users", ADMIN, {})
+    user_id = _state["users"]["member"]
+    resp = client.patch(f"/api/admin/users/{user_id}", headers=ADMIN, json={"name": "ETag改名"})
+    assert resp.status_code == 200, resp.text
+    resp = revalidate("/api/admin/users", ADMIN, {}, etag)
+    assert resp.status_code == 200
+    assert {u["id"]: u["name"] for u in resp.json()}[user_id] == "ETag改名"
+
+
+def main():
+    print("🔍 条件 GET 测试")
+    print("=" * 50)
+    setup_module()
+    test_not_modified_on_matching_etag()
+    test_etag_changes_after_user_changed()
+    test_manager_etag_scoped_to_tenant()
+    test_update_endpoint_invalidates_etag()
+    print("\n🎉 条件 GET 测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
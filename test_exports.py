@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 流式导出测试
+users:export / usage:export 的 CSV 与 NDJSON 输出、gzip 压缩后解压与未压缩内容一致、
+按租户与时间范围过滤，以及响应头（类型、文件名、Content-Encoding）。
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "exports.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, UsageEvent, User, utcnow
+from server.exports import USAGE_EXPORT_COLUMNS, USER_EXPORT_COLUMNS
+from server.tenants import tenant_directory
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+ORGANIZATION, OTHER = "导出测试医院甲", "导出测试医院乙"
+EVENT_DAYS = (1, 2, 3)
+
+client = TestClient(app_main.app)
+_state = {}
+
+
+def setup_module(module=None):
+    client.__enter__()
+    db = SessionLocal()
+    try:
+        for name in (ORGANIZATION, OTHER):
+            tenant_directory.create(db, name)
+        tenants = {name: tenant_directory.resolve(db, name) for name in (ORGANIZATION, OTHER)}
+        users = {}
+        for email, organization in (
+            ("a@exports.example.com", ORGANIZATION),
+            ("b@exports.example.com", ORGANIZATION),
+            ("c@exports.example.com", OTHER),
+        ):
+            user = db.query(User).filter(User.email == email).first()
+            if user is None:
+                now = utcnow()
+                user = User(
+                    email=email, password_hash="x", name="导出测试；分号", organization=organization,
+                    phone="13800000000", tenant_id=tenants[organization], created_at=now, updated_at=now,
+                )
+                db.add(user)
+                db.flush()
+                # 固定时间的用量事件：甲机构每天一条，乙机构只在第二天有一条
+                days = EVENT_DAYS if organization == ORGANIZATION else (2,)
+                for day in days:
+                    db.add(UsageEvent(
+                        tenant_id=user.tenant_id, user_id=user.id, event_type="generate",
+                        created_at=datetime(2024, 3, day, 10), tokens_used=day * 10, latency_ms=day * 100,
+                    ))
+                db.commit()
+            users[email] = user.id
+        _state["tenants"] = tenants
+        _state["users"] = users
+    finally:
+        db.close()
+
+
+def get_export(path, **params):
+    resp = client.get(path, headers=ADMIN, params=params)
+    assert resp.status_code == 200, resp.text
+    return resp
+
+
+def csv_rows(resp):
+    return list(csv.reader(io.StringIO(resp.text), delimiter=";"))
+
+
+def ndjson_rows(resp):
+    return [json.loads(line) for line in resp.text.splitlines()]
+
+
+def raw_body(path, **params):
+    """不经客户端自动解压的原始响应体"""
+    with client.stream("GET", path, headers=ADMIN, params=params) as resp:
+        assert resp.status_code == 200
+        return resp.headers, b"".join(resp.iter_raw())
+
+
+def test_users_export_formats():
+    tenant_id = _state["tenants"][ORGANIZATION]
+    resp = get_export("/api/admin/users:export", tenant_id=tenant_id)
+    assert resp.headers["content-type"] == "text/csv; charset=utf-8"
+    assert resp.headers["content-disposition"] == 'attachment; filename="users.csv"'
+    assert "content-encoding" not in resp.headers
+    rows = csv_rows(resp)
+    assert rows[0] == USER_EXPORT_COLUMNS
+    assert [r[1] for r in rows[1:]] == ["a@exports.example.com", "b@exports.example.com"]
+    assert rows[1][2] == "导出测试；分号"
+    assert rows[1][USER_EXPORT_COLUMNS.index("usage_used")] == "0"
+
+    resp = get_export("/api/admin/users:export", format="ndjson", tenant_id=tenant_id)
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    assert resp.headers["content-disposition"] == 'attachment; filename="users.ndjson"'
+    items = ndjson_rows(resp)
+    assert [u["email"] for u in items] == ["a@exports.example.com", "b@exports.example.com"]
+    assert set(items[0]) == set(USER_EXPORT_COLUMNS)
+    assert items[0]["is_admin"] == 0 and items[0]["organization"] == ORGANIZATION
+
+    # 旧接口与 format=csv 输出一致
+    assert get_export("/api/admin/users:export-csv", tenant_id=tenant_id).content == get_export(
+        "/api/admin/users:export", tenant_id=tenant_id
+    ).content
+
+
+def test_usage_export_filters():
+    tenant_id = _state["tenants"][ORGANIZATION]
+    resp = get_export("/api/admin/usage:export", tenant_id=tenant_id)
+    assert resp.headers["content-disposition"] == 'attachment; filename="usage_events.csv"'
+    rows = csv_rows(resp)
+    assert rows[0] == USAGE_EXPORT_COLUMNS
+    created = USAGE_EXPORT_COLUMNS.index("created_at")
+    # 按时间升序，两个用户各三天
+    assert [r[created] for r in rows[1:]] == sorted(r[created] for r in rows[1:])
+    assert len(rows) - 1 == 2 * len(EVENT_DAYS)
+    assert {r[USAGE_EXPORT_COLUMNS.index("meta")] for r in rows[1:]} == {""}
+
+    resp = get_export(
+        "/api/admin/usage:export", format="ndjson",
+        start="2024-03-02T00:00:00", end="2024-03-02T23:59:59",
+    )
+    items = [e for e in ndjson_rows(resp) if e["tenant_id"] in _state["tenants"].values()]
+    assert sorted(e["user_id"] for e in items) == sorted(_state["users"].values())
+    assert {e["created_at"] for e in items} == {"2024-03-02T10:00:00"}
+    assert items[0]["tokens_used"] == 20 and items[0]["latency_ms"] == 200 and items[0]["meta"] is None
+
+    user_id = _state["users"]["b@exports.example.com"]
+    resp = get_export("/api/admin/usage:export", format="ndjson", user_id=user_id, start="2024-03-02T10:00:00")
+    assert [e["created_at"] for e in ndjson_rows(resp)] == ["2024-03-02T10:00:00", "2024-03-03T10:00:00"]
+
+
+def test_gzip_round_trip():
+    tenant_id = _state["tenants"][ORGANIZATION]
+    for path in ("/api/admin/users:export", "/api/admin/usage:export"):
+        for fmt in ("csv", "ndjson"):
+            plain = get_export(path, format=fmt, tenant_id=tenant_id).content
+            headers, body = raw_body(path, format=fmt, tenant_id=tenant_id, gzip="true")
+            assert headers["content-encoding"] == "gzip"
+            assert headers["vary"] == "Accept-Encoding"
+            assert body[:2] == b"\x1f\x8b"
+            assert gzip.decompress(body) == plain
+
+
+def test_export_rejects_bad_requests():
+    assert client.get("/api/admin/users:export").status_code in (401, 403)
+    assert client.get("/api/admin/usage:export", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/api/admin/users:export", headers=ADMIN, params={"format": "xml"}).status_code == 400
+    resp = client.get("/api/admin/usage:export", headers=ADMIN, params={"start": "昨天"})
+    assert resp.status_code == 400
+
+
+def main():
+    print("🔍 流式导出测试")
+    print("=" * 50)
+    setup_module()
+    test_users_export_formats()
+    test_usage_export_filters()
+    test_gzip_round_trip()
+    test_export_rejects_bad_requests()
+    print("\n🎉 流式导出测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 用户列表游标分页测试
+排序键重复（created_at 相同、邮箱仅大小写不同）时逐页翻完不重不漏，
+以及篡改、乱码、排序方式不一致的游标被拒绝（接口返回 400）。
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "pagination.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, User
+from server.pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_page, projected_user_query
+from server.tenants import tenant_directory
+from server.tokens import issue_token
+
+ORGANIZATION = "分页测试医院"
+# 只有三个不同的创建时间，大量行的排序键相同
+TIMES = [datetime(2023, 5, 1, 8), datetime(2023, 5, 1, 9), datetime(2023, 5, 2, 8)]
+# 邮箱仅大小写不同（唯一约束区分大小写）
+EMAILS = [
+    "page-a@pagination.example.com", "Page-A@pagination.example.com", "PAGE-A@pagination.example.com",
+    "page-b@pagination.example.com", "Page-b@pagination.example.com",
+    "page-c@pagination.example.com", "page-C@pagination.example.com",
+    "page-d@pagination.example.com", "page-e@pagination.example.com",
+    "Page-f@pagination.example.com", "page-F@pagination.example.com",
+]
+
+client = TestClient(app_main.app)
+_state = {}
+
+
+def setup_module(module=None):
+    client.__enter__()
+    db = SessionLocal()
+    try:
+        tenant_directory.create(db, ORGANIZATION)
+        tenant_id = tenant_directory.resolve(db, ORGANIZATION)
+        if db.query(User.id).filter(User.tenant_id == tenant_id).first() is None:
+            # 插入顺序与邮箱、时间顺序均不一致，id 才真正起到次序键的作用
+            for i, email in enumerate(reversed(EMAILS)):
+                created_at = TIMES[i % len(TIMES)]
+                db.add(User(
+                    email=email, password_hash="x", name=f"分页{i}", organization=ORGANIZATION,
+                    phone="13800000000", tenant_id=tenant_id, created_at=created_at, updated_at=created_at,
+                ))
+            db.commit()
+        manager = db.query(User).filter(User.email == EMAILS[0]).one()
+        manager.role = "hospital_admin"
+        db.commit()
+        _state["tenant_id"] = tenant_id
+        _state["token"] = issue_token(manager)["access_token"]
+        _state["rows"] = [
+            (u.id, u.created_at, u.email) for u in db.query(User).filter(User.tenant_id == tenant_id)
+        ]
+    finally:
+        db.close()
+
+
+def expected_ids(sort, order):
+    index = {"id": 0, "created_at": 1, "email": 2}[sort]
+    rows = sorted(_state["rows"], key=lambda r: (r[index], r[0]), reverse=order == "desc")
+    return [r[0] for r in rows]
+
+
+def walk(db, sort, order, size=3):
+    ids, cursor, pages = [], None, 0
+    while True:
+        q = projected_user_query(db, sort).filter(User.tenant_id == _state["tenant_id"])
+        rows, cursor = keyset_page(q, sort, order, size, cursor)
+        assert 0 < len(rows) <= size
+        ids.extend(r.id for r in rows)
+        pages += 1
+        if cursor is None:
+            return ids, pages
+
+
+def test_cursor_round_trip_with_duplicate_keys():
+    created = [r[1] for r in _state["rows"]]
+    assert len(set(created)) < len(created)
+    assert len({r[2].lower() for r in _state["rows"]}) < len(EMAILS)
+    db = SessionLocal()
+    try:
+        for sort in ("id", "created_at", "email"):
+            for order in ("asc", "desc"):
+                ids, pages = walk(db, sort, order)
+                assert ids == expected_ids(sort, order), (sort, order)
+                assert len(set(ids)) == len(EMAILS)
+                assert pages == -(-len(EMAILS) // 3)
+                # 每页恰好一行时同样不重不漏
+                assert walk(db, sort, order, size=1)[0] == ids
+    finally:
+        db.close()
+
+
+def test_endpoint_round_trip():
+    headers = {"Authorization": f"Bearer {_state['token']}"}
+    for sort in ("created_at", "email"):
+        ids, cursor = [], None
+        while True:
+            params = {"sort": sort, "order": "desc", "size": 4}
+            if cursor:
+                params["cursor"] = cursor
+            resp = client.get("/api/admin/users:paged2", headers=headers, params=params)
+            assert resp.status_code == 200, resp.text
+            body = resp.json()
+            ids.extend(u["id"] for u in body["items"])
+            assert body["has_more"] == (body["next_cursor"] is not None)
+            cursor = body["next_cursor"]
+            if not cursor:
+                break
+        assert ids == expected_ids(sort, "desc")
+
+
+def assert_invalid(cursor, sort="created_at", order="asc"):
+    try:
+        decode_cursor(cursor, sort, order)
+    except InvalidCursor:
+        return
+    raise AssertionError(f"游标应被拒绝: {cursor!r}")
+
+
+def test_invalid_cursors_rejected():
+    value = TIMES[1]
+    good = encode_cursor("created_at", "asc", value, 5)
+    assert decode_cursor(good, "created_at", "asc") == (value, 5)
+    for bad in (
+        "",
+        "not-a-cursor",
+        "!!!",
+        "游标",
+        good[:-3],
+        good + "AAAA",
+        encode_cursor("created_at", "asc", value, "x"),
+        encode_cursor("created_at", "asc", {"dt": "not-a-date"}, 5),
+    ):
+        assert_invalid(bad)
+    # 游标中的排序方式与本次请求不一致
+    assert_invalid(good, sort="email")
+    assert_invalid(good, order="desc")
+    assert_invalid(encode_cursor("email", "asc", EMAILS[0], 5))
+
+    headers = {"Authorization": f"Bearer {_state['token']}"}
+    for path in ("/api/admin/users:paged", "/api/admin/users:paged2"):
+        for params in (
+            {"sort": "created_at", "cursor": "not-a-cursor"},
+            {"sort": "created_at", "cursor": good[:-3]},
+            {"sort": "email", "cursor": good},
+            {"sort": "created_at", "order": "desc", "cursor": good},
+        ):
+            resp = client.get(path, headers=headers, params=params)
+            assert resp.status_code == 400, (path, params, resp.text)
+
+
+def main():
+    print("🔍 用户列表游标分页测试")
+    print("=" * 50)
+    setup_module()
+    test_cursor_round_trip_with_duplicate_keys()
+    test_endpoint_round_trip()
+    test_invalid_cursors_rejected()
+    print("\n🎉 用户列表游标分页测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
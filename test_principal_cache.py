@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 鉴权缓存失效测试
+修改、删除、重置密码/用量与 CSV 导入后，下一次请求立即使用新的用户状态与配额，
+不需要等待 PRINCIPAL_CACHE_TTL 过期。
+"""
+
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "principal_cache.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, User
+from server.principals import principal_cache
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+ORGANIZATION = "缓存测试医院"
+PASSWORD = "secret123"
+
+client = TestClient(app_main.app)
+_saved = {}
+
+
+def setup_module(module=None):
+    client.__enter__()
+    resp = client.post("/api/admin/tenants", headers=ADMIN, json={"name": ORGANIZATION})
+    assert resp.status_code in (200, 409), resp.text
+    # 缓存足够久，测试中读到的新状态只可能来自显式失效；裸 X-User-Id 每次都经过缓存判断状态
+    _saved["ttl"], principal_cache.ttl = principal_cache.ttl, 3600
+    _saved["legacy"], app_main.ALLOW_LEGACY_USER_HEADER = app_main.ALLOW_LEGACY_USER_HEADER, True
+
+
+def teardown_module(module=None):
+    principal_cache.ttl = _saved["ttl"]
+    app_main.ALLOW_LEGACY_USER_HEADER = _saved["legacy"]
+
+
+def create_user(email):
+    resp = client.post("/api/admin/users", headers=ADMIN, json={
+        "name": "缓存测试", "organization": ORGANIZATION, "phone": "13800000000",
+        "email": email, "password": PASSWORD,
+    })
+    assert resp.status_code == 200, resp.text
+    return resp.json()["id"]
+
+
+def me(user_id):
+    return client.get("/api/me/usage", headers={"X-User-Id": str(user_id)})
+
+
+def disable_in_db(user_id):
+    """绕过接口直接改库：缓存仍是旧状态，直到某个接口使其失效"""
+    assert me(user_id).status_code == 200
+    db = SessionLocal()
+    try:
+        db.query(User).filter(User.id == user_id).update({"status": "disabled"})
+        db.commit()
+    finally:
+        db.close()
+    assert me(user_id).status_code == 200
+
+
+def test_update_and_delete_invalidate():
+    user_id = create_user("update@cache.example.com")
+    assert me(user_id).json()["usage_quota"] != 5
+
+    resp = client.patch(f"/api/admin/users/{user_id}", headers=ADMIN, json={"usage_quota": 5})
+    assert resp.status_code == 200, resp.text
+    assert me(user_id).json()["usage_quota"] == 5
+
+    resp = client.patch(f"/api/admin/users/{user_id}", headers=ADMIN, json={"status": "disabled"})
+    assert resp.status_code == 200, resp.text
+    assert me(user_id).status_code == 403
+
+    other_id = create_user("delete@cache.example.com")
+    assert me(other_id).status_code == 200
+    assert client.delete(f"/api/admin/users/{other_id}", headers=ADMIN).status_code == 200
+    assert me(other_id).status_code == 404
+
+
+def test_reset_endpoints_invalidate():
+    user_id = create_user("reset-password@cache.example.com")
+    disable_in_db(user_id)
+    resp = client.post(f"/api/admin/users/{user_id}:reset-password", headers=ADMIN, json={"new_password": "newsecret"})
+    assert resp.status_code == 200, resp.text
+    assert me(user_id).status_code == 403
+
+    user_id = create_user("reset-usage@cache.example.com")
+    disable_in_db(user_id)
+    assert client.post(f"/api/admin/users/{user_id}:reset-usage", headers=ADMIN).status_code == 200
+    assert me(user_id).status_code == 403
+
+
+def test_csv_import_invalidates():
+    user_id = create_user("import@cache.example.com")
+    assert me(user_id).status_code == 200
+    content = "email;organization;status\nimport@cache.example.com;缓存测试医院;disabled\n".encode("utf-8")
+    resp = client.post(
+        "/api/admin/users:import-csv", headers=ADMIN, files={"file": ("users.csv", io.BytesIO(content), "text/csv")}
+    )
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["updated"] == 1
+    assert me(user_id).status_code == 403
+
+
+def main():
+    print("🔍 鉴权缓存失效测试")
+    print("=" * 50)
+    setup_module()
+    try:
+        test_update_and_delete_invalidate()
+        test_reset_endpoints_invalidate()
+        test_csv_import_invalidates()
+    finally:
+        teardown_module()
+    print("\n🎉 鉴权缓存失效测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 热点查询执行计划审计
+捕获管理端热点接口实际发出的SQL，逐条执行 EXPLAIN QUERY PLAN，
+一旦某条查询退化为全表扫描（SCAN 表 且未使用索引）即判定失败。
+"""
+
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "plan_audit.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from sqlalchemy import event, select, text
+
+from server.bulk_users import bulk_conditions, run_bulk
+from server.db import Base, SessionLocal, User, engine, run_simple_migrations
+from server.org_stats import list_organizations, organization_totals, tenant_totals
+from server.pagination import encode_cursor, keyset_page, projected_user_query
+from server.rollups import aggregate_usage
+from server.user_changes import changes_since
+from server.user_search import ensure_user_search, search_users, user_search_filter
+
+# 形如 "SCAN users" 且没有 "USING ... INDEX" 的计划行即为全表扫描；
+# FTS5 虚拟表的 "SCAN users_fts VIRTUAL TABLE INDEX ..." 是走全文索引，不算全表扫描
+TABLE_SCAN = re.compile(r"^SCAN (\w+)\b(?! USING| VIRTUAL TABLE INDEX)")
+
+# 带时间窗口的查询：覆盖 原始事件边缘 + 小时桶 + 日桶 三种分段
+WINDOW = (datetime(2026, 9, 3, 10, 15), datetime(2026, 9, 20, 3, 30))
+
+
+def setup_module(module=None):
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+
+
+def capture_sql(fn):
+    """执行 fn 并返回期间发出的 SELECT 语句及参数"""
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return captured
+
+
+def explain(statement, parameters):
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+    return [row[-1] for row in rows]
+
+
+def table_scans(captured):
+    """返回 [(表名, SQL, 执行计划)]，列出所有退化为全表扫描的查询"""
+    scans = []
+    for statement, parameters in captured:
+        plan = explain(statement, parameters)
+        for line in plan:
+            m = TABLE_SCAN.match(line)
+            if m:
+                scans.append((m.group(1), statement, plan))
+    return scans
+
+
+def assert_no_table_scan(name, fn):
+    captured = capture_sql(fn)
+    assert captured, f"{name}: 未捕获到任何查询"
+    scans = table_scans(captured)
+    for table, statement, plan in scans:
+        print(f"   ❌ {name}: 全表扫描 {table}\n      SQL: {statement}\n      PLAN: {plan}")
+    assert not scans, f"{name}: 查询退化为全表扫描"
+    print(f"   ✅ {name}: {len(captured)} 条查询均使用索引")
+
+
+def test_usage_window_queries():
+    """用量统计：时间窗口查询必须走 created_at / bucket 索引"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        for group_by in ("total", "user", "day"):
+            assert_no_table_scan(
+                f"usage:{group_by}", lambda: aggregate_usage(db, *WINDOW, group_by=group_by)
+            )
+            assert_no_table_scan(
+                f"usage:{group_by}:tenant",
+                lambda: aggregate_usage(db, *WINDOW, group_by=group_by, tenant_id=1),
+            )
+    finally:
+        db.close()
+
+
+def test_unbounded_usage_reads_rollups_only():
+    """不带时间窗口的统计只能读取汇总表，不能扫描 usage_events"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        captured = capture_sql(lambda: aggregate_usage(db, None, None, group_by="user"))
+        assert captured
+        for table, statement, _ in table_scans(captured):
+            assert table.startswith("usage_rollups_"), f"不应扫描 {table}: {statement}"
+    finally:
+        db.close()
+
+
+def test_organization_queries():
+    """机构统计：读物化统计表与机构事件统计"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        org = "北京协和医院"
+        org_user_ids = select(User.id).where(User.organization == org)
+        assert_no_table_scan("org:list", lambda: list_organizations(db))
+        assert_no_table_scan("org:totals", lambda: organization_totals(db, org, 1))
+        assert_no_table_scan("tenant:totals", lambda: tenant_totals(db, 1))
+        assert_no_table_scan(
+            "org:events",
+            lambda: aggregate_usage(db, *WINDOW, group_by="total", user_ids=org_user_ids),
+        )
+    finally:
+        db.close()
+
+
+def test_user_lookups():
+    """鉴权与唯一性检查的主键/邮箱查找"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        assert_no_table_scan("user:by_id", lambda: db.query(User).filter(User.id == 1).first())
+        assert_no_table_scan(
+            "user:by_email", lambda: db.query(User).filter(User.email == "a@b.com").first()
+        )
+        assert_no_table_scan(
+            "user:tenant_list",
+            lambda: db.query(User).filter(User.tenant_id == 1).order_by(User.id.asc()).all(),
+        )
+    finally:
+        db.close()
+
+
+def test_user_keyset_pages():
+    """用户列表游标分页：后续页直接在 (排序键, id) 索引上定位"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        for sort, value in (("id", 1000), ("created_at", datetime(2026, 9, 3)), ("email", "m@b.com")):
+            cursor = encode_cursor(sort, "desc", value, 1000)
+            assert_no_table_scan(
+                f"users:keyset:{sort}",
+                lambda: keyset_page(db.query(User), sort, "desc", 20, cursor),
+            )
+            assert_no_table_scan(
+                f"users:keyset:{sort}:tenant",
+                lambda: keyset_page(db.query(User).filter(User.tenant_id == 1), sort, "desc", 20, cursor),
+            )
+            # fields= 投影：只查询请求的列，排序键不在其中时仍能定位
+            assert_no_table_scan(
+                f"users:keyset:{sort}:fields",
+                lambda: keyset_page(
+                    projected_user_query(db, sort, ("id", "name")).filter(User.tenant_id == 1), sort, "desc", 20, cursor
+                ),
+            )
+    finally:
+        db.close()
+
+
+def test_user_search_uses_fts():
+    """用户搜索：三个字符以上的查询词走 FTS5 全文索引，不扫描 users"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        assert ensure_user_search(db)
+        for q in ("张伟芳", "13800012", "hosp7.cn"):
+            assert_no_table_scan(f"users:search:{q}", lambda: search_users(db, q, 20))
+            assert_no_table_scan(
+                f"users:search:{q}:paged",
+                lambda: keyset_page(db.query(User).filter(User.tenant_id == 1, user_search_filter(q)), "id", "asc", 20),
+            )
+    finally:
+        db.close()
+
+
+def test_user_changes_since():
+    """增量同步：按变更序号定位，不扫描用户表或变更日志"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        assert_no_table_scan("users:changes", lambda: changes_since(db, 100, 50))
+        assert_no_table_scan("users:changes:tenant", lambda: changes_since(db, 100, 50, tenant_id=1))
+    finally:
+        db.close()
+
+
+def test_bulk_user_selection():
+    """批量操作按租户/ID选中用户，不能扫描 users"""
+    setup_module()
+    db = SessionLocal()
+    try:
+        assert_no_table_scan(
+            "users:bulk:tenant", lambda: run_bulk(db, "disable", bulk_conditions(tenant_id=1, status="active"))
+        )
+        assert_no_table_scan("users:bulk:ids", lambda: run_bulk(db, "reset_usage", bulk_conditions(ids=[1, 2, 3])))
+    finally:
+        db.close()
+
+
+def test_indexes_created_by_migration():
+    """迁移应为已有库补建复合索引"""
+    setup_module()
+    with engine.connect() as conn:
+        names = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    for expected in (
+        "ix_usage_events_tenant_created",
+        "ix_usage_events_user_created",
+        "ix_usage_events_created_at",
+        "ix_users_organization_status",
+        "ix_users_tenant_created",
+    ):
+        assert expected in names, f"缺少索引 {expected}"
+    print(f"   ✅ 已创建 {len(names)} 个索引")
+
+
+def main():
+    print("🔍 热点查询执行计划审计")
+    print("=" * 50)
+    test_usage_window_queries()
+    test_unbounded_usage_reads_rollups_only()
+    test_organization_queries()
+    test_user_lookups()
+    test_user_keyset_pages()
+    test_user_search_uses_fts()
+    test_user_changes_since()
+    test_bulk_user_selection()
+    test_indexes_created_by_migration()
+    print("\n🎉 所有热点查询均未退化为全表扫描")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 用量事件保留策略测试
+归档清理后：明细查询跨热数据与冷归档按时间归并、取满 limit 即停止且不重复；
+重建汇总表时并入冷归档，统计与清理前一致。
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# 使用临时数据库与归档目录，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "retention.db"))
+os.environ.setdefault("USAGE_PURGE_CHUNK_PAUSE", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from server.db import Base, SessionLocal, UsageEvent, UsageRollupDaily, UsageRollupHourly, engine, run_simple_migrations
+from server.retention import _append_archive, event_to_dict, iter_archive_by_day, purge_tenant, query_events
+from server.rollups import apply_event, backfill_rollups
+
+TENANT = 9101
+START = datetime(2021, 3, 1, 22, 0)
+CUTOFF = datetime(2021, 3, 3)
+
+
+def setup_module(module=None):
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+    db = SessionLocal()
+    try:
+        if db.query(UsageEvent.id).filter(UsageEvent.tenant_id == TENANT).first() is None:
+            # 三天内每 37 分钟一条事件，跨越小时与日期边界
+            for i in range(120):
+                created_at = START + timedelta(minutes=37 * i)
+                tokens, latency = 10 + i, (None if i % 5 == 0 else 100 + i)
+                db.add(UsageEvent(
+                    tenant_id=TENANT, user_id=1 + i % 3, event_type="generate",
+                    created_at=created_at, tokens_used=tokens, latency_ms=latency,
+                ))
+                apply_event(db, TENANT, 1 + i % 3, created_at, tokens, latency)
+            db.commit()
+    finally:
+        db.close()
+
+
+def rollup_snapshot(db):
+    snapshot = {}
+    for model in (UsageRollupHourly, UsageRollupDaily):
+        rows = db.query(model).filter(model.tenant_id == TENANT).all()
+        snapshot[model.__tablename__] = sorted(
+            (str(r.bucket), r.user_id, r.event_count, r.tokens_sum, r.latency_sum, r.latency_count) for r in rows
+        )
+    return snapshot
+
+
+def event_ids(db):
+    rows = db.query(UsageEvent).filter(UsageEvent.tenant_id == TENANT).all()
+    return [e.id for e in sorted(rows, key=lambda e: (e.created_at, e.id))]
+
+
+def test_query_and_rebuild_after_purge():
+    db = SessionLocal()
+    try:
+        expected_ids = event_ids(db)
+        before = rollup_snapshot(db)
+        assert purge_tenant(db, TENANT, CUTOFF) > 0
+        hot_ids = event_ids(db)
+        assert 0 < len(hot_ids) < len(expected_ids)
+        # 模拟清理中断：同一事件既已归档又仍在热数据中
+        _append_archive([event_to_dict(db.query(UsageEvent).filter(UsageEvent.id == hot_ids[0]).one())])
+
+        result = query_events(db, tenant_id=TENANT, limit=len(expected_ids) + 10)
+        assert [r["id"] for r in result["items"]] == expected_ids
+        assert result["hot"] == len(hot_ids) and result["archived"] == len(expected_ids) - len(hot_ids)
+        assert not result["truncated"]
+
+        # 只取前几条：全部来自归档，标记为截断
+        result = query_events(db, tenant_id=TENANT, limit=5)
+        assert [r["id"] for r in result["items"]] == expected_ids[:5]
+        assert result["truncated"] and result["hot"] == 0
+
+        # 跨越归档与热数据分界的窗口（闭区间）
+        lo, hi = CUTOFF - timedelta(hours=3), CUTOFF + timedelta(hours=3)
+        result = query_events(db, lo, hi, tenant_id=TENANT, limit=1000)
+        created = [datetime.fromisoformat(r["created_at"]) for r in result["items"]]
+        assert created == sorted(created) and all(lo <= c <= hi for c in created)
+        assert result["hot"] > 0 and result["archived"] > 0
+
+        # 重建汇总表并入冷归档，与清理前一致
+        backfill_rollups(db, iter_archive_by_day())
+        assert rollup_snapshot(db) == before
+    finally:
+        db.close()
+
+
+def main():
+    print("🔍 用量事件保留策略测试")
+    print("=" * 50)
+    setup_module()
+    test_query_and_rebuild_after_purge()
+    print("\n🎉 用量事件保留策略测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
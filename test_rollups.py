@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 用量汇总窗口拆分正确性测试
+aggregate_usage（原始事件边缘 + 小时桶 + 日桶）与直接逐条扫描事件的结果逐项比对，
+覆盖起止落在整点/零点、窗口在同一小时内、起止相同与不限起止（None）等边界。
+"""
+
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "rollups.db"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from server.db import Base, SessionLocal, UsageEvent, UsageRollupDaily, UsageRollupHourly, engine, run_simple_migrations
+from server.rollups import aggregate_usage, apply_event
+
+TENANT = 9301
+BASE = datetime(2022, 7, 8)
+US = timedelta(microseconds=1)
+
+# 事件时间：六天内每 7 分钟左右一条，外加恰好落在整点、零点及其前后 1 微秒的事件
+EVENT_TIMES = sorted(
+    [BASE + timedelta(minutes=7 * i, seconds=i % 60, microseconds=i * 37 % 1000) for i in range(6 * 24 * 60 // 7)]
+    + [
+        moment + delta
+        for moment in (datetime(2022, 7, 10), datetime(2022, 7, 10, 13), datetime(2022, 7, 11, 17), datetime(2022, 7, 12))
+        for delta in (-US, timedelta(0), timedelta(0), US)
+    ]
+)
+
+WINDOWS = [
+    # 起止均为零点
+    (datetime(2022, 7, 9), datetime(2022, 7, 12)),
+    # 起止均为整点
+    (datetime(2022, 7, 9, 5), datetime(2022, 7, 11, 17)),
+    (datetime(2022, 7, 10, 13), datetime(2022, 7, 10, 14)),
+    # 一端为零点、另一端在小时中间
+    (datetime(2022, 7, 9, 5, 17, 3), datetime(2022, 7, 12)),
+    (datetime(2022, 7, 10), datetime(2022, 7, 11, 17, 42, 9, 500)),
+    # 一端为整点、另一端在小时中间
+    (datetime(2022, 7, 10, 13), datetime(2022, 7, 11, 6, 30)),
+    (datetime(2022, 7, 9, 22, 59, 59, 999999), datetime(2022, 7, 11, 17)),
+    # 同一天内跨若干小时，不含整天
+    (datetime(2022, 7, 10, 2, 30), datetime(2022, 7, 10, 20, 15)),
+    # 相邻两个小时，中间没有整小时桶
+    (datetime(2022, 7, 10, 12, 30), datetime(2022, 7, 10, 13, 10)),
+    # 窗口在同一小时内
+    (datetime(2022, 7, 10, 13, 5), datetime(2022, 7, 10, 13, 55)),
+    (datetime(2022, 7, 10, 13), datetime(2022, 7, 10, 13, 59, 59, 999999)),
+    (datetime(2022, 7, 10, 12, 59, 59, 999999), datetime(2022, 7, 10, 13)),
+    # 起止相同：只统计恰好在该时刻的事件
+    (datetime(2022, 7, 10, 13), datetime(2022, 7, 10, 13)),
+    # 不限起止
+    (None, datetime(2022, 7, 10, 13)),
+    (None, datetime(2022, 7, 11, 6, 30)),
+    (datetime(2022, 7, 10), None),
+    (datetime(2022, 7, 10, 13, 0, 0, 1), None),
+    (None, None),
+    # 起点晚于终点
+    (datetime(2022, 7, 11), datetime(2022, 7, 10)),
+    # 带时区的输入按 UTC 处理
+    (
+        datetime(2022, 7, 10, 8, tzinfo=timezone(timedelta(hours=8))),
+        datetime(2022, 7, 11, 9, 45, tzinfo=timezone(timedelta(hours=8))),
+    ),
+]
+
+_events = []
+
+
+def setup_module(module=None):
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+    rng = random.Random(20220708)
+    _events.clear()
+    for i, created_at in enumerate(EVENT_TIMES):
+        tokens = rng.choice([None, rng.randrange(1, 500)])
+        latency = rng.choice([None, rng.randrange(50, 5000)])
+        _events.append((created_at, 1 + i % 4, tokens, latency))
+    db = SessionLocal()
+    try:
+        for model in (UsageEvent, UsageRollupHourly, UsageRollupDaily):
+            db.query(model).filter(model.tenant_id == TENANT).delete(synchronize_session=False)
+        for created_at, user_id, tokens, latency in _events:
+            db.add(UsageEvent(
+                tenant_id=TENANT, user_id=user_id, event_type="generate",
+                created_at=created_at, tokens_used=tokens, latency_ms=latency,
+            ))
+            apply_event(db, TENANT, user_id, created_at, tokens, latency)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _utc(dt):
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def direct_scan(start, end, group_by):
+    """逐条扫描事件的参考结果（闭区间）"""
+    start, end = _utc(start), _utc(end)
+    result = {}
+    for created_at, user_id, tokens, latency in _events:
+        if (start is not None and created_at < start) or (end is not None and created_at > end):
+            continue
+        key = {"total": None, "user": user_id, "day": created_at.date().isoformat()}[group_by]
+        acc = result.setdefault(key, {"event_count": 0, "tokens_sum": 0, "latency_sum": 0, "latency_count": 0})
+        acc["event_count"] += 1
+        acc["tokens_sum"] += tokens or 0
+        acc["latency_sum"] += latency or 0
+        acc["latency_count"] += 1 if latency is not None else 0
+    return result
+
+
+def test_aggregate_matches_direct_scan():
+    db = SessionLocal()
+    try:
+        for start, end in WINDOWS:
+            for group_by in ("total", "user", "day"):
+                expected = direct_scan(start, end, group_by)
+                actual = aggregate_usage(db, start, end, group_by=group_by, tenant_id=TENANT)
+                assert actual == expected, (start, end, group_by, actual, expected)
+    finally:
+        db.close()
+
+
+def test_boundary_events_counted_once():
+    """恰好落在整点/零点的事件只计入一个分段"""
+    db = SessionLocal()
+    try:
+        midnight = datetime(2022, 7, 10)
+        for start, end in ((midnight - US, midnight), (midnight, midnight + US), (midnight - US, midnight + US)):
+            expected = direct_scan(start, end, "total")
+            assert aggregate_usage(db, start, end, tenant_id=TENANT) == expected
+        assert direct_scan(midnight - US, midnight + US, "total")[None]["event_count"] == 4
+    finally:
+        db.close()
+
+
+def main():
+    print("🔍 用量汇总窗口拆分正确性测试")
+    print("=" * 50)
+    setup_module()
+    test_aggregate_matches_direct_scan()
+    test_boundary_events_counted_once()
+    print("\n🎉 汇总结果与逐条扫描一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 机构租户测试
+租户只能显式创建：管理员创建用户时机构须对应已有租户，自助注册的未知机构归入默认租户；
+旧库按机构回填租户为一次性迁移，只归入已有租户、报告未匹配的机构，执行后不能再次执行。
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "tenants.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, Tenant, User, utcnow
+from server.tenants import DEFAULT_TENANT_ID, tenant_directory
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+
+client = TestClient(app_main.app)
+
+
+def setup_module(module=None):
+    client.__enter__()
+
+
+def user_payload(email, organization):
+    return {
+        "name": "租户测试", "organization": organization, "phone": "13800000000",
+        "email": email, "password": "secret123",
+    }
+
+
+def tenant_exists(name):
+    db = SessionLocal()
+    try:
+        return db.query(Tenant.id).filter(Tenant.name == name).first() is not None
+    finally:
+        db.close()
+
+
+def user_tenant(email):
+    db = SessionLocal()
+    try:
+        return db.query(User.tenant_id).filter(User.email == email).scalar()
+    finally:
+        db.close()
+
+
+def test_tenants_created_explicitly():
+    # 未创建的机构：管理员创建用户返回 400，且不会生成租户
+    resp = client.post("/api/admin/users", headers=ADMIN, json=user_payload("a@tenants.example.com", "租户测试医院甲"))
+    assert resp.status_code == 400, resp.text
+    assert not tenant_exists("租户测试医院甲")
+
+    resp = client.post("/api/admin/tenants", headers=ADMIN, json={"name": " 租户测试医院甲 "})
+    assert resp.status_code == 200, resp.text
+    tenant_id = resp.json()["id"]
+    assert client.post("/api/admin/tenants", headers=ADMIN, json={"name": "租户测试医院甲"}).status_code == 409
+    assert client.post("/api/admin/tenants", json={"name": "租户测试医院乙"}).status_code in (401, 403)
+
+    resp = client.post("/api/admin/users", headers=ADMIN, json=user_payload("a@tenants.example.com", "租户测试医院甲"))
+    assert resp.status_code == 200, resp.text
+    user = resp.json()
+    assert user_tenant("a@tenants.example.com") == tenant_id
+
+    # 修改为不存在的机构同样被拒绝，用户保持原租户
+    resp = client.patch(f"/api/admin/users/{user['id']}", headers=ADMIN, json={"organization": "租户测试医院笔误"})
+    assert resp.status_code == 400, resp.text
+    assert not tenant_exists("租户测试医院笔误")
+    assert user_tenant("a@tenants.example.com") == tenant_id
+
+    # 自助注册：未知机构归入默认租户，不创建租户
+    resp = client.post("/api/users/register", json=user_payload("b@tenants.example.com", "租户测试医院丙"))
+    assert resp.status_code == 200, resp.text
+    assert user_tenant("b@tenants.example.com") == DEFAULT_TENANT_ID
+    assert not tenant_exists("租户测试医院丙")
+    resp = client.post("/api/users/register", json=user_payload("c@tenants.example.com", "租户测试医院甲"))
+    assert resp.status_code == 200, resp.text
+    assert user_tenant("c@tenants.example.com") == tenant_id
+
+
+def test_backfill_runs_once():
+    db = SessionLocal()
+    try:
+        # 旧库：所有用户都在默认租户
+        now = utcnow()
+        tenant_directory.create(db, "回填医院甲")
+        for email, organization in (("d@tenants.example.com", "回填医院甲"), ("e@tenants.example.com", "回填医院乙")):
+            db.add(User(
+                email=email, password_hash="x", name="回填测试", organization=organization, phone="13800000000",
+                tenant_id=DEFAULT_TENANT_ID, created_at=now, updated_at=now,
+            ))
+        db.commit()
+    finally:
+        db.close()
+
+    resp = client.post("/api/admin/tenants:backfill", headers=ADMIN, params={"dry_run": "true"})
+    assert resp.status_code == 200, resp.text
+    preview = resp.json()
+    assert preview["dry_run"] and preview["users_moved"] >= 1
+    assert {"organization": "回填医院乙", "users": 1} in preview["unmatched"]
+
+    resp = client.post("/api/admin/tenants:backfill", headers=ADMIN)
+    assert resp.status_code == 200, resp.text
+    result = resp.json()
+    assert result["users_moved"] == preview["users_moved"]
+    assert result["unmatched"] == preview["unmatched"]
+
+    db = SessionLocal()
+    try:
+        moved = db.query(User).filter(User.email == "d@tenants.example.com").one()
+        assert moved.tenant_id == tenant_directory.resolve(db, "回填医院甲")
+        kept = db.query(User).filter(User.email == "e@tenants.example.com").one()
+        assert kept.tenant_id == DEFAULT_TENANT_ID
+    finally:
+        db.close()
+    # 未匹配的机构不会创建租户；迁移只执行一次
+    assert not tenant_exists("回填医院乙")
+    assert client.post("/api/admin/tenants:backfill", headers=ADMIN).status_code == 409
+    assert client.post("/api/admin/tenants:backfill", headers=ADMIN, params={"dry_run": "true"}).status_code == 409
+
+
+def main():
+    print("🔍 机构租户测试")
+    print("=" * 50)
+    setup_module()
+    test_tenants_created_explicitly()
+    test_backfill_runs_once()
+    print("\n🎉 机构租户测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
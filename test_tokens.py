@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 会话令牌测试
+签发与校验、过期、篡改与非法输入，禁用/删除/改密后的撤销，
+以及裸 X-User-Id 请求头默认拒绝、开启后也不能代表管理员；X-Real-IP 仅在来自受信任代理时采用。
+"""
+
+import ipaddress
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "tokens.db"))
+os.environ.setdefault("ADMIN_TOKEN", "secret-admin")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi import Request
+from fastapi.testclient import TestClient
+
+from server import main as app_main
+from server.db import SessionLocal, User
+from server.principals import principal_cache
+from server.tokens import InvalidToken, _b64decode, _b64encode, issue_token, verify_token
+
+ADMIN = {"X-Admin-Token": "secret-admin"}
+PASSWORD = "secret123"
+
+client = TestClient(app_main.app)
+
+
+def setup_module(module=None):
+    client.__enter__()
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def create_user(email, organization="令牌测试医院"):
+    # 机构须对应已有租户
+    resp = client.post("/api/admin/tenants", headers=ADMIN, json={"name": organization})
+    assert resp.status_code in (200, 409), resp.text
+    resp = client.post("/api/admin/users", headers=ADMIN, json={
+        "name": "令牌测试", "organization": organization, "phone": "13800000000",
+        "email": email, "password": PASSWORD,
+    })
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+def login(email, password=PASSWORD):
+    resp = client.post("/api/users/login", json={"email": email, "password": password})
+    assert resp.status_code == 200, resp.text
+    return resp.json()["access_token"]
+
+
+def assert_invalid(token):
+    try:
+        verify_token(token)
+    except InvalidToken:
+        return
+    raise AssertionError(f"令牌应被拒绝: {token!r}")
+
+
+def test_issue_and_verify():
+    user = create_user("issue@tokens.example.com")
+    token = login("issue@tokens.example.com")
+    principal = verify_token(token)
+    assert principal.id == user["id"]
+    assert principal.role == "user" and not principal.is_admin
+    resp = client.get("/api/users/me", headers=bearer(token))
+    assert resp.status_code == 200 and resp.json()["id"] == user["id"]
+
+
+def test_expired_token_rejected():
+    user = create_user("expiry@tokens.example.com")
+    db = SessionLocal()
+    try:
+        row = db.query(User).filter(User.id == user["id"]).first()
+        token = issue_token(row, ttl=-1)["access_token"]
+    finally:
+        db.close()
+    assert_invalid(token)
+    assert client.get("/api/users/me", headers=bearer(token)).status_code == 401
+
+
+def test_tampered_and_malformed_tokens_rejected():
+    create_user("tamper@tokens.example.com")
+    token = login("tamper@tokens.example.com")
+    body, signature = token.split(".")
+    # 改写载荷中的角色，签名不变
+    forged = _b64encode(_b64decode(body).replace(b'"role":"user"', b'"role":"admin"'))
+    assert forged != body
+    for bad in (
+        f"{forged}.{signature}",
+        f"{body}.{signature[:-2]}",
+        f"{body}.{signature}.x",
+        "not-a-token",
+        "",
+        f"{body}é.{signature}",
+        f"{body}.{signature}é",
+        "令牌.签名",
+    ):
+        assert_invalid(bad)
+    # 非 ASCII 的令牌经请求头传入时同样返回 401，而不是 500
+    resp = client.get("/api/users/me", headers={"Authorization": f"Bearer {body}.{signature}é".encode("latin-1")})
+    assert resp.status_code == 401, resp.text
+    resp = client.get("/api/users/me", headers=bearer(f"{forged}.{signature}"))
+    assert resp.status_code == 401
+
+
+def test_revoked_after_disable():
+    user = create_user("disable@tokens.example.com")
+    token = login("disable@tokens.example.com")
+    resp = client.patch(f"/api/admin/users/{user['id']}", headers=ADMIN, json={"status": "disabled"})
+    assert resp.status_code == 200, resp.text
+    assert_invalid(token)
+    assert client.get("/api/users/me", headers=bearer(token)).status_code == 401
+
+
+def test_revoked_after_delete():
+    user = create_user("delete@tokens.example.com")
+    token = login("delete@tokens.example.com")
+    assert client.delete(f"/api/admin/users/{user['id']}", headers=ADMIN).status_code == 200
+    assert_invalid(token)
+    assert client.get("/api/users/me", headers=bearer(token)).status_code == 401
+
+
+def test_revoked_after_password_change():
+    user = create_user("password@tokens.example.com")
+    old = login("password@tokens.example.com")
+    resp = client.post(
+        f"/api/users/{user['id']}/password:change",
+        json={"old_password": PASSWORD, "new_password": "changed123"},
+    )
+    assert resp.status_code == 200, resp.text
+    assert_invalid(old)
+    # 改密时为调用方签发的新令牌有效
+    assert verify_token(resp.json()["access_token"]).id == user["id"]
+
+    # 管理员重置密码同样使此前的令牌失效
+    current = login("password@tokens.example.com", "changed123")
+    resp = client.post(f"/api/admin/users/{user['id']}:reset-password", headers=ADMIN, json={"new_password": "reset1234"})
+    assert resp.status_code == 200, resp.text
+    assert_invalid(current)
+    assert verify_token(login("password@tokens.example.com", "reset1234")).id == user["id"]
+
+
+def test_legacy_user_header():
+    user = create_user("legacy@tokens.example.com")
+    manager = create_user("legacy-manager@tokens.example.com")
+    db = SessionLocal()
+    try:
+        db.query(User).filter(User.id == manager["id"]).update({"role": "hospital_admin"})
+        db.commit()
+    finally:
+        db.close()
+    principal_cache.invalidate([manager["id"]])
+
+    # 默认关闭：裸 X-User-Id 一律拒绝
+    assert not app_main.ALLOW_LEGACY_USER_HEADER
+    assert client.get("/api/users/me", headers={"X-User-Id": str(user["id"])}).status_code == 401
+    resp = client.post("/api/generate", headers={"X-User-Id": str(user["id"])}, json={"prompt": "hi"})
+    assert resp.status_code == 401
+    assert client.get("/api/admin/users", headers={"X-User-Id": str(manager["id"])}).status_code == 401
+
+    # 显式开启后仅普通用户可用，管理员仍须使用会话令牌
+    app_main.ALLOW_LEGACY_USER_HEADER = True
+    try:
+        resp = client.get("/api/users/me", headers={"X-User-Id": str(user["id"])})
+        assert resp.status_code == 200 and resp.json()["id"] == user["id"]
+        assert client.get("/api/users/me", headers={"X-User-Id": str(manager["id"])}).status_code == 401
+        assert client.get("/api/admin/users", headers={"X-User-Id": str(manager["id"])}).status_code == 401
+        resp = client.post("/api/admin/users:bulk", headers={"X-User-Id": str(manager["id"])}, json={"op": "disable", "filter": {"ids": [user["id"]]}})
+        assert resp.status_code == 401
+        resp = client.post("/api/generate", headers={"X-User-Id": str(manager["id"])}, json={"prompt": "hi"})
+        assert resp.status_code == 401
+    finally:
+        app_main.ALLOW_LEGACY_USER_HEADER = False
+
+    # 医院管理员使用会话令牌正常访问
+    resp = client.get("/api/admin/users", headers=bearer(login("legacy-manager@tokens.example.com")))
+    assert resp.status_code == 200, resp.text
+
+
+def test_client_ip_trusts_configured_proxies():
+    def request_from(host, real_ip):
+        return Request({"type": "http", "client": (host, 50000), "headers": [(b"x-real-ip", real_ip.encode())]})
+
+    saved = app_main.TRUSTED_PROXIES
+    try:
+        # 未配置代理：伪造的 X-Real-IP 不生效
+        app_main.TRUSTED_PROXIES = []
+        assert app_main.client_ip(request_from("203.0.113.5", "10.9.9.9")) == "203.0.113.5"
+        app_main.TRUSTED_PROXIES = [ipaddress.ip_network("172.18.0.0/16")]
+        assert app_main.client_ip(request_from("172.18.0.3", "198.51.100.7")) == "198.51.100.7"
+        assert app_main.client_ip(request_from("203.0.113.5", "10.9.9.9")) == "203.0.113.5"
+        assert app_main.client_ip(request_from("testclient", "10.9.9.9")) == "testclient"
+    finally:
+        app_main.TRUSTED_PROXIES = saved
+
+
+def main():
+    print("🔍 会话令牌测试")
+    print("=" * 50)
+    setup_module()
+    test_issue_and_verify()
+    test_expired_token_rejected()
+    test_tampered_and_malformed_tokens_rejected()
+    test_revoked_after_disable()
+    test_revoked_after_delete()
+    test_revoked_after_password_change()
+    test_legacy_user_header()
+    test_client_ip_trusts_configured_proxies()
+    print("\n🎉 会话令牌测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 用户增量同步测试
+按租户拉取变更：新增、更新、删除，以及用户迁到其他租户后原租户收到墓碑。
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "user_changes.db"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from server.db import Base, SessionLocal, Tenant, User, engine, run_simple_migrations, utcnow
+from server.user_changes import changes_since, current_version, ensure_change_log
+
+
+def setup_module(module=None):
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+    db = SessionLocal()
+    try:
+        ensure_change_log(db)
+    finally:
+        db.close()
+
+
+def tenant_of(db, organization):
+    tenant = db.query(Tenant).filter(Tenant.name == organization).first()
+    if tenant is None:
+        tenant = Tenant(name=organization)
+        db.add(tenant)
+        db.flush()
+    return tenant.id
+
+
+def add_user(db, email, organization):
+    now = utcnow()
+    user = User(
+        email=email, password_hash="x", name="同步测试", organization=organization, phone="13800000000",
+        tenant_id=tenant_of(db, organization), created_at=now, updated_at=now,
+    )
+    db.add(user)
+    db.commit()
+    return user
+
+
+def test_changes_by_tenant():
+    db = SessionLocal()
+    try:
+        since = current_version(db)
+        user = add_user(db, "sync-a@changes.example.com", "同步医院甲")
+        tenant_id = user.tenant_id
+        changes = changes_since(db, since, tenant_id=tenant_id)
+        assert [u["id"] for u in changes["items"]] == [user.id]
+        assert changes["deleted"] == []
+
+        since = changes["version"]
+        user.name = "同步测试（改名）"
+        db.commit()
+        changes = changes_since(db, since, tenant_id=tenant_id)
+        assert [u["name"] for u in changes["items"]] == ["同步测试（改名）"]
+
+        since = changes["version"]
+        user_id = user.id
+        db.delete(user)
+        db.commit()
+        changes = changes_since(db, since, tenant_id=tenant_id)
+        assert changes["items"] == [] and changes["deleted"] == [user_id]
+    finally:
+        db.close()
+
+
+def test_move_leaves_tombstone_in_old_tenant():
+    db = SessionLocal()
+    try:
+        user = add_user(db, "sync-move@changes.example.com", "同步医院乙")
+        old_tenant = user.tenant_id
+        new_tenant = tenant_of(db, "同步医院丙")
+        db.commit()
+        old_since = changes_since(db, 0, tenant_id=old_tenant)["version"]
+        new_since = current_version(db)
+        all_since = current_version(db)
+
+        user.organization = "同步医院丙"
+        user.tenant_id = new_tenant
+        db.commit()
+
+        # 原租户：收到删除，不再返回该用户
+        changes = changes_since(db, old_since, tenant_id=old_tenant)
+        assert changes["items"] == [] and changes["deleted"] == [user.id]
+        # 新租户：收到新增
+        changes = changes_since(db, new_since, tenant_id=new_tenant)
+        assert [u["id"] for u in changes["items"]] == [user.id] and changes["deleted"] == []
+        # 不限租户：只作为更新出现一次
+        changes = changes_since(db, all_since)
+        assert [u["id"] for u in changes["items"]] == [user.id] and changes["deleted"] == []
+
+        # 迁回原租户：原租户重新收到该用户，新租户收到删除
+        old_since = changes_since(db, old_since, tenant_id=old_tenant)["version"]
+        new_since = changes_since(db, new_since, tenant_id=new_tenant)["version"]
+        user.organization = "同步医院乙"
+        user.tenant_id = old_tenant
+        db.commit()
+        changes = changes_since(db, old_since, tenant_id=old_tenant)
+        assert [u["id"] for u in changes["items"]] == [user.id] and changes["deleted"] == []
+        changes = changes_since(db, new_since, tenant_id=new_tenant)
+        assert changes["items"] == [] and changes["deleted"] == [user.id]
+    finally:
+        db.close()
+
+
+def main():
+    print("🔍 用户增量同步测试")
+    print("=" * 50)
+    setup_module()
+    test_changes_by_tenant()
+    test_move_leaves_tombstone_in_old_tenant()
+    print("\n🎉 用户增量同步测试全部通过")
+
+
+if __name__ == "__main__":
+    main()
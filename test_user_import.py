@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+MedGemma AI 用户 CSV 批量导入测试
+逐行错误的行号与原因、第 1000/1001 行的分批边界（批内重复合并、跨批重复转为更新），
+以及机构须对应已有租户（不自动创建）、机构变化的已有用户迁到新租户。
+"""
+
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 使用临时数据库，避免影响本地 app.db
+os.environ.setdefault("APP_DB_PATH", os.path.join(tempfile.mkdtemp(), "user_import.db"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from server.db import Base, SessionLocal, User, engine, run_simple_migrations
+from server.tenants import ensure_default_tenant, tenant_directory
+from server.user_import import CHUNK_SIZE, import_users_csv
+
+HEADER = "email;name;organization;usage_quota"
+
+
+def setup_module(module=None):
+    Base.metadata.create_all(bind=engine)
+    run_simple_migrations()
+    db = SessionLocal()
+    try:
+        ensure_default_tenant(db)
+        for organization in ("导入医院甲", "导入医院乙"):
+            tenant_directory.create(db, organization)
+    finally:
+        db.close()
+
+
+def run_import(db, lines):
+    """导入给定数据行（自动加表头），第 N 条数据行位于文件第 N+1 行"""
+    data = "\n".join([HEADER, *lines]) + "\n"
+    return import_users_csv(db, io.BytesIO(data.encode("utf-8")), password_hash="x")
+
+
+def user_by_email(db, email):
+    return db.query(User).filter(User.email == email).one()
+
+
+def test_row_errors_report_line_numbers():
+    db = SessionLocal()
+    try:
+        report = run_import(db, [
+            "ok-1@import.example.com;正常一;导入医院甲;10",   # 第 2 行
+            ";缺邮箱;导入医院甲;10",                           # 第 3 行
+            "not-an-email;格式错误;导入医院甲;10",             # 第 4 行
+            "quota@import.example.com;额度错误;导入医院甲;abc",  # 第 5 行
+            ";;;",                                              # 第 6 行：空行跳过
+            "ok-2@import.example.com;正常二;导入医院甲;",      # 第 7 行
+        ])
+        assert report["created"] == 2 and report["updated"] == 0
+        assert report["error_count"] == 3
+        assert report["errors"] == [
+            {"line": 3, "email": None, "error": "缺少邮箱"},
+            {"line": 4, "email": "not-an-email", "error": "邮箱格式无效"},
+            {"line": 5, "email": "quota@import.example.com", "error": "usage_quota 不是整数: abc"},
+        ]
+        assert db.query(User).filter(User.email == "quota@import.example.com").first() is None
+        assert user_by_email(db, "ok-1@import.example.com").usage_quota == 10
+        assert user_by_email(db, "ok-2@import.example.com").usage_quota is None
+    finally:
+        db.close()
+
+
+def test_chunk_boundary():
+    db = SessionLocal()
+    try:
+        emails = [f"chunk-{i:04d}@import.example.com" for i in range(CHUNK_SIZE + 1)]
+        lines = [f"{email};第{i}行;导入医院乙;{i}" for i, email in enumerate(emails)]
+        # 第一批内重复：与前一行合并，非空字段覆盖，不占批次名额
+        lines.insert(500, f"{emails[1]};批内合并;;")
+        # 第一批恰好满 CHUNK_SIZE 个邮箱后，第 CHUNK_SIZE+1 个邮箱与跨批重复落在第二批
+        lines.append(f"{emails[2]};跨批更新;;")
+        report = run_import(db, lines)
+        assert report["error_count"] == 0, report["errors"]
+        assert report["created"] == CHUNK_SIZE + 1
+        assert report["updated"] == 1
+
+        merged = user_by_email(db, emails[1])
+        assert merged.name == "批内合并" and merged.usage_quota == 1 and merged.organization == "导入医院乙"
+        updated = user_by_email(db, emails[2])
+        assert updated.name == "跨批更新" and updated.usage_quota == 2
+        last = user_by_email(db, emails[CHUNK_SIZE])
+        assert last.name == f"第{CHUNK_SIZE}行"
+        count = db.query(User).filter(User.email.like("chunk-%@import.example.com")).count()
+        assert count == CHUNK_SIZE + 1
+    finally:
+        db.close()
+
+
+def test_unknown_organizations_rejected_and_users_moved():
+    db = SessionLocal()
+    try:
+        # 机构没有对应租户：记为该行错误，不创建租户
+        report = run_import(db, [
+            "tenant-a@import.example.com;租户甲;导入新医院丙;",
+            "tenant-b@import.example.com;租户乙;导入医院甲;",
+            "tenant-c@import.example.com;无机构;;",
+        ])
+        assert report["created"] == 2
+        assert report["errors"] == [
+            {"line": 2, "email": "tenant-a@import.example.com", "error": "机构不存在: 导入新医院丙"},
+        ]
+        assert tenant_directory.resolve(db, "导入新医院丙") is None
+        assert db.query(User).filter(User.email == "tenant-a@import.example.com").first() is None
+        tenant_id = tenant_directory.resolve(db, "导入医院甲")
+        assert user_by_email(db, "tenant-b@import.example.com").tenant_id == tenant_id
+        assert user_by_email(db, "tenant-c@import.example.com").tenant_id == tenant_directory.resolve(db, None)
+
+        # 显式创建租户后重新导入；已有用户机构变化时迁到该租户，未填机构的行保持原租户
+        new_tenant = tenant_directory.create(db, "导入新医院丙")
+        assert new_tenant is not None and new_tenant != tenant_id
+        report = run_import(db, [
+            "tenant-a@import.example.com;租户甲;导入新医院丙;",
+            "tenant-b@import.example.com;租户乙;导入新医院丙;",
+            "tenant-c@import.example.com;无机构（改名）;;",
+        ])
+        assert report["created"] == 1 and report["updated"] == 2 and report["error_count"] == 0
+        db.expire_all()
+        assert user_by_email(db, "tenant-a@import.example.com").tenant_id == new_tenant
+        moved = user_by_email(db, "tenant-b@import.example.com")
+        assert moved.tenant_id == new_tenant and moved.organization == "导入新医院丙"
+        kept = user_by_email(db, "tenant-c@import.example.com")
+        assert kept.tenant_id == tenant_directory.resolve(db, None) and kept.organization is None
+    finally:
+        db.close()
+
+
+def main():
+    print("🔍 用户批量导入测试")
+    print("=" * 50)
+    setup_module()
+    test_row_errors_report_line_numbers()
+    test_chunk_boundary()
+    test_unknown_organizations_rejected_and_users_moved()
+    print("\n🎉 用户批量导入测试全部通过")
+
+
+if __name__ == "__main__":
+    main()